@@ -0,0 +1,338 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+
+# modules of the app are imported the same way as app.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+# synthetic videos with the seconds between their scene cuts
+CASES = {
+    '360p-2m-30fps-cut5s': {'duration': 120, 'width': 640, 'height': 360, 'fps': 30, 'scene_cut': 5},
+    '720p-2m-25fps-cut15s': {'duration': 120, 'width': 1280, 'height': 720, 'fps': 25, 'scene_cut': 15},
+    '1080p-1m-30fps-cut2s': {'duration': 60, 'width': 1920, 'height': 1080, 'fps': 30, 'scene_cut': 2}
+}
+# allowed drop of frames/sec and growth of peak rss over the baseline
+DEFAULT_TOLERANCE = 0.1
+# rss growth in MB allowed over the tolerance, as a stage growing a few MB varies by more than the tolerance
+RSS_SLACK_MB = 16
+SEED = 'benchmark'
+
+
+def create_scene(rng, width, height):
+    # gradient of a random hue, so that the histograms of two scenes differ
+    hsv = np.empty((height, width, 3), dtype=np.uint8)
+    hsv[..., 0] = (rng.randint(0, 180) + np.linspace(0, 30, width)[np.newaxis, :]).astype(np.uint8) % 180
+    hsv[..., 1] = rng.randint(80, 256)
+    hsv[..., 2] = np.linspace(60, 255, height).astype(np.uint8)[:, np.newaxis]
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+
+def write_video(file_path, case, seed=0):
+    rng = np.random.RandomState(seed)
+    width, height, fps = case['width'], case['height'], case['fps']
+    writer = cv2.VideoWriter(file_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    # noise is rolled instead of generated for every frame, it still changes every frame
+    noise = rng.randint(0, 24, (height, width, 3)).astype(np.uint8)
+    frames_per_scene = int(case['scene_cut'] * fps)
+    radius = height // 8
+    for frame_id in range(case['duration'] * fps):
+        if frame_id % frames_per_scene == 0:
+            background = create_scene(rng, width, height)
+            color = tuple(map(int, rng.randint(0, 256, 3)))
+        frame = cv2.add(background, np.roll(noise, frame_id * 3, axis=1))
+        center = (radius + (frame_id * 7) % (width - 2 * radius), height // 2)
+        cv2.circle(frame, center, radius, color, -1)
+        writer.write(frame)
+    writer.release()
+
+
+def get_video(work_dir, name):
+    file_path = "{}/{}.mp4".format(work_dir, name)
+    if not os.path.exists(file_path):
+        print("Writing {}".format(file_path))
+        write_video(file_path, CASES[name])
+    return file_path
+
+
+def create_random_weights(work_dir):
+    # random weights cost the same as the real ones, so that the benchmarks run without the trained models
+    from generator.base_mode import BASE_MODEL, TECHNICAL, AESTHETIC
+    from nima.model_builder import Nima
+
+    weights_files = []
+    for model_type in [TECHNICAL, AESTHETIC]:
+        weights_file = "{}/random_{}.hdf5".format(work_dir, model_type)
+        if not os.path.exists(weights_file):
+            nima = Nima(BASE_MODEL, weights=None)
+            nima.build()
+            nima.nima_model.save_weights(weights_file)
+        weights_files.append(weights_file)
+    return weights_files
+
+
+def create_app(args, weights_files):
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.config.from_mapping(
+        TECHNICAL_WEIGHTS_FILE_PATH=weights_files[0],
+        AESTHETIC_WEIGHTS_FILE_PATH=weights_files[1],
+        IN_MEMORY_FRAMES=True,
+        NIMA_BATCH_SIZE=args.batch_size,
+        NIMA_DUAL_HEAD=False,
+        BATCHING_WAIT=0,
+        BATCHING_MAX_SIZE=64,
+        PREFILTER_RATIO=1,
+        INFERENCE_BACKEND=args.inference_backend,
+        CALIBRATION_IMAGES_PATH=None,
+        KEYFRAME_INTERVAL=args.keyframe_interval,
+        VIDEO_DECODER=args.video_decoder,
+        DECODE_THREADS=0,
+        DECODE_WORKERS=0,
+        SHARED_MEMORY_FRAMES=False,
+        PIPELINE_BATCHES=0,
+        SCENE_CANDIDATES=0,
+        SCENE_CANDIDATE_STRATEGY='sharpness',
+        FRAME_CACHE_SIZE=0,
+        PROGRESS_BARS=False
+    )
+    return app
+
+
+def read_status_mb(field):
+    # VmRSS or VmHWM of the process in MB, None without procfs
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def reset_peak_rss():
+    # linux resets the peak rss of the process, so that the peak of a stage is not the peak of the stages before it
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    # peak of the process so far in MB, ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_stage(stages, stage, frames, function, *args):
+    # rss growth of a stage is its peak over the rss it started with, else the growth of the peak of the process
+    is_reset = reset_peak_rss() and read_status_mb('VmRSS') is not None
+    start_rss = read_status_mb('VmRSS') if is_reset else get_peak_rss()
+    start_time = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start_time
+    rss_growth = (read_status_mb('VmHWM') if is_reset else get_peak_rss()) - start_rss
+    stage_result = stages.setdefault(stage, {'seconds': 0, 'frames': 0, 'rssGrowthMb': 0})
+    stage_result['seconds'] += seconds
+    stage_result['frames'] += frames
+    stage_result['rssGrowthMb'] = max(stage_result['rssGrowthMb'], rss_growth)
+    return result
+
+
+def run_mode(stages, name, mode_name, video_file_path, work_dir, args):
+    from generator import create_mode, init_state
+    from generator.base_mode import AESTHETIC, predict, score_frames
+
+    predicts_path = "{}/predicts/{}/{}".format(work_dir, name, mode_name)
+    os.makedirs(predicts_path, exist_ok=True)
+    state = init_state({
+        'request_uid': "{}:{}".format(name, mode_name),
+        'mode': mode_name,
+        'video_file_path': video_file_path,
+        'total_clips': args.total_clips,
+        'images_per_clip': args.images_per_clip,
+        'seed': SEED,
+        'image_extension': 'jpg',
+        'temp_images_path': "{}/temps".format(work_dir),
+        'predicts_path': predicts_path
+    })
+
+    clip_frames = []
+    extract_state = None
+    sample_state = None
+    for clip_id in range(1, state['total_clips'] + 1):
+        state.update({
+            'clip_id': clip_id,
+            'tag': "[{}:{}]".format(state['request_uid'], clip_id)
+        })
+        mode = create_mode(state)
+        frames_in_clip = mode.get_clip_details()[2]
+        extract_state = time_stage(stages, "{}.extract".format(mode_name), frames_in_clip, mode.extract, extract_state)
+        if clip_id == 1:
+            clip_frames = mode.extracted_frames
+        sample_state = time_stage(
+            stages, "{}.sample".format(mode_name), len(mode.extracted_frames), mode.sample, sample_state)
+
+    # aesthetic scores are cached in the frames ahead, so that predict times only the saving of the frames
+    state['sampled_frames'] = score_frames(state['sampled_frames'], AESTHETIC, state['batch_size'])
+    time_stage(stages, "{}.predict".format(mode_name), len(state['sampled_frames']), predict, state)
+    return clip_frames
+
+
+def run_score(stages, frames, work_dir, args):
+    import nima
+    from flask import current_app
+    from generator.base_mode import BASE_MODEL, TECHNICAL, AESTHETIC, WEIGHTS_FILE_PATHS
+
+    # nima.score reads the frames from a folder, same as the frames saved by the modes
+    images_path = "{}/score".format(work_dir)
+    os.makedirs(images_path, exist_ok=True)
+    for file_name in os.listdir(images_path):
+        os.remove(os.path.join(images_path, file_name))
+    for frame in frames:
+        cv2.imwrite("{}/{}.jpg".format(images_path, frame['image_id']), frame['image'])
+    for model_type in [TECHNICAL, AESTHETIC]:
+        time_stage(stages, "nima.score.{}".format(model_type), len(frames), nima.score,
+                   BASE_MODEL, current_app.config[WEIGHTS_FILE_PATHS[model_type]], images_path, args.batch_size,
+                   None, 'jpg', 0, args.inference_backend)
+
+
+def run_case(name, work_dir, args):
+    from generator import decoders
+    from generator.utils import SUPPORTED_MODES
+
+    video_file_path = get_video(work_dir, name)
+    stages = {}
+    clip_frames = []
+    # preview decodes the keyframes with pyav only
+    for mode_name in SUPPORTED_MODES if decoders.is_available(decoders.PYAV) else SUPPORTED_MODES[:2]:
+        frames = run_mode(stages, name, mode_name, video_file_path, work_dir, args)
+        clip_frames = clip_frames or frames
+    run_score(stages, clip_frames, work_dir, args)
+    for stage_result in stages.values():
+        stage_result['framesPerSecond'] = stage_result['frames'] / max(stage_result['seconds'], 1e-9)
+    return stages
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, stages in results['cases'].items():
+        for stage, result in stages.items():
+            base_result = baseline.get('cases', {}).get(name, {}).get(stage)
+            if base_result is None:
+                continue
+            if result['framesPerSecond'] < base_result['framesPerSecond'] * (1 - tolerance):
+                regressions.append("{} {}: {:.1f} frames/s against {:.1f} frames/s".format(
+                    name, stage, result['framesPerSecond'], base_result['framesPerSecond']))
+            # baselines saved before the rss growth was recorded are compared by their frames/s only
+            if 'rssGrowthMb' in base_result and \
+                    result['rssGrowthMb'] > base_result['rssGrowthMb'] * (1 + tolerance) + RSS_SLACK_MB:
+                regressions.append("{} {}: {:.0f} MB rss growth against {:.0f} MB".format(
+                    name, stage, result['rssGrowthMb'], base_result['rssGrowthMb']))
+    return regressions
+
+
+def print_results(results):
+    print("{:<24} {:<24} {:>10} {:>10} {:>12} {:>10}".format(
+        'case', 'stage', 'frames', 'seconds', 'frames/s', 'rss +MB'))
+    for name, stages in results['cases'].items():
+        for stage, result in stages.items():
+            print("{:<24} {:<24} {:>10} {:>10.3f} {:>12.1f} {:>10.0f}".format(
+                name, stage, result['frames'], result['seconds'], result['framesPerSecond'], result['rssGrowthMb']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases',
+                        nargs='*',
+                        default=list(CASES.keys()),
+                        choices=list(CASES.keys()),
+                        help='synthetic videos to benchmark, defaults to all')
+    parser.add_argument('--work-dir',
+                        default='./benchmarks/work',
+                        help='folder for the videos, weights and frames, defaults to "./benchmarks/work"')
+    parser.add_argument('--output',
+                        default='./benchmarks/results.json',
+                        help='results file, defaults to "./benchmarks/results.json"')
+    parser.add_argument('--baseline',
+                        default='./benchmarks/baseline.json',
+                        help='baseline the results are compared with, defaults to "./benchmarks/baseline.json"')
+    parser.add_argument('--save-baseline',
+                        action='store_true',
+                        help='save the results as the baseline instead of comparing them')
+    parser.add_argument('--tolerance',
+                        default=DEFAULT_TOLERANCE,
+                        type=float,
+                        help='allowed drop of frames/s and growth of the rss of a stage over the baseline, '
+                             'defaults to 0.1')
+    parser.add_argument('--weights',
+                        default='random',
+                        choices=['random', 'resources'],
+                        help='random weights or the trained weights in ./resources/weights, defaults to "random"')
+    parser.add_argument('--batch-size', default='32', help='batch size for scoring the frames, defaults to 32')
+    parser.add_argument('--inference-backend',
+                        default='keras',
+                        choices=['keras', 'tflite-float16', 'tflite-int8', 'tflite-dynamic'],
+                        help='backend running the models, defaults to "keras"')
+    parser.add_argument('--keyframe-interval', default=250, type=int, help='defaults to 250')
+    parser.add_argument('--video-decoder',
+                        default='opencv',
+                        choices=['opencv', 'pyav'],
+                        help='decoder of the videos, defaults to "opencv"')
+    parser.add_argument('--total-clips', default=2, type=int, help='clips of every video, defaults to 2')
+    parser.add_argument('--images-per-clip', default=3, type=int, help='images per clip, defaults to 3')
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    if args.weights == 'random':
+        weights_files = create_random_weights(args.work_dir)
+    else:
+        weights_files = [
+            './resources/weights/weights_mobilenet_technical_0.11.hdf5',
+            './resources/weights/weights_mobilenet_aesthetic_0.07.hdf5'
+        ]
+
+    from generator import load_models
+
+    app = create_app(args, weights_files)
+    with app.app_context():
+        load_models(app.config)
+        results = {
+            'platform': {
+                'python': platform.python_version(),
+                'opencv': cv2.__version__,
+                'cpus': os.cpu_count()
+            },
+            'args': vars(args),
+            'cases': {name: run_case(name, args.work_dir, args) for name in args.cases}
+        }
+    print_results(results)
+    with open(args.output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print("Saved the baseline at {}".format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline at {}, run with --save-baseline to create it".format(args.baseline))
+        return 0
+    with open(args.baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file), args.tolerance)
+    for regression in regressions:
+        print("Regression: {}".format(regression))
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,18 @@
 import argparse
 import json
 import os
-import traceback
 from logging.config import dictConfig
 
-from flask import Flask
+from flask import Flask, Response
 
-from generator import utils
+import jobs
+import metrics
+import result_cache
+from generator import check_drift, decoders, feature_index, load_models, utils
 from highlights import highlights
 
 
-def create_app():
+def create_app(args, load_nima_models=True):
     # load log config
     with open(args.log_config_path) as log_config_file:
         log_config = json.load(log_config_file)
@@ -20,11 +22,42 @@ def create_app():
     # create flask app and set the configs
     app = Flask(__name__)
     app.config.from_mapping(
+        LOG_CONFIG=log_config,
         TEMP_VIDEOS_PATH="{}/videos".format(args.temp_path),
         TEMP_IMAGES_PATH="{}/images".format(args.temp_path),
         TECHNICAL_WEIGHTS_FILE_PATH='./resources/weights/weights_mobilenet_technical_0.11.hdf5',
         AESTHETIC_WEIGHTS_FILE_PATH='./resources/weights/weights_mobilenet_aesthetic_0.07.hdf5',
-        OUTPUT_IMAGES_PATH="{}/images".format(args.output_path)
+        OUTPUT_IMAGES_PATH="{}/images".format(args.output_path),
+        IN_MEMORY_FRAMES=args.in_memory_frames,
+        NIMA_BATCH_SIZE=args.batch_size,
+        NIMA_DUAL_HEAD=args.dual_head,
+        BATCHING_WAIT=args.batching_wait,
+        BATCHING_MAX_SIZE=args.batching_max_size,
+        PREFILTER_RATIO=args.prefilter_ratio,
+        INFERENCE_BACKEND=args.inference_backend,
+        CALIBRATION_IMAGES_PATH=args.calibration_path,
+        KEYFRAME_INTERVAL=args.keyframe_interval,
+        VIDEO_DECODER=args.video_decoder,
+        DECODE_THREADS=args.decode_threads,
+        DECODE_WORKERS=args.decode_workers,
+        SHARED_MEMORY_FRAMES=args.shared_memory_frames,
+        PIPELINE_BATCHES=args.pipeline_batches,
+        SCENE_CANDIDATES=args.scene_candidates,
+        SCENE_CANDIDATE_STRATEGY=args.scene_candidate_strategy,
+        FRAME_CACHE_SIZE=args.frame_cache_size,
+        FEATURE_INDEX=args.feature_index,
+        FEATURES_PATH="{}/features".format(args.output_path),
+        JOBS_DB_PATH="{}/jobs.db".format(args.temp_path),
+        JOB_WORKERS=args.job_workers,
+        JOB_THREADS=args.job_threads,
+        JOB_QUEUE_LIMIT=args.job_queue_limit,
+        UPLOAD_TIMEOUT=args.upload_timeout,
+        RESULTS_DB_PATH="{}/results.db".format(args.temp_path),
+        RESULT_CACHE_SIZE=args.result_cache_size,
+        RESULT_CACHE_AGE=args.result_cache_age,
+        METRICS_DB_PATH="{}/metrics.db".format(args.temp_path),
+        PROGRESS_BARS=not args.no_progress_bars,
+        PREFORK_WORKERS=0
     )
     dirs_to_resets = [
         app.config['TEMP_VIDEOS_PATH'],
@@ -32,48 +65,85 @@ def create_app():
         app.config['OUTPUT_IMAGES_PATH']
     ]
     utils.create_dirs(dirs_to_resets, app.logger, "[flask]")
+    # indexes are keyed by the weights version, so they outlive the process and are only evicted by their age
+    os.makedirs(app.config['FEATURES_PATH'], exist_ok=True)
+    feature_index.evict_indexes(app.config['FEATURES_PATH'], app.config['RESULT_CACHE_AGE'] * 60 * 60)
+    jobs.JobStore(app.config['JOBS_DB_PATH']).reset()
+    metrics.MetricStore(app.config['METRICS_DB_PATH']).reset()
+    with app.app_context():
+        result_cache.get_result_cache().reset()
+    if app.config['RESULT_CACHE_SIZE'] > 0 or app.config['FEATURE_INDEX']:
+        app.config['WEIGHTS_VERSION'] = result_cache.get_weights_version(app.config)
 
-    # print available resources
-    import tensorflow as tf
-    # physical gpus
-    physical_gpus = tf.config.experimental.list_physical_devices('GPU')
-    app.logger.debug("Available Physical GPUs: {}".format(len(physical_gpus)))
-    # logical gpus
-    logical_gpus = tf.config.experimental.list_logical_devices('GPU')
-    app.logger.debug("Available Logical GPUs: {}".format(len(logical_gpus)))
+    if not 0 <= app.config['PREFILTER_RATIO'] <= 1:
+        app.logger.warning("Pre-filter ratio is clamped between 0 and 1")
+        app.config['PREFILTER_RATIO'] = min(max(app.config['PREFILTER_RATIO'], 0), 1)
+    if not decoders.is_available(app.config['VIDEO_DECODER']):
+        app.logger.warning("PyAV is not installed, decoding the videos with opencv")
+        app.config['VIDEO_DECODER'] = decoders.OPENCV
+    if not decoders.is_available(decoders.PYAV):
+        app.logger.warning("PyAV is not installed, preview requests are rejected")
+    if app.config['NIMA_DUAL_HEAD'] and not app.config['IN_MEMORY_FRAMES']:
+        app.logger.warning("Dual head scoring is used only with in-memory frames")
+    if app.config['FEATURE_INDEX'] and not app.config['IN_MEMORY_FRAMES']:
+        app.logger.warning("Feature index is built only with in-memory frames")
+    if app.config['SHARED_MEMORY_FRAMES'] and not (app.config['IN_MEMORY_FRAMES'] and app.config['DECODE_WORKERS'] > 1):
+        app.logger.warning("Shared memory frames are used only by the decode workers of in-memory frames")
+    if app.config['NIMA_DUAL_HEAD'] and app.config['INFERENCE_BACKEND'] != 'keras':
+        app.logger.warning("Dual head scoring runs on the keras backend")
+    # processes serving the requests whose models ran their warm-up, the pre-fork server counts its workers
+    app.extensions['readiness'] = lambda: (int('MODELS_WARM_UP_TIME' in app.config), 1)
+    # the pre-fork server loads the models in its workers after the fork
+    if load_nima_models:
+        warm_up_app(app)
 
     @app.route('/')
     def hello_world():
         return 'Hello, World!'
 
+    @app.route('/ready')
+    def get_readiness():
+        ready_workers, workers = app.extensions['readiness']()
+        return utils.get_print_string({
+            'ready': ready_workers >= workers,
+            'readyWorkers': ready_workers,
+            'workers': workers
+        }), 200 if ready_workers >= workers else 503
+
+    @app.route('/metrics')
+    def get_metrics():
+        # totals of the requests run by this process and the job workers, in the prometheus text format
+        return Response(metrics.MetricStore(app.config['METRICS_DB_PATH']).export(), mimetype=metrics.CONTENT_TYPE)
+
     # register modules
     app.register_blueprint(highlights)
 
     return app
 
 
-if __name__ == '__main__':
-    # get environment variables
-    env_name = os.environ.get("FLASK_ENV", default='development')
-    debug_on = bool(os.environ.get("FLASK_DEBUG", default=0))
-
+def warm_up_app(app, is_drift_checked=True):
+    # print available resources
     import tensorflow as tf
-    # show device placement only in debug mode
-    if debug_on:
-        tf.debugging.set_log_device_placement(True)
-    # get available gpus
-    gpus = tf.config.experimental.list_physical_devices('GPU')
-    if gpus:
-        try:
-            # allow memory growth for safe running of the program
-            # Currently, memory growth needs to be the same across GPUs
-            for gpu in gpus:
-                tf.config.experimental.set_memory_growth(gpu, True)
-        except RuntimeError as ex:
-            # Memory growth must be set before GPUs have been initialized
-            print("Exception occurred when enabling memory growth: {}".format(ex))
-            traceback.print_exc()
+    # physical gpus
+    physical_gpus = tf.config.experimental.list_physical_devices('GPU')
+    app.logger.debug("Available Physical GPUs: {}".format(len(physical_gpus)))
+    # logical gpus
+    logical_gpus = tf.config.experimental.list_logical_devices('GPU')
+    app.logger.debug("Available Logical GPUs: {}".format(len(logical_gpus)))
+
+    # load the models once so that all the requests share them
+    warm_up_time = load_models(app.config)
+    app.config['MODELS_WARM_UP_TIME'] = warm_up_time
+    app.logger.info("Loaded nima models in {:.3f}s".format(warm_up_time))
+    # converted models are compared with the keras models on the calibration images
+    if is_drift_checked and app.config['INFERENCE_BACKEND'] != 'keras' and app.config['CALIBRATION_IMAGES_PATH']:
+        for weights_file, drift in check_drift(app.config).items():
+            app.logger.info("Mean score drift of {} on {}: {}".format(
+                app.config['INFERENCE_BACKEND'], weights_file, drift))
+    return warm_up_time
+
 
+def create_parser():
     # ref: https://docs.python.org/3/howto/argparse.html
     parser = argparse.ArgumentParser()
     parser.add_argument('--log-config-path',
@@ -85,10 +155,132 @@ if __name__ == '__main__':
     parser.add_argument('--output-path',
                         default='./output',
                         help='folder for output, defaults to "./output"')
+    parser.add_argument('--in-memory-frames',
+                        action='store_true',
+                        help='keep the extracted frames in memory instead of the temp folder')
+    parser.add_argument('--batch-size',
+                        default='32',
+                        help='batch size for scoring the frames or "auto" to pick it from the available memory, '
+                             'defaults to 32')
+    parser.add_argument('--dual-head',
+                        action='store_true',
+                        help='score the in-memory frames with technical and aesthetic models in a single pass')
+    parser.add_argument('--batching-wait',
+                        default=0,
+                        type=float,
+                        help='milliseconds the frames of a request wait for the frames of the other requests to be '
+                             'scored in the same batch, defaults to 0 (every request scores its own batches)')
+    parser.add_argument('--batching-max-size',
+                        default=64,
+                        type=int,
+                        help='largest batch of the frames of the concurrent requests, defaults to 64')
+    parser.add_argument('--prefilter-ratio',
+                        default=1,
+                        type=float,
+                        help='fraction of the frames scored by the technical model, the others are dropped for being '
+                             'blurred, dark or blown-out, defaults to 1 (no pre-filter)')
+    parser.add_argument('--inference-backend',
+                        default='keras',
+                        choices=['keras', 'tflite-float16', 'tflite-int8', 'tflite-dynamic'],
+                        help='runs the models with keras or converted to tflite with the quantization, '
+                             'defaults to "keras"')
+    parser.add_argument('--calibration-path',
+                        default=None,
+                        help='folder of jpg images for calibrating tflite-int8 and for measuring the score drift '
+                             'of the tflite backends')
+    parser.add_argument('--keyframe-interval',
+                        default=250,
+                        type=int,
+                        help='expected frames between two keyframes, longer skips are done by seeking, defaults to 250')
+    parser.add_argument('--video-decoder',
+                        default='opencv',
+                        choices=['opencv', 'pyav'],
+                        help='decodes the videos with opencv or with pyav, which decodes with frame threading and '
+                             'scales the frames while converting them, defaults to "opencv"')
+    parser.add_argument('--decode-threads',
+                        default=0,
+                        type=int,
+                        help='threads of the pyav decoder, defaults to 0 (picked by ffmpeg)')
+    parser.add_argument('--decode-workers',
+                        default=0,
+                        type=int,
+                        help='number of processes decoding the clips in parallel with in-memory frames, '
+                             'defaults to 0 (sequential)')
+    parser.add_argument('--shared-memory-frames',
+                        action='store_true',
+                        help='decode workers hand the frames over through a shared memory ring instead of pickling '
+                             'them')
+    parser.add_argument('--pipeline-batches',
+                        default=0,
+                        type=int,
+                        help='frame batches queued between the decoder thread and the scorer of a clip with in-memory '
+                             'frames, defaults to 0 (decode the clip before scoring it)')
+    parser.add_argument('--scene-candidates',
+                        default=0,
+                        type=int,
+                        help='frames of every scene scored by the aesthetic model in scene_detect mode with in-memory '
+                             'frames, defaults to 0 (every frame)')
+    parser.add_argument('--scene-candidate-strategy',
+                        default='sharpness',
+                        choices=['even', 'sharpness'],
+                        help='picks evenly spaced or the sharpest frames as the candidates of a scene, '
+                             'defaults to "sharpness"')
+    parser.add_argument('--frame-cache-size',
+                        default=0,
+                        type=int,
+                        help='memory in MB for keeping the full resolution frames of the candidates during extraction, '
+                             'defaults to 0 (read them again from the video)')
+    parser.add_argument('--feature-index',
+                        action='store_true',
+                        help='score every in-memory frame with both the models and index them, so that the same video '
+                             'with other params is answered without decoding and scoring')
+    parser.add_argument('--job-workers',
+                        default=1,
+                        type=int,
+                        help='number of worker processes running the highlight jobs, defaults to 1')
+    parser.add_argument('--job-threads',
+                        default=1,
+                        type=int,
+                        help='jobs run at the same time by every job worker, sharing its models, defaults to 1')
+    parser.add_argument('--job-queue-limit',
+                        default=16,
+                        type=int,
+                        help='maximum number of queued and running jobs, defaults to 16')
+    parser.add_argument('--upload-timeout',
+                        default=600,
+                        type=int,
+                        help='seconds a job waits for the next chunk of its upload before failing, defaults to 600')
+    parser.add_argument('--result-cache-size',
+                        default=1024,
+                        type=int,
+                        help='disk space in MB for the images of the cached results, 0 disables the cache, '
+                             'defaults to 1024')
+    parser.add_argument('--result-cache-age',
+                        default=24,
+                        type=int,
+                        help='hours for which a cached result is reused, defaults to 24')
+    parser.add_argument('--no-progress-bars',
+                        action='store_true',
+                        help='hide the tqdm progress bars of the requests')
+    return parser
+
+
+if __name__ == '__main__':
+    # get environment variables
+    env_name = os.environ.get("FLASK_ENV", default='development')
+    debug_on = bool(os.environ.get("FLASK_DEBUG", default=0))
+
+    import tensorflow as tf
+    # show device placement only in debug mode
+    if debug_on:
+        tf.debugging.set_log_device_placement(True)
+    # allow memory growth for safe running of the program
+    from nima.utils import set_memory_growth
+    set_memory_growth()
 
-    args = parser.parse_args()
+    args = create_parser().parse_args()
 
     # get flask app
-    cur_app = create_app()
+    cur_app = create_app(args)
     # run in the required environment
     cur_app.run(debug=debug_on)
@@ -1,24 +1,77 @@
 from generator import utils
 
 IS_VERBOSE = False
+SCENE_CORRELATIONS_FILE = 'scene_correlations.json'
+# batches queued ahead of the scorer of a clip whose full resolution frames are cached
+CACHE_PIPELINE_BATCHES = 1
 
 
-def get_predictions(state):
+def load_models(config):
+    import nima
+    from generator.base_mode import BASE_MODEL
+
+    # frames of the concurrent requests are scored together by the batchers of the models
+    nima.configure_batching(config['BATCHING_MAX_SIZE'], config['BATCHING_WAIT'] / 1000)
+    # load the models once so that all the requests share them
+    warm_up_time = nima.load_models(BASE_MODEL, [
+        config['TECHNICAL_WEIGHTS_FILE_PATH'],
+        config['AESTHETIC_WEIGHTS_FILE_PATH']
+    ], config['INFERENCE_BACKEND'], config['CALIBRATION_IMAGES_PATH'])
+    if config['NIMA_DUAL_HEAD']:
+        warm_up_time += nima.load_dual_model(
+            BASE_MODEL, config['TECHNICAL_WEIGHTS_FILE_PATH'], config['AESTHETIC_WEIGHTS_FILE_PATH'])
+    return warm_up_time
+
+
+def preload_weights(config):
+    import nima
+
+    weights_files = [config['TECHNICAL_WEIGHTS_FILE_PATH'], config['AESTHETIC_WEIGHTS_FILE_PATH']]
+    nima.preload_weights(weights_files, config['INFERENCE_BACKEND'], config['CALIBRATION_IMAGES_PATH'])
+    # dual model is built from the keras models whatever the backend
+    if config['NIMA_DUAL_HEAD'] and config['INFERENCE_BACKEND'] != nima.KERAS:
+        nima.preload_weights(weights_files)
+
+
+def check_drift(config):
+    import nima
+    from generator.base_mode import BASE_MODEL
+
+    return nima.check_drift(BASE_MODEL, [
+        config['TECHNICAL_WEIGHTS_FILE_PATH'],
+        config['AESTHETIC_WEIGHTS_FILE_PATH']
+    ], config['INFERENCE_BACKEND'], config['CALIBRATION_IMAGES_PATH'])
+
+
+def create_mode(state):
+    if state['mode'] == utils.SUPPORTED_MODES[1]:
+        from generator.scene_detect_mode import SceneDetectMode
+        return SceneDetectMode(state)
+    if state['mode'] == utils.SUPPORTED_MODES[2]:
+        from generator.preview_mode import PreviewMode
+        return PreviewMode(state)
+    from generator.human_eye_mode import HumanEyeMode
+    return HumanEyeMode(state)
+
+
+def init_state(state):
+    # details of the video and the configs used by the modes, the state needs request_uid and temp_images_path
     import math
-    import os
-    import shutil
 
-    import cv2
     from flask import current_app
-    from tqdm import tqdm
 
-    video_cap = cv2.VideoCapture(state['video_file_path'])
-    frames_per_second = video_cap.get(cv2.CAP_PROP_FPS)
-    frame_count = video_cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    import nima
+    from generator.decoders import create_decoder
+    from generator.frame_cache import FrameCache
+
+    decoder = create_decoder(
+        state['video_file_path'], current_app.config['VIDEO_DECODER'], current_app.config['DECODE_THREADS'])
+    frames_per_second = decoder.get_fps()
+    frame_count = decoder.get_frame_count()
     total_time = frame_count / frames_per_second
     clip_time = math.ceil(total_time / (state['total_clips'] * 60))
     total_clips = math.ceil(total_time / (clip_time * 60))
-    video_cap.release()
+    decoder.release()
 
     # update the state object
     state.update({
@@ -28,61 +81,193 @@ def get_predictions(state):
         'clip_time': clip_time,
         'total_clips': total_clips,
         'is_verbose': IS_VERBOSE,
+        'progress_bars': current_app.config['PROGRESS_BARS'],
+        'seed': state.get('seed') or utils.rand_gen(),
+        'keyframe_interval': current_app.config['KEYFRAME_INTERVAL'],
+        'decode_workers': current_app.config['DECODE_WORKERS'],
+        'video_decoder': current_app.config['VIDEO_DECODER'],
+        'decode_threads': current_app.config['DECODE_THREADS'],
+        'pipeline_batches': current_app.config['PIPELINE_BATCHES'],
+        'shared_memory_frames': current_app.config['SHARED_MEMORY_FRAMES'],
+        'sampling_stride': 1,
+        'scene_candidates': current_app.config['SCENE_CANDIDATES'],
+        'scene_candidate_strategy': current_app.config['SCENE_CANDIDATE_STRATEGY'],
+        'in_memory_frames': current_app.config['IN_MEMORY_FRAMES'],
+        'batch_size': nima.resolve_batch_size(current_app.config['NIMA_BATCH_SIZE']),
+        # dual head works on the in-memory frames only
+        'is_dual_head': current_app.config['NIMA_DUAL_HEAD'] and current_app.config['IN_MEMORY_FRAMES'],
+        'prefilter_ratio': current_app.config['PREFILTER_RATIO'],
+        'sampled_frames': [],
+        'frame_cache': None,
         'tag': "[{}]".format(state['request_uid'])
     })
 
+    # full resolution frames kept during extraction, so that predict need not decode them again
+    if current_app.config['FRAME_CACHE_SIZE'] > 0:
+        state['frame_cache'] = FrameCache(current_app.config['FRAME_CACHE_SIZE'] * 1024 * 1024)
+
     # set additional directories
-    request_dirs = ["temps", "extracts", "samples", "swap", "swap_preds", "swap_buffer"]
+    request_dirs = ["temps", "extracts", "samples", "swap"]
     request_dirs = list(map(lambda add_path: '{}/{}'.format(state['temp_images_path'], add_path), request_dirs))
     state['temps_path'], state['extracts_path'] = request_dirs[:2]
-    state['samples_path'], state['swap_path'] = request_dirs[2:4]
-    state['swap_preds'], state['swap_buffer'] = request_dirs[4:]
-    # reset samples and swap directories
-    utils.create_dirs(request_dirs[2:], current_app.logger, state['tag'])
+    state['samples_path'], state['swap_path'] = request_dirs[2:]
+    return state
+
+
+def get_predictions(state):
+    import os
+    import shutil
+    import time
+
+    from flask import current_app
+
+    import metrics
+    from generator import feature_index, streaming
+    from generator.budget import SamplingBudget
+
+    # videos uploaded in chunks are decoded while their later clips are still uploaded
+    if 'upload_size' in state:
+        state['media_range'] = streaming.get_media_range(state['video_file_path'], state['upload_size'])
+        if state['media_range'] is None:
+            streaming.wait_for_bytes(state['video_file_path'], state['upload_size'], state['upload_timeout'],
+                                     "[{}]".format(state['request_uid']), current_app.logger)
+
+    init_state(state)
+
+    # frames of an indexed video are loaded with their scores, so that only the selection runs again
+    indexed_frames = None
+    if state.get('index_path') is not None and os.path.exists(state['index_path']):
+        indexed_frames = feature_index.load_index(state['index_path'])
+        current_app.logger.info("{} Re-ranking {} indexed frames".format(state['tag'], len(indexed_frames)))
+        # every indexed frame is scored, so the scenes need not be prefiltered
+        state['scene_candidates'] = 0
+    elif state.get('index_path') is not None and state.get('time_budget') is None:
+        # frames sampled within a time budget depend on the timings, so they are not indexed
+        state['feature_index'] = feature_index.FeatureIndex()
+    # sampling of the remaining clips is made sparser whenever the request falls behind its time budget
+    sampling_budget = None
+    if state.get('time_budget') is not None and indexed_frames is None:
+        sampling_budget = SamplingBudget(state['time_budget'], state['total_clips'])
+
+    # additional directories of the request
+    request_dirs = [state['temps_path'], state['extracts_path'], state['samples_path'], state['swap_path']]
+    # in-memory frames go straight from the decoder to the scorer, so the directories are not required
+    if state['in_memory_frames']:
+        request_dirs = []
+    else:
+        # reset samples and swap directories
+        utils.create_dirs(request_dirs[2:], current_app.logger, state['tag'])
 
     # manual task assignment in python is making TensorFlow to run on cpu even when gpu is available
     # so implemented sequential requests and removed task scheduling on threads that uses ProcessPoolExecutioner
+    # only decoding of the in-memory frames runs in parallel processes, scoring stays in this process
+    extracted_clips = None
+    if state['in_memory_frames'] and state['decode_workers'] > 1 and indexed_frames is None:
+        from generator.parallel import extract_clips
+        extracted_clips = extract_clips(state)
+    # in-memory frames of a clip are scored in batches while the rest of the clip is decoded
+    # clips cut short by an estimate of their bytes are extracted again, which a pipelined clip cannot do
+    # cached frames of a clip are released as its batches are scored, so the cache keeps the running top frames
+    # instead of the first frames of the clip, hence a cached clip is pipelined even when no batches are set
+    pipeline_batches = state['pipeline_batches'] or (CACHE_PIPELINE_BATCHES if state['frame_cache'] is not None else 0)
+    is_pipelined = pipeline_batches > 0 and state['in_memory_frames'] and extracted_clips is None \
+        and indexed_frames is None and not streaming.is_estimated(state)
     extract_state = None
     sample_state = None
-    for clip_id in range(1, total_clips+1):
+    for clip_id in range(1, state['total_clips']+1):
         # generate clip state
         clip_state = state
         clip_state.update({
             'clip_id': clip_id,
-            'tag': "[{}:{}]".format(state['request_uid'], clip_id)
+            'tag': "[{}:{}]".format(state['request_uid'], clip_id),
+            'sampling_stride': sampling_budget.stride if sampling_budget is not None else 1
         })
 
-        # reset temp and extracts directories
-        utils.create_dirs(request_dirs[:2], current_app.logger, clip_state['tag'])
-        # move swap images from previous iteration to extract for current iteration
-        for file_name in tqdm(
-                os.listdir(state['swap_path']),
-                desc="{} Loading unprocessed frames".format(clip_state['tag'])
-        ):
-            cur_location, new_location = tuple(map(
-                lambda dir_path: '{}/{}'.format(dir_path, file_name),
-                [state['swap_path'], state['extracts_path']])
-            )
-            shutil.move(cur_location, new_location)
-        # reset swap directories
-        utils.create_dirs(request_dirs[3:], current_app.logger, clip_state['tag'])
+        if not state['in_memory_frames']:
+            # reset temp and extracts directories
+            utils.create_dirs(request_dirs[:2], current_app.logger, clip_state['tag'])
+            # move swap images from previous iteration to extract for current iteration
+            moved_bytes = 0
+            for file_name in utils.progress_bar(
+                    os.listdir(state['swap_path']),
+                    desc="{} Loading unprocessed frames".format(clip_state['tag']),
+                    is_shown=state['progress_bars']
+            ):
+                cur_location, new_location = tuple(map(
+                    lambda dir_path: '{}/{}'.format(dir_path, file_name),
+                    [state['swap_path'], state['extracts_path']])
+                )
+                moved_bytes += os.path.getsize(cur_location)
+                shutil.move(cur_location, new_location)
+            metrics.inc('highlights_disk_moved_bytes_total', moved_bytes, folder='extracts')
+            # reset swap directories
+            utils.create_dirs(request_dirs[3:], current_app.logger, clip_state['tag'])
 
         # process the clip
-        mode = state['mode']
-        if mode == utils.SUPPORTED_MODES[1]:
-            from generator.scene_detect_mode import SceneDetectMode
-            mode = SceneDetectMode(clip_state)
+        mode = create_mode(clip_state)
+        extract_seconds = 0
+        if indexed_frames is not None:
+            clip_start_time, _, frames_in_clip = mode.get_clip_details()
+            mode.extracted_frames = feature_index.get_clip_frames(
+                indexed_frames, clip_start_time, frames_in_clip, state['frames_per_second'])
+        elif extracted_clips is not None:
+            wait_start_time = time.perf_counter()
+            mode.extracted_frames, extract_state = next(extracted_clips)
+            # clips are decoded by the workers, so only the wait for the clip holds the request
+            extract_seconds = time.perf_counter() - wait_start_time
+        elif is_pipelined:
+            streaming.wait_for_clip(clip_state, clip_id, current_app.logger)
+        else:
+            streaming.wait_for_clip(clip_state, clip_id, current_app.logger)
+            prev_extract_state = extract_state
+            extract_state = mode.extract(extract_state)
+            # clip cut short by the received bytes is extracted again once the whole video is received
+            if mode.is_cut_short and not streaming.is_clip_received(clip_state):
+                streaming.wait_for_clip(clip_state, logger=current_app.logger)
+                mode = create_mode(clip_state)
+                extract_state = mode.extract(prev_extract_state)
+        sample_start_time = time.perf_counter()
+        if is_pipelined:
+            from generator import pipeline
+            extract_state, sample_state = pipeline.run_clip(mode, extract_state, sample_state, pipeline_batches)
         else:
-            from generator.human_eye_mode import HumanEyeMode
-            mode = HumanEyeMode(clip_state)
-        extract_state = mode.extract(extract_state)
-        sample_state = mode.sample(sample_state)
+            sample_state = mode.sample(sample_state)
+        if state.get('feature_index') is not None:
+            mode.complete_index()
+        if extracted_clips is not None and state['shared_memory_frames']:
+            # shared slots of the clip are recycled on the next clip, so the frames kept beyond it are copied
+            from generator.frame_ring import detach_frames
+            detach_frames(mode.retained_frames(sample_state))
+        if sampling_budget is not None:
+            scoring_seconds = time.perf_counter() - sample_start_time
+            # pipelined clips are scored while they are decoded, so only the time beyond decoding is scoring
+            if is_pipelined:
+                scoring_seconds = max(scoring_seconds - mode.extract_seconds, 0)
+            stride = sampling_budget.update(clip_id, extract_seconds or mode.extract_seconds, scoring_seconds,
+                                            mode.kept_count or len(mode.extracted_frames))
+            current_app.logger.debug("{} Sampling stride of the next clips: {}".format(clip_state['tag'], stride))
+    if extracted_clips is not None:
+        # releases the frames of the last clip and the shared slots of the request
+        extracted_clips.close()
+    if sampling_budget is not None:
+        state['sampling'] = sampling_budget.get_report(state['total_time'])
 
     # get final predictions
+    streaming.wait_for_clip(state, logger=current_app.logger)
     from generator.base_mode import predict
     predictions = predict(state)
+    # index is saved only after every frame is scored by both the models
+    request_index = state.pop('feature_index', None)
+    if request_index is not None and request_index.is_complete():
+        request_index.save(state['index_path'])
+        features_path = os.path.dirname(state['index_path'])
+        feature_index.evict_indexes(features_path, current_app.config['RESULT_CACHE_AGE'] * 60 * 60)
+    # correlations of scene detection are served with the images for tuning the threshold offline
+    if 'scene_correlations' in state:
+        utils.save_json(state['scene_correlations'], "{}/{}".format(state['predicts_path'], SCENE_CORRELATIONS_FILE))
     # delete the directories created in this request
-    for request_dir in tqdm(request_dirs, desc="{} Deleting temp folders".format(state['tag'])):
+    for request_dir in utils.progress_bar(
+            request_dirs, desc="{} Deleting temp folders".format(state['tag']), is_shown=state['progress_bars']):
         shutil.rmtree(request_dir)
     # return final predictions
     return predictions
@@ -1,20 +1,132 @@
+import heapq
+import math
+import os
 import re
 import shutil
+import time
 
 import cv2
 from flask import current_app
-from tqdm import tqdm
 
+import metrics
 import nima
+from generator import utils
+from generator.decoders import create_decoder
+from generator.quality import select_best
 
 BASE_MODEL = 'MobileNet'
+# model types and the configs holding their weights
+TECHNICAL = 'technical'
+AESTHETIC = 'aesthetic'
+# label of the batches scored by both the models at once
+DUAL = 'dual'
+# input size of the models, frames are scaled to it by the decoder unless the full resolution frame is cached
+FRAME_SIZE = (224, 224)
+WEIGHTS_FILE_PATHS = {
+    TECHNICAL: 'TECHNICAL_WEIGHTS_FILE_PATH',
+    AESTHETIC: 'AESTHETIC_WEIGHTS_FILE_PATH'
+}
 
 
 def save_frame(image, dir_path, timestamp, file_extension, resize=False):
     image_name = "{}/frame_{}.{}".format(dir_path, timestamp, file_extension)
-    if resize:
-        image = cv2.resize(image, (224, 224))
+    if resize and image.shape[1::-1] != FRAME_SIZE:
+        image = cv2.resize(image, FRAME_SIZE)
     cv2.imwrite(image_name, image)
+    # bytes written, so that the disk usage of a request is recorded
+    return os.path.getsize(image_name) if os.path.exists(image_name) else 0
+
+
+def create_frame(image, timestamp):
+    # in-memory counterpart of save_frame, so the frame never hits the disk
+    return {
+        'image_id': "frame_{}".format(timestamp),
+        'timestamp': timestamp,
+        'image': image if image.shape[1::-1] == FRAME_SIZE else cv2.resize(image, FRAME_SIZE)
+    }
+
+
+def record_batch(model_type):
+    # latency of every batch scored by the model is recorded in the metrics of the request
+    return lambda seconds: metrics.observe('highlights_cnn_batch_seconds', seconds, model=model_type)
+
+
+def record_queue(model_type):
+    # frames queued ahead of the request and the wait and size of its batches, when batched with other requests
+    def record(queued_count, batches):
+        metrics.observe('highlights_batching_queue_frames', queued_count, model=model_type)
+        for wait_seconds, batch_size in batches:
+            metrics.observe('highlights_batching_wait_seconds', wait_seconds, model=model_type)
+            metrics.observe('highlights_batching_batch_frames', batch_size, model=model_type)
+    return record
+
+
+def score_frames(frames, model_type, batch_size, is_dual_head=False, is_verbose=False):
+    score_key = "{}_score".format(model_type)
+    # scores are cached in the frames, so score only the frames that are not scored by this model yet
+    pending_frames = list(filter(lambda frame: score_key not in frame, frames))
+    if len(pending_frames) == 0:
+        scored_frames = []
+    elif is_dual_head:
+        # dual head scores the frames with both the models at once
+        metrics.inc('highlights_cnn_images_total', len(pending_frames), model=DUAL)
+        scored_frames = nima.score_dual(
+            base_model_name=BASE_MODEL,
+            technical_weights_file=current_app.config[WEIGHTS_FILE_PATHS[TECHNICAL]],
+            aesthetic_weights_file=current_app.config[WEIGHTS_FILE_PATHS[AESTHETIC]],
+            samples=pending_frames,
+            batch_size=batch_size,
+            is_verbose=is_verbose,
+            on_batch=record_batch(DUAL),
+            on_queue=record_queue(DUAL)
+        )
+    else:
+        metrics.inc('highlights_cnn_images_total', len(pending_frames), model=model_type)
+        scored_frames = nima.score_images(
+            base_model_name=BASE_MODEL,
+            weights_file=current_app.config[WEIGHTS_FILE_PATHS[model_type]],
+            samples=pending_frames,
+            batch_size=batch_size,
+            is_verbose=is_verbose,
+            backend=current_app.config['INFERENCE_BACKEND'],
+            on_batch=record_batch(model_type),
+            on_queue=record_queue(model_type)
+        )
+        scored_frames = list(map(
+            lambda frame: dict(frame, **{score_key: frame['mean_score_prediction']}),
+            scored_frames
+        ))
+    scored_frames = {frame['image_id']: frame for frame in scored_frames}
+    frames = map(lambda frame: scored_frames.get(frame['image_id'], frame), frames)
+    return list(map(lambda frame: dict(frame, mean_score_prediction=frame[score_key]), frames))
+
+
+def get_frame_id(timestamp, frames_per_second):
+    # same frame as seeking the capture to the timestamp in milliseconds
+    return int(timestamp * frames_per_second / 1000 + 0.5)
+
+
+def plan_reads(frame_ids, keyframe_interval):
+    # frames to be grabbed before reading each of the sorted frame ids, None when it is faster to seek
+    # a seek decodes from the keyframe preceding the frame, so it pays off only for skips over a keyframe interval
+    read_plan = []
+    next_frame_id = None
+    for frame_id in frame_ids:
+        skip_count = None if next_frame_id is None else frame_id - next_frame_id
+        read_plan.append(skip_count if skip_count is not None and 0 <= skip_count <= keyframe_interval else None)
+        next_frame_id = frame_id + 1
+    return read_plan
+
+
+def read_planned_frame(decoder, frame_id, skip_count):
+    if skip_count is None:
+        decoder.seek_frame(frame_id)
+    else:
+        # grab only decodes the frame, it neither retrieves nor converts it
+        for _ in range(skip_count):
+            if not decoder.grab():
+                return False, None
+    return decoder.read()
 
 
 def append_timestamp(prediction):
@@ -28,26 +140,61 @@ def append_timestamp(prediction):
 
 class BaseMode:
     def __init__(self, state):
+        self.mode = state['mode']
         self.total_clips = state['total_clips']
         self.clip_id = state['clip_id']
         self.tag = state['tag']
         self.video_file_path = state['video_file_path']
+        self.video_decoder = state['video_decoder']
+        self.decode_threads = state['decode_threads']
         self.clip_time = state['clip_time']  # in minutes
         self.prediction_limit = state['images_per_clip']
+        # only every sampling_stride-th frame is kept, so that a request finishes within its time budget
+        self.sampling_stride = state['sampling_stride']
         self.frames_per_second = state['frames_per_second']
         self.frame_count = state['frame_count']
         self.total_time = state['total_time']
         self.image_extension = state['image_extension']
         # swap directories
         self.swap_path = state['swap_path']
-        self.swap_preds = state['swap_preds']
-        self.swap_buffer = state['swap_buffer']
         # other directories
         self.temps_path = state['temps_path']
         self.extracts_path = state['extracts_path']
         self.samples_path = state['samples_path']
+        # in-memory frames
+        self.in_memory_frames = state['in_memory_frames']
+        self.extracted_frames = []
+        self.sampled_frames = state['sampled_frames']
+        # inference params
+        self.batch_size = state['batch_size']
+        self.is_dual_head = state['is_dual_head']
+        self.prefilter_ratio = state['prefilter_ratio']
+        # full resolution frames of the candidates, None when they are read again from the video in predict
+        self.frame_cache = state.get('frame_cache')
+        # cached frames are kept in full resolution, others are decoded straight to the input size of the models
+        self.frame_size = FRAME_SIZE if self.frame_cache is None else None
+        # features of the scored frames, None when the video is not indexed in this request
+        self.feature_index = state.get('feature_index')
         # is_verbose
         self.is_verbose = state['is_verbose']
+        self.progress_callback = state.get('progress_callback')
+        self.progress_bars = state['progress_bars']
+        # counts of the clip recorded once it is extracted, so the decode loops only add to them
+        self.decoded_count = 0
+        self.seek_count = 0
+        self.kept_count = 0
+        self.written_bytes = 0
+        self.extract_seconds = 0
+        # set when the decoder runs out of frames before the end of the clip, as on a partially uploaded video
+        self.is_cut_short = False
+        # batches of the in-memory frames are put on the queue while decoding a pipelined clip
+        self.frame_queue = None
+        self.queued_count = 0
+        # shared slots the decode worker writes the in-memory frames into, None when they are sent back pickled
+        self.frame_ring = None
+        self.ring_slots = None
+        # decode workers run without the flask app, so they send their own logger
+        self.logger = state.get('logger') or current_app.logger
 
     def get_clip_details(self):
         clip_start_time = int((self.clip_id-1) * self.clip_time * 60) + 1
@@ -56,31 +203,160 @@ class BaseMode:
         frames_in_clip = int(self.frames_per_second * (clip_end_time - clip_start_time - 1))
         return clip_start_time, clip_end_time, frames_in_clip
 
+    def max_kept_frames(self, prev_state=None):
+        # upper bound of the frames kept from the clip, so that enough shared slots are reserved for it
+        _, _, frames_in_clip = self.get_clip_details()
+        return math.ceil(frames_in_clip / self.sampling_stride)
+
+    def retained_frames(self, prev_state=None):
+        # frames held beyond the sampling of the clip, along with their images
+        return self.sampled_frames
+
     def save_samples(self, predictions, cur_path, new_path, desc="N/A"):
-        for prediction in tqdm(predictions, desc=desc):
+        moved_bytes = 0
+        for prediction in utils.progress_bar(predictions, desc=desc, is_shown=self.progress_bars):
             cur_location, new_location = tuple(map(
                 lambda dir_path: '{}/{}.{}'.format(dir_path, prediction['image_id'], self.image_extension),
                 [cur_path, new_path]
             ))
+            moved_bytes += os.path.getsize(cur_location)
             shutil.move(cur_location, new_location)
+        metrics.inc('highlights_disk_moved_bytes_total', moved_bytes, folder=os.path.basename(new_path))
 
     def save_tech_samples(self, cur_path, new_path):
+        if self.prefilter_ratio < 1:
+            samples = list(map(lambda file_name: {'image_id': os.path.splitext(file_name)[0]}, os.listdir(cur_path)))
+            kept_samples = self.prefilter_frames(samples, lambda sample: cv2.imread(
+                "{}/{}.{}".format(cur_path, sample['image_id'], self.image_extension)))
+            # frames dropped by the pre-filter can never be samples, so they are not left for the technical model
+            kept_ids = set(map(lambda sample: sample['image_id'], kept_samples))
+            for sample in filter(lambda sample: sample['image_id'] not in kept_ids, samples):
+                os.remove("{}/{}.{}".format(cur_path, sample['image_id'], self.image_extension))
         # get technical predictions
         predictions = nima.score(
             base_model_name=BASE_MODEL,
             image_source=cur_path,
-            swap_pred=self.swap_preds,
-            swap_buffer=self.swap_buffer,
+            batch_size=self.batch_size,
             weights_file=current_app.config['TECHNICAL_WEIGHTS_FILE_PATH'],
-            is_verbose=self.is_verbose
+            is_verbose=self.is_verbose,
+            backend=current_app.config['INFERENCE_BACKEND'],
+            on_batch=record_batch(TECHNICAL),
+            on_queue=record_queue(TECHNICAL)
         )
+        metrics.inc('highlights_cnn_images_total', len(predictions), model=TECHNICAL)
         # get samples
-        predictions = sorted(predictions, key=lambda k: k['mean_score_prediction'], reverse=True)
-        predictions = predictions[:self.prediction_limit]
+        predictions = self.select_top(predictions)
         # save samples
         desc = "{} Moving samples to **{}".format(self.tag, new_path[new_path.rindex("/"):])
         self.save_samples(predictions, cur_path, new_path, desc)
 
+    def save_tech_frames(self, frames):
+        frames = self.prefilter_frames(frames, lambda frame: frame['image'])
+        # get technical predictions
+        predictions = score_frames(frames, TECHNICAL, self.batch_size, self.is_dual_head, self.is_verbose)
+        self.index_frames(predictions)
+        # get samples
+        self.sampled_frames.extend(self.select_top(predictions))
+
+    def prefilter_frames(self, frames, load_image, quality_threshold=None):
+        # sharp and well exposed frames are scored by the technical model, at least as many as the frames sampled
+        # indexed frames need every score and frames scored by the dual head are already scored
+        # batches of a clip are filtered against the frames of the clip so far with the quality_threshold
+        if self.feature_index is not None:
+            return frames
+        scored_frames = list(filter(lambda frame: 'technical_score' in frame, frames))
+        pending_frames = list(filter(lambda frame: 'technical_score' not in frame, frames))
+        if quality_threshold is not None and len(pending_frames) > 0:
+            kept_frames = quality_threshold.select(pending_frames, load_image)
+        else:
+            keep_count = max(self.prediction_limit, math.ceil(len(pending_frames) * self.prefilter_ratio))
+            if len(pending_frames) <= keep_count:
+                return frames
+            kept_frames = select_best(pending_frames, load_image, keep_count)
+        dropped_count = len(pending_frames) - len(kept_frames)
+        if dropped_count == 0:
+            return frames
+        self.discard_frames(pending_frames, kept_frames)
+        # technical model is not run on the dropped frames
+        metrics.inc('highlights_prefiltered_frames_total', dropped_count, model=TECHNICAL)
+        self.logger.debug("{} Pre-filtered {} of {} frames before the technical model".format(
+            self.tag, dropped_count, len(pending_frames)))
+        return scored_frames + kept_frames
+
+    def select_top(self, predictions):
+        top_preds = heapq.nlargest(self.prediction_limit, predictions, key=lambda k: k['mean_score_prediction'])
+        # frames losing here can never be a final prediction, so their full resolution frames are released
+        self.discard_frames(predictions, top_preds)
+        return top_preds
+
+    def discard_frames(self, predictions, kept_preds):
+        if self.frame_cache is not None:
+            kept_ids = set(map(lambda prediction: prediction['image_id'], kept_preds))
+            self.frame_cache.discard(filter(
+                lambda image_id: image_id not in kept_ids,
+                map(lambda prediction: prediction['image_id'], predictions)
+            ))
+
+    def index_frames(self, frames, hists=None):
+        if self.feature_index is not None:
+            self.feature_index.update(frames, hists)
+
+    def complete_index(self):
+        # every frame is scored by both the models, so that any selection can be answered from the index
+        for model_type in [TECHNICAL, AESTHETIC]:
+            score_key = "{}_score".format(model_type)
+            pending_frames = list(filter(
+                lambda frame: not self.feature_index.has_score(frame['image_id'], score_key),
+                self.extracted_frames
+            ))
+            self.index_frames(score_frames(pending_frames, model_type, self.batch_size, self.is_dual_head,
+                                           self.is_verbose))
+        # samples take the scores from the index, so that predict need not score them again
+        self.sampled_frames[:] = list(map(
+            lambda frame: dict(frame, **self.feature_index.get_scores(frame['image_id'])),
+            self.sampled_frames
+        ))
+
+    def report_progress(self, stage, completed=0, total=0):
+        utils.report_progress(self.progress_callback, stage, self.clip_id, self.total_clips, completed, total)
+
+    def keep_frame(self, image, timestamp):
+        self.kept_count += 1
+        if self.frame_cache is not None:
+            self.frame_cache.add("frame_{}".format(timestamp), image)
+        if self.in_memory_frames:
+            frame = create_frame(image, timestamp)
+            slot = next(self.ring_slots, None) if self.frame_ring is not None else None
+            if slot is not None:
+                # the decode worker sends back only the details of the frames written into the shared slots
+                frame['image'] = self.frame_ring.write(slot, frame['image'], timestamp)
+            self.extracted_frames.append(frame)
+            if self.frame_queue is not None:
+                self.queue_frames()
+        else:
+            self.written_bytes += save_frame(image, self.extracts_path, timestamp, self.image_extension, True)
+
+    def queue_frames(self, is_flushed=False):
+        # full batches are queued as they are decoded, the remaining frames only at the end of the clip
+        while len(self.extracted_frames) - self.queued_count >= self.batch_size or \
+                (is_flushed and len(self.extracted_frames) > self.queued_count):
+            batch = self.extracted_frames[self.queued_count:self.queued_count + self.batch_size]
+            self.frame_queue.put(batch)
+            self.queued_count += len(batch)
+
+    def record_extract(self, start_time):
+        self.extract_seconds = time.perf_counter() - start_time
+        metrics.observe('highlights_decode_seconds', self.extract_seconds, mode=self.mode)
+        metrics.inc('highlights_frames_decoded_total', self.decoded_count, mode=self.mode)
+        metrics.inc('highlights_frames_kept_total', self.kept_count, mode=self.mode)
+        metrics.inc('highlights_seeks_total', self.seek_count, mode=self.mode)
+        if self.written_bytes > 0:
+            metrics.inc('highlights_disk_written_bytes_total', self.written_bytes, folder='extracts')
+
+    def plan_extract_state(self, prev_state=None):
+        # termination state of extract without decoding the clip, modes carrying a state over clips override it
+        return prev_state
+
     def extract(self, prev_state=None):
         pass
 
@@ -90,29 +366,73 @@ class BaseMode:
 
 def predict(state):
     # get aesthetic predictions
-    predictions = nima.score(
-        base_model_name=BASE_MODEL,
-        image_source=state['samples_path'],
-        swap_pred=state['swap_preds'],
-        swap_buffer=state['swap_buffer'],
-        weights_file=current_app.config['AESTHETIC_WEIGHTS_FILE_PATH'],
-        is_verbose=state['is_verbose']
-    )
-    # append timestamp to the predictions
-    predictions = list(map(lambda timed_pred: append_timestamp(timed_pred), predictions))
+    if state['in_memory_frames']:
+        predictions = score_frames(
+            state['sampled_frames'], AESTHETIC, state['batch_size'], state['is_dual_head'], state['is_verbose'])
+        # only the prediction fields are retained, so the resized images are released
+        predictions = list(map(lambda timed_pred: append_timestamp(timed_pred), predictions))
+        state['sampled_frames'] = []
+    else:
+        predictions = nima.score(
+            base_model_name=BASE_MODEL,
+            image_source=state['samples_path'],
+            batch_size=state['batch_size'],
+            weights_file=current_app.config['AESTHETIC_WEIGHTS_FILE_PATH'],
+            is_verbose=state['is_verbose'],
+            backend=current_app.config['INFERENCE_BACKEND'],
+            on_batch=record_batch(AESTHETIC),
+            on_queue=record_queue(AESTHETIC)
+        )
+        metrics.inc('highlights_cnn_images_total', len(predictions), model=AESTHETIC)
+        # append timestamp to the predictions
+        predictions = list(map(lambda timed_pred: append_timestamp(timed_pred), predictions))
     # sort the predictions by timestamp
     predictions = sorted(predictions, key=lambda k: k['timestamp'])
 
     # extract original resolution frames
-    video_cap = cv2.VideoCapture(state['video_file_path'])
-    for prediction in tqdm(predictions, desc="{} Saving".format(state['tag'])):
-        video_cap.set(cv2.CAP_PROP_POS_MSEC, prediction['timestamp'])
-        success, image = video_cap.read()
+    frame_cache = state.get('frame_cache')
+    cached_images = {}
+    if frame_cache is not None:
+        cached_images = {
+            prediction['image_id']: frame_cache.get(prediction['image_id'])
+            for prediction in predictions if prediction['image_id'] in frame_cache.frames
+        }
+        current_app.logger.info("{} Retained {} of {} frames, {} were encoded and {} did not fit".format(
+            state['tag'], len(cached_images), len(predictions), frame_cache.encoded_count, frame_cache.missed_count))
+        frame_cache.clear()
+    # frames are read in the order of timestamps, so nearby frames are reached by decoding forward
+    read_preds = list(filter(lambda prediction: prediction['image_id'] not in cached_images, predictions))
+    frame_ids = list(map(
+        lambda prediction: get_frame_id(prediction['timestamp'], state['frames_per_second']),
+        read_preds
+    ))
+    read_plan = dict(zip(
+        map(lambda prediction: prediction['image_id'], read_preds),
+        zip(frame_ids, plan_reads(frame_ids, state['keyframe_interval']))
+    ))
+    save_start_time = time.perf_counter()
+    written_bytes = 0
+    decoder = create_decoder(state['video_file_path'], state['video_decoder'], state['decode_threads']) \
+        if read_preds else None
+    for index, prediction in enumerate(utils.progress_bar(
+            predictions, desc="{} Saving".format(state['tag']), is_shown=state['progress_bars'])):
+        utils.report_progress(
+            state.get('progress_callback'), utils.PROGRESS_STAGES[2], state['total_clips'], state['total_clips'],
+            index, len(predictions)
+        )
+        if prediction['image_id'] in cached_images:
+            success, image = True, cached_images.pop(prediction['image_id'])
+        else:
+            success, image = read_planned_frame(decoder, *read_plan[prediction['image_id']])
         if success:
-            save_frame(image, state['predicts_path'], prediction['timestamp'], state['image_extension'])
+            written_bytes += save_frame(
+                image, state['predicts_path'], prediction['timestamp'], state['image_extension'])
         else:
             current_app.logger.error("{} Unable to read frame at {}ms".format(state['tag'], prediction['timestamp']))
     # release video handles
-    video_cap.release()
+    if decoder is not None:
+        decoder.release()
+    metrics.observe('highlights_save_seconds', time.perf_counter() - save_start_time)
+    metrics.inc('highlights_disk_written_bytes_total', written_bytes, folder='predicts')
     # return predictions
     return predictions
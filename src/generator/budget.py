@@ -0,0 +1,43 @@
+import math
+import time
+
+# fraction of the time budget left for scoring and saving the final frames
+PREDICT_RESERVE = 0.1
+# sparsest sampling, every 16th frame of human_eye or scene_detect is kept
+MAX_STRIDE = 16
+
+
+class SamplingBudget:
+    '''sampling stride of the remaining clips, adapted after every clip to finish the request within its time budget'''
+
+    def __init__(self, time_budget, total_clips):
+        self.time_budget = time_budget
+        self.total_clips = total_clips
+        self.deadline = time.perf_counter() + time_budget * (1 - PREDICT_RESERVE)
+        self.stride = 1
+        self.strides = []
+        self.kept_frames = 0
+
+    def update(self, clip_id, extract_seconds, scoring_seconds, kept_frames):
+        self.strides.append(self.stride)
+        self.kept_frames += kept_frames
+        remaining_clips = self.total_clips - clip_id
+        if remaining_clips == 0:
+            return self.stride
+        clip_budget = (self.deadline - time.perf_counter()) / remaining_clips
+        # decoding takes about the same time at any stride, scoring the kept frames scales with the stride
+        scoring_seconds = scoring_seconds * self.stride
+        if clip_budget <= extract_seconds:
+            stride = MAX_STRIDE
+        else:
+            stride = math.ceil(scoring_seconds / (clip_budget - extract_seconds))
+        self.stride = min(max(stride, 1), MAX_STRIDE)
+        return self.stride
+
+    def get_report(self, total_time):
+        # effective sampling rate is in the kept frames per second of the video
+        return {
+            'timeBudget': self.time_budget,
+            'strides': self.strides,
+            'framesPerSecond': self.kept_frames / total_time if total_time > 0 else 0
+        }
@@ -0,0 +1,171 @@
+import cv2
+
+try:
+    import av
+except ImportError:
+    # pyav is optional, the videos are decoded with opencv without it
+    av = None
+
+# decoder backends
+OPENCV = 'opencv'
+PYAV = 'pyav'
+DECODERS = [OPENCV, PYAV]
+# frames are retrieved in BGR as in opencv, the histograms, the quality, the scorer and the saved frames expect it
+PYAV_FORMAT = 'bgr24'
+
+
+class OpenCVDecoder:
+    '''frames of a video decoded by cv2.VideoCapture, scaled after retrieving them'''
+
+    def __init__(self, video_file_path, threads=0):
+        # threads of the ffmpeg backend are not configurable in opencv
+        self.video_cap = cv2.VideoCapture(video_file_path)
+
+    def get_fps(self):
+        return self.video_cap.get(cv2.CAP_PROP_FPS)
+
+    def get_frame_count(self):
+        return self.video_cap.get(cv2.CAP_PROP_FRAME_COUNT)
+
+    def get_frame_id(self):
+        # index of the next frame to be decoded
+        return int(self.video_cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+    def get_timestamp(self):
+        # in milliseconds, of the last grabbed frame
+        return int(self.video_cap.get(cv2.CAP_PROP_POS_MSEC))
+
+    def skip_nonkey_frames(self):
+        # opencv decodes every frame, so the keyframes are reached by seeking
+        return False
+
+    def seek_msec(self, msec):
+        return self.video_cap.set(cv2.CAP_PROP_POS_MSEC, msec)
+
+    def seek_frame(self, frame_id):
+        return self.video_cap.set(cv2.CAP_PROP_POS_FRAMES, frame_id)
+
+    def grab(self):
+        # grab only demuxes and decodes, it neither retrieves nor converts the frame
+        return self.video_cap.grab()
+
+    def retrieve(self, size=None):
+        success, image = self.video_cap.retrieve()
+        if not success:
+            return False, None
+        if size is not None:
+            image = cv2.resize(image, size)
+        return True, image
+
+    def read(self, size=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(size)
+
+    def release(self):
+        self.video_cap.release()
+
+
+class PyAVDecoder:
+    '''frames of a video decoded by ffmpeg with frame threading, scaled and converted by its scaler in one pass'''
+
+    def __init__(self, video_file_path, threads=0):
+        self.container = av.open(video_file_path)
+        self.stream = self.container.streams.video[0]
+        # frame threading decodes several frames at once, 0 lets ffmpeg pick the threads from the cores
+        self.stream.thread_type = 'AUTO'
+        self.stream.thread_count = threads
+        self.time_base = self.stream.time_base
+        self.start_pts = self.stream.start_time or 0
+        self.frames_per_second = float(self.stream.average_rate) if self.stream.average_rate else 0
+        self.frames = self.container.decode(self.stream)
+        # last grabbed frame and the frame decoded ahead by a seek
+        self.frame = None
+        self.next_frame = None
+
+    def get_fps(self):
+        return self.frames_per_second
+
+    def get_frame_count(self):
+        if self.stream.frames > 0:
+            return self.stream.frames
+        # containers without the frame count in their header are estimated from the duration, as in opencv
+        if self.stream.duration:
+            duration = float(self.stream.duration * self.time_base)
+        else:
+            duration = self.container.duration / av.time_base
+        return int(duration * self.frames_per_second + 0.5)
+
+    def to_frame_id(self, frame):
+        return int(float((frame.pts - self.start_pts) * self.time_base) * self.frames_per_second + 0.5)
+
+    def get_frame_id(self):
+        # index of the next frame to be decoded
+        if self.next_frame is not None:
+            return self.to_frame_id(self.next_frame)
+        return self.to_frame_id(self.frame) + 1 if self.frame is not None else 0
+
+    def get_timestamp(self):
+        # in milliseconds, of the last grabbed frame
+        if self.frame is None:
+            return 0
+        return int(float((self.frame.pts - self.start_pts) * self.time_base) * 1000)
+
+    def skip_nonkey_frames(self):
+        # frames other than the keyframes are dropped by the decoder without decoding them
+        self.stream.codec_context.skip_frame = 'NONKEY'
+        return True
+
+    def seek_pts(self, pts):
+        # ffmpeg seeks to the preceding keyframe, so decode forward till the frame at the pts
+        self.container.seek(int(pts), stream=self.stream, backward=True)
+        self.frames = self.container.decode(self.stream)
+        self.frame = None
+        self.next_frame = None
+        # half a frame of tolerance for the rounding of the timestamps
+        tolerance = 1 / (2 * self.frames_per_second * self.time_base) if self.frames_per_second > 0 else 0
+        for frame in self.frames:
+            if frame.pts is not None and frame.pts >= pts - tolerance:
+                self.next_frame = frame
+                return True
+        return False
+
+    def seek_msec(self, msec):
+        return self.seek_pts(self.start_pts + msec / 1000 / self.time_base)
+
+    def seek_frame(self, frame_id):
+        return self.seek_pts(self.start_pts + frame_id / self.frames_per_second / self.time_base)
+
+    def grab(self):
+        if self.next_frame is not None:
+            self.frame, self.next_frame = self.next_frame, None
+            return True
+        try:
+            self.frame = next(self.frames, None)
+        except av.AVError:
+            self.frame = None
+        return self.frame is not None
+
+    def retrieve(self, size=None):
+        if self.frame is None:
+            return False, None
+        width, height = size if size is not None else (None, None)
+        return True, self.frame.to_ndarray(width=width, height=height, format=PYAV_FORMAT)
+
+    def read(self, size=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(size)
+
+    def release(self):
+        self.container.close()
+
+
+def is_available(decoder):
+    return decoder != PYAV or av is not None
+
+
+def create_decoder(video_file_path, decoder=OPENCV, threads=0):
+    if decoder == PYAV:
+        return PyAVDecoder(video_file_path, threads)
+    return OpenCVDecoder(video_file_path, threads)
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+# cached scores of the frames, same as the score keys of base_mode
+SCORE_KEYS = ['technical_score', 'aesthetic_score']
+INDEX_FILE_EXTENSION = 'npz'
+
+
+class FeatureIndex:
+    '''features of the extracted frames of a request, saved as a structured array so that the video can be re-ranked'''
+
+    def __init__(self):
+        # image id -> features of the frame
+        self.features = {}
+
+    def update(self, frames, hists=None):
+        for index, frame in enumerate(frames):
+            features = self.features.setdefault(frame['image_id'], {'timestamp': frame['timestamp']})
+            features.update({key: frame[key] for key in SCORE_KEYS + ['embedding'] if key in frame})
+            if hists is not None:
+                features['hist'] = hists[index]
+
+    def has_score(self, image_id, score_key):
+        return score_key in self.features.get(image_id, {})
+
+    def get_scores(self, image_id):
+        features = self.features.get(image_id, {})
+        return {key: features[key] for key in SCORE_KEYS + ['embedding'] if key in features}
+
+    def is_complete(self):
+        return all(map(lambda features: all(key in features for key in SCORE_KEYS), self.features.values()))
+
+    def to_array(self):
+        features = sorted(self.features.values(), key=lambda k: k['timestamp'])
+        # histograms and embeddings are kept only when every frame has them
+        sizes = list(map(
+            lambda key: len(features[0][key]) if len(features) > 0 and all(key in k for k in features) else 0,
+            ['hist', 'embedding']
+        ))
+        index_array = np.zeros(len(features), dtype=[
+            ('timestamp', np.int64),
+            ('technical_score', np.float32),
+            ('aesthetic_score', np.float32),
+            # half precision keeps the correlations of the histograms and halves the index
+            ('hist', np.float16, (sizes[0],)),
+            ('embedding', np.float16, (sizes[1],))
+        ])
+        for key in ['timestamp'] + SCORE_KEYS + ['hist', 'embedding']:
+            if len(features) > 0 and index_array.dtype[key].shape != (0,):
+                index_array[key] = np.stack(list(map(lambda k: k[key], features)))
+        return index_array
+
+    def save(self, file_path):
+        # written to a temp file first, so that the other workers never load a partial index
+        temp_file_path = "{}.{}.tmp".format(file_path, os.getpid())
+        with open(temp_file_path, 'wb') as index_file:
+            np.savez_compressed(index_file, features=self.to_array())
+        os.replace(temp_file_path, file_path)
+
+
+def get_index_path(features_path, content_hash, mode, seed, weights_version):
+    # frames depend on the mode and on the seed of the random sampling, selection params are left to re-ranking
+    index_key = hashlib.sha256(json.dumps({
+        'content_hash': content_hash,
+        'mode': mode,
+        'seed': seed,
+        'weights_version': weights_version
+    }, sort_keys=True).encode()).hexdigest()
+    return "{}/{}.{}".format(features_path, index_key, INDEX_FILE_EXTENSION)
+
+
+def load_index(file_path):
+    # frames in the same format as the in-memory frames with their cached scores and without the images
+    with np.load(file_path) as index_file:
+        index_array = index_file['features']
+    frames = []
+    for features in index_array:
+        frame = {
+            'image_id': "frame_{}".format(features['timestamp']),
+            'timestamp': int(features['timestamp']),
+            'technical_score': float(features['technical_score']),
+            'aesthetic_score': float(features['aesthetic_score'])
+        }
+        for key in ['hist', 'embedding']:
+            if index_array.dtype[key].shape != (0,):
+                frame[key] = features[key].astype(np.float32)
+        frames.append(frame)
+    return frames
+
+
+def get_clip_frames(frames, clip_start_time, frames_in_clip, frames_per_second):
+    # frames read by extract of the clip, which starts at the clip start and reads frames_in_clip frames
+    start_timestamp = clip_start_time * 1000
+    end_timestamp = start_timestamp + frames_in_clip * 1000 / frames_per_second
+    return list(filter(lambda frame: start_timestamp <= frame['timestamp'] < end_timestamp, frames))
+
+
+def evict_indexes(features_path, max_age):
+    # temp files are left by the workers that died while saving an index
+    for entry in os.scandir(features_path):
+        if entry.name.endswith((INDEX_FILE_EXTENSION, '.tmp')) and time.time() - entry.stat().st_mtime > max_age:
+            os.remove(entry.path)
@@ -0,0 +1,69 @@
+import threading
+
+import cv2
+
+# fast png compression, the frames are encoded only once and decoded only for the final predictions
+PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+
+class FrameCache:
+    '''full resolution frames of the candidates within a memory budget, raw first and png encoded beyond it'''
+
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        # image id -> (is_encoded, image or png buffer)
+        self.frames = {}
+        self.encoded_count = 0
+        self.missed_count = 0
+        # bytes and count of every png encoded, their mean tells whether another png can fit
+        self.png_bytes = 0
+        self.png_count = 0
+        # frames are added by the decoder thread while the scorer discards them in a pipelined clip
+        self.lock = threading.RLock()
+
+    def add(self, image_id, image):
+        with self.lock:
+            if self.memory_used + image.nbytes <= self.memory_budget:
+                self.store(image_id, False, image)
+                return True
+            # encoding costs as much as decoding the frame again, so it is skipped when a typical png cannot fit
+            if self.png_count > 0 and self.memory_used + self.png_bytes / self.png_count > self.memory_budget:
+                self.missed_count += 1
+                return False
+            # losers of the previous clips are already discarded, so the remaining frames spill as png
+            success, buffer = cv2.imencode('.png', image, PNG_PARAMS)
+            if success:
+                self.png_bytes += buffer.nbytes
+                self.png_count += 1
+            if success and self.memory_used + buffer.nbytes <= self.memory_budget:
+                self.store(image_id, True, buffer)
+                self.encoded_count += 1
+                return True
+            # frames that do not fit are read again from the video
+            self.missed_count += 1
+            return False
+
+    def store(self, image_id, is_encoded, data):
+        with self.lock:
+            self.discard([image_id])
+            self.frames[image_id] = (is_encoded, data)
+            self.memory_used += data.nbytes
+
+    def get(self, image_id):
+        with self.lock:
+            if image_id not in self.frames:
+                return None
+            is_encoded, data = self.frames[image_id]
+            return cv2.imdecode(data, cv2.IMREAD_COLOR) if is_encoded else data
+
+    def discard(self, image_ids):
+        with self.lock:
+            for image_id in image_ids:
+                if image_id in self.frames:
+                    self.memory_used -= self.frames.pop(image_id)[1].nbytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.memory_used = 0
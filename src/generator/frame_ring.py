@@ -0,0 +1,130 @@
+import errno
+import glob
+import os
+import tempfile
+
+import numpy as np
+
+from generator.base_mode import FRAME_SIZE
+
+# slot states, a slot is reserved by the server process, written by a decode worker and released once sampled
+FREE = 0
+WRITING = 1
+READY = 2
+FRAME_SHAPE = FRAME_SIZE[::-1] + (3,)
+FRAME_BYTES = int(np.prod(FRAME_SHAPE))
+# timestamp, state and image of a slot
+SLOT_BYTES = 8 + 1 + FRAME_BYTES
+# tmpfs keeps the ring in memory and allocates only the pages reserved, systems without it use the temp folder
+RING_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+RING_PREFIX = 'highlights-frames'
+
+
+class FrameRing:
+    '''frame slots in a shared memory file, written by the decode workers and read as views by the server process'''
+
+    def __init__(self, path, slots_count=None):
+        # the server process creates the file, the decode workers attach to it by its path
+        if slots_count is not None:
+            with open(path, 'wb') as ring_file:
+                ring_file.truncate(slots_count * SLOT_BYTES)
+                # pages of the timestamps and the states are always written, the images only once reserved
+                allocate(ring_file, 0, slots_count * 9)
+        else:
+            slots_count = os.path.getsize(path) // SLOT_BYTES
+        self.path = path
+        self.slots_count = slots_count
+        # timestamps and states lead the images, so scanning them never touches the pages of the images
+        self.timestamps = np.memmap(path, dtype=np.int64, mode='r+', shape=(slots_count,))
+        self.states = np.memmap(path, dtype=np.uint8, mode='r+', offset=slots_count * 8, shape=(slots_count,))
+        self.images = np.memmap(path, dtype=np.uint8, mode='r+', offset=slots_count * 9,
+                                shape=(slots_count,) + FRAME_SHAPE)
+        # slot the next reservation starts from, so the slots are recycled in turns
+        self.next_slot = 0
+
+    def reserve(self, count):
+        # only the server process reserves, so the decode workers never race for a slot
+        free_slots = np.flatnonzero(np.roll(self.states, -self.next_slot) == FREE)[:count]
+        if count == 0 or len(free_slots) < count:
+            return None
+        slots = ((free_slots + self.next_slot) % self.slots_count).tolist()
+        # a write into a page the full file system cannot allocate kills the worker with a SIGBUS,
+        # so the pages of the slots are allocated here and a full file system fails only the reservation
+        try:
+            with open(self.path, 'r+b') as ring_file:
+                for start, stop in get_runs(slots):
+                    allocate(ring_file, self.slots_count * 9 + start * FRAME_BYTES, (stop - start) * FRAME_BYTES)
+        except OSError:
+            return None
+        self.states[slots] = WRITING
+        self.next_slot = (slots[-1] + 1) % self.slots_count
+        return slots
+
+    def write(self, slot, image, timestamp):
+        self.images[slot] = image
+        self.timestamps[slot] = timestamp
+        # state is set last, so a ready slot always has its whole frame
+        self.states[slot] = READY
+        return self.images[slot]
+
+    def read(self, slot):
+        # view of the frame, valid till the slot is released
+        return self.images[slot] if self.states[slot] == READY else None
+
+    def release(self, slots):
+        self.states[slots] = FREE
+
+    def close(self, is_removed=False):
+        # views still held keep the memory mapped till they are released, the file is removed right away
+        self.timestamps = self.states = self.images = None
+        if is_removed and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def allocate(ring_file, offset, length):
+    # tmpfs allocates the pages or fails with ENOSPC, systems without fallocate check the free space instead
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(ring_file.fileno(), offset, length)
+        return
+    stats = os.statvfs(RING_DIR)
+    if stats.f_bavail * stats.f_frsize < length:
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+
+def get_runs(slots):
+    # (start, stop) of the consecutive slots, the reserved slots wrap around the end of the ring at most once
+    runs = []
+    for slot in slots:
+        if len(runs) > 0 and runs[-1][1] == slot:
+            runs[-1][1] = slot + 1
+        else:
+            runs.append([slot, slot + 1])
+    return runs
+
+
+def is_ring_image(image):
+    return isinstance(image, np.memmap)
+
+
+def detach_frames(frames):
+    # frames kept beyond their clip get their own copy of the image, so their slots can be recycled
+    for frame in frames:
+        if is_ring_image(frame.get('image')):
+            frame['image'] = np.array(frame['image'])
+
+
+def get_ring_path(request_uid):
+    # pid of the server process is in the name, so the rings left by a crashed process are found
+    return "{}/{}-{}-{}".format(RING_DIR, RING_PREFIX, os.getpid(), request_uid)
+
+
+def remove_stale_rings():
+    for path in glob.glob("{}/{}-*".format(RING_DIR, RING_PREFIX)):
+        try:
+            os.kill(int(os.path.basename(path).split('-')[2]), 0)
+        except ProcessLookupError:
+            # another request may have removed it meanwhile
+            if os.path.exists(path):
+                os.remove(path)
+        except (ValueError, IndexError, PermissionError):
+            continue
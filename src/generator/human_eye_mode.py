@@ -1,11 +1,11 @@
 import math
 import random
+import time
 
-import cv2
-from flask import current_app
-from tqdm import tqdm
-
-from generator.base_mode import BaseMode, save_frame
+from generator import utils
+from generator.decoders import create_decoder
+from generator.quality import QualityThreshold
+from generator.base_mode import BaseMode, score_frames, TECHNICAL
 
 # human eye params
 RAND_INT_START = 2/3
@@ -15,6 +15,9 @@ RAND_INT_END = 1
 class HumanEyeMode(BaseMode):
     def __init__(self, state):
         super().__init__(state)
+        # seeded per clip, so the sampled frames are the same for a given seed
+        self.random = random.Random("{}:{}".format(state['seed'], self.clip_id))
+        self.keyframe_interval = state['keyframe_interval']
 
     def get_frame_skip_limit(self):
         end = max(RAND_INT_START, RAND_INT_END)
@@ -25,38 +28,109 @@ class HumanEyeMode(BaseMode):
         start = self.frames_per_second * start
         start = end - math.floor(start)
 
-        random.seed()
-        return random.randint(start, end)
+        return self.random.randint(start, end) * self.sampling_stride
+
+    def plan_frames(self, frames_in_clip, count):
+        # a skip limit is drawn for every frame, so the plan matches reading every frame
+        kept_frame_ids = []
+        for frame_id in range(frames_in_clip):
+            frame_skip_limit = self.get_frame_skip_limit()
+            count += 1
+            if count >= frame_skip_limit:
+                count = 0
+                kept_frame_ids.append(frame_id)
+        return kept_frame_ids, count
+
+    def plan_extract_state(self, prev_state=None):
+        _, _, frames_in_clip = self.get_clip_details()
+        _, end_count = self.plan_frames(frames_in_clip, prev_state if prev_state else 0)
+        return end_count
+
+    def max_kept_frames(self, prev_state=None):
+        # a new instance draws the same skip limits as the one extracting the clip
+        _, _, frames_in_clip = self.get_clip_details()
+        kept_frame_ids, _ = self.plan_frames(frames_in_clip, prev_state if prev_state else 0)
+        return len(kept_frame_ids)
+
+    def skip_frames(self, decoder, start_frame, cur_frame_id, next_frame_id):
+        skip_count = next_frame_id - cur_frame_id
+        if skip_count > self.keyframe_interval:
+            # seeking decodes only from the keyframe preceding the target frame
+            self.seek_count += 1
+            return decoder.seek_frame(start_frame + next_frame_id)
+        # grab only demuxes and decodes, it neither retrieves nor converts the frame
+        for _ in range(skip_count):
+            if not decoder.grab():
+                return False
+            self.decoded_count += 1
+        return True
 
     def extract(self, prev_state=None):
+        start_time = time.perf_counter()
         clip_start_time, _, frames_in_clip = self.get_clip_details()
-        video_cap = cv2.VideoCapture(self.video_file_path)
-        video_cap.set(cv2.CAP_PROP_POS_MSEC, clip_start_time * 1000)
+        decoder = create_decoder(self.video_file_path, self.video_decoder, self.decode_threads)
+        decoder.seek_msec(clip_start_time * 1000)
+        start_frame = decoder.get_frame_id()
 
         # load from previous state if available
         count = prev_state if prev_state else 0
-        with tqdm(total=frames_in_clip, desc="{} Extracting".format(self.tag)) as frame_bar:
-            for frame_id in range(frames_in_clip):
-                success, image = video_cap.read()
-                frame_skip_limit = self.get_frame_skip_limit()
-                count += 1
+        # decide the frames to be kept ahead and decode only them
+        kept_frame_ids, end_count = self.plan_frames(frames_in_clip, count)
+        cur_frame_id = 0
+        with utils.progress_bar(
+                total=frames_in_clip, desc="{} Extracting".format(self.tag), is_shown=self.progress_bars
+        ) as frame_bar:
+            for kept_frame_id in kept_frame_ids:
+                success = self.skip_frames(decoder, start_frame, cur_frame_id, kept_frame_id)
+                success = success and decoder.grab()
+                if success:
+                    self.decoded_count += 1
+                    success, image = decoder.retrieve(self.frame_size)
 
                 if success:
-                    frame_bar.update(1)
-                    if count >= frame_skip_limit:
-                        count = 0
-                        timestamp = int(video_cap.get(cv2.CAP_PROP_POS_MSEC))
-                        save_frame(image, self.extracts_path, timestamp, self.image_extension, True)
+                    frame_bar.update(kept_frame_id + 1 - cur_frame_id)
+                    self.report_progress(utils.PROGRESS_STAGES[0], kept_frame_id + 1, frames_in_clip)
+                    timestamp = decoder.get_timestamp()
+                    self.keep_frame(image, timestamp)
+                    cur_frame_id = kept_frame_id + 1
                 else:
-                    pending_frames = frames_in_clip - frame_id
-                    current_app.logger.error("{} Unable to read {} frames".format(self.tag, pending_frames-1))
+                    # skipped frames are not retrieved, so the failure is attributed to the frames after the last kept frame
+                    pending_frames = frames_in_clip - cur_frame_id
+                    self.logger.error("{} Unable to read {} frames".format(self.tag, pending_frames-1))
+                    self.is_cut_short = True
                     frame_bar.update(pending_frames)
+                    # count the frames till the failed one, same as reading every frame would have
+                    end_count = kept_frame_id - cur_frame_id + 1 if cur_frame_id > 0 else count + kept_frame_id + 1
                     break
+            else:
+                frame_bar.update(frames_in_clip - cur_frame_id)
         # release video handles and delete it with the containing folder
-        video_cap.release()
+        decoder.release()
+        self.record_extract(start_time)
         # count contains the termination state of this operation, so return it
-        return count
+        return end_count
 
     def sample(self, prev_state=None):
-        self.save_tech_samples(self.extracts_path, self.samples_path)
+        self.report_progress(utils.PROGRESS_STAGES[1])
+        if self.in_memory_frames:
+            self.save_tech_frames(self.extracted_frames)
+        else:
+            self.save_tech_samples(self.extracts_path, self.samples_path)
+        return prev_state
+
+    def sample_batches(self, batches, prev_state=None):
+        # batches are scored as they arrive, the running top frames give the same samples as scoring the whole clip
+        # pre-filter keeps the same share of the clip, though not the same frames, as it sees only the frames so far
+        self.report_progress(utils.PROGRESS_STAGES[1])
+        top_preds = []
+        # ratio of the pre-filter applies to the whole clip, not to every batch
+        quality_threshold = None
+        if self.prefilter_ratio < 1:
+            quality_threshold = QualityThreshold(self.prefilter_ratio, self.prediction_limit)
+        for batch in batches:
+            batch = self.prefilter_frames(batch, lambda frame: frame['image'], quality_threshold)
+            predictions = score_frames(batch, TECHNICAL, self.batch_size, self.is_dual_head, self.is_verbose)
+            self.index_frames(predictions)
+            top_preds = self.select_top(top_preds + predictions)
+        self.sampled_frames.extend(top_preds)
         return prev_state
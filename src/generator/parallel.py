@@ -0,0 +1,158 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from generator import create_mode, streaming
+from generator.frame_ring import FrameRing, get_ring_path, is_ring_image, remove_stale_rings
+
+# clips decoded ahead of the clip being sampled per worker, bounds the frames held in memory
+CLIPS_AHEAD_PER_WORKER = 1
+# state values that are either not picklable or not required for decoding
+# full resolution frames are not sent back from the workers, predict reads them from the video
+UNSHARED_STATE_KEYS = ['progress_callback', 'sampled_frames', 'scene_correlations', 'logger', 'frame_cache',
+                       'feature_index']
+
+# decode workers are reused across the requests as spawning them imports opencv and tensorflow again
+_EXECUTOR = None
+_EXECUTOR_WORKERS = 0
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor(max_workers, broken_executor=None):
+    global _EXECUTOR, _EXECUTOR_WORKERS
+    with _EXECUTOR_LOCK:
+        # a worker that died, as on a segfault of the decoder, breaks the pool for every later clip,
+        # so the broken pool is replaced unless a concurrent request has already replaced it
+        if _EXECUTOR is None or _EXECUTOR_WORKERS != max_workers or _EXECUTOR is broken_executor:
+            if _EXECUTOR is not None:
+                _EXECUTOR.shutdown(wait=False)
+            # forking a process with initialized tensorflow is not safe, so spawn the workers
+            _EXECUTOR = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'))
+            _EXECUTOR_WORKERS = max_workers
+        return _EXECUTOR
+
+
+def get_clip_state(state, clip_id):
+    clip_state = {key: value for key, value in state.items() if key not in UNSHARED_STATE_KEYS}
+    clip_state.update({
+        'clip_id': clip_id,
+        'tag': "[{}:{}]".format(state['request_uid'], clip_id)
+    })
+    return clip_state
+
+
+def extract_clip(clip_state, extract_state, ring_path=None, slots=None):
+    # runs in the decode workers, so the frames and the metrics are returned instead of being kept in the state
+    clip_state = dict(clip_state, sampled_frames=[], logger=logging.getLogger(__name__))
+    metrics.start_request()
+    mode = create_mode(clip_state)
+    if slots is not None:
+        mode.frame_ring, mode.ring_slots = FrameRing(ring_path), iter(slots)
+    extract_state = mode.extract(extract_state)
+    # images written into the shared slots are not pickled, frames beyond the slots are sent back with their images
+    extracted_frames = list(map(
+        lambda frame: dict(frame, image=None) if is_ring_image(frame['image']) else frame, mode.extracted_frames))
+    return extracted_frames, extract_state, metrics.stop_request(), mode.is_cut_short
+
+
+def submit_clip(executor, max_workers, *args):
+    # returns the future along with the executor running it, a broken pool is replaced and the clip submitted again
+    try:
+        return executor, executor.submit(extract_clip, *args)
+    except BrokenProcessPool:
+        executor = get_executor(max_workers, executor)
+        return executor, executor.submit(extract_clip, *args)
+
+
+def create_ring(state, max_pending):
+    # slots for the frames of every pending clip, the pages of the images are allocated only as they are reserved
+    remove_stale_rings()
+    mode = create_mode(dict(state, **get_clip_state(state, 1)))
+    _, _, frames_in_clip = mode.get_clip_details()
+    ring_path = get_ring_path(state['request_uid'])
+    try:
+        return FrameRing(ring_path, max_pending * frames_in_clip)
+    except OSError as ex:
+        logging.getLogger(__name__).warning("{} Frames are pickled, unable to create the frame ring: {}".format(
+            state['tag'], ex))
+        if os.path.exists(ring_path):
+            os.remove(ring_path)
+        return None
+
+
+def reserve_slots(frame_ring, mode, planned_state):
+    # clips without room in the ring send their frames pickled
+    return frame_ring.reserve(mode.max_kept_frames(planned_state))
+
+
+def extract_clips(state):
+    # yields (extracted frames, extract state) of every clip in order, same as extracting them sequentially
+    # frames of the clip yielded last are released on the next clip, so the caller detaches the frames it keeps
+    executor = get_executor(state['decode_workers'])
+    max_pending = state['decode_workers'] * CLIPS_AHEAD_PER_WORKER
+    frame_ring = create_ring(state, max_pending) if state['shared_memory_frames'] else None
+
+    # carry-over of extract is planned without decoding, so every clip can start with its state
+    pending_clips = deque()
+    planned_state = None
+    next_clip_id = 1
+    extract_state = None
+    try:
+        while True:
+            while next_clip_id <= state['total_clips'] and len(pending_clips) < max_pending:
+                clip_state = get_clip_state(state, next_clip_id)
+                # clips yet to be uploaded are waited for only when there is no decoded clip to hand over
+                if len(pending_clips) > 0 and not streaming.is_clip_received(clip_state, next_clip_id):
+                    break
+                streaming.wait_for_clip(clip_state, next_clip_id)
+                slots = None
+                if frame_ring is not None:
+                    slots = reserve_slots(frame_ring, create_mode(dict(state, **clip_state)), planned_state)
+                clip_args = (clip_state, planned_state, frame_ring.path if slots else None, slots)
+                executor, future = submit_clip(executor, state['decode_workers'], *clip_args)
+                pending_clips.append((clip_args, executor, future))
+                planned_state = create_mode(dict(state, **clip_state)).plan_extract_state(planned_state)
+                next_clip_id += 1
+            if len(pending_clips) == 0:
+                return
+
+            clip_args, clip_executor, future = pending_clips.popleft()
+            clip_state, clip_planned_state, _, slots = clip_args
+            try:
+                extracted_frames, next_state, clip_metrics, is_cut_short = future.result()
+            except BrokenProcessPool:
+                # pending clips of a dead worker fail with it, so each of them is decoded again in a new pool,
+                # a clip that breaks the new pool as well fails the request
+                logging.getLogger(__name__).warning(
+                    "{} Decode worker died, extracting the clip again".format(clip_state['tag']))
+                executor = get_executor(state['decode_workers'], clip_executor)
+                extracted_frames, next_state, clip_metrics, is_cut_short = \
+                    executor.submit(extract_clip, *clip_args).result()
+            metrics.merge(clip_metrics)
+            if slots is not None:
+                # frames the worker wrote are read as views of their slots, they are never copied
+                for frame, slot in zip(extracted_frames, slots):
+                    if frame['image'] is None:
+                        frame['image'] = frame_ring.read(slot)
+            # clip cut short by the received bytes is extracted again once the whole video is received
+            is_cut_short = is_cut_short and not streaming.is_clip_received(clip_state)
+            if is_cut_short:
+                streaming.wait_for_clip(clip_state)
+            # a failed read changes the carry-over, so extract the clip again with the actual state
+            if clip_planned_state != extract_state or is_cut_short:
+                mode = create_mode(dict(state, **clip_state))
+                next_state = mode.extract(extract_state)
+                extracted_frames = mode.extracted_frames
+            extract_state = next_state
+            yield extracted_frames, extract_state
+            if slots is not None:
+                frame_ring.release(slots)
+    finally:
+        # the ring is removed even when the request fails, the rings of a crashed process on the next request
+        if frame_ring is not None:
+            frame_ring.close(is_removed=True)
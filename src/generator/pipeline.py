@@ -0,0 +1,72 @@
+import queue
+import threading
+
+import metrics
+
+# seconds a blocked put waits before checking whether the scorer has stopped
+PUT_INTERVAL = 0.5
+
+
+class FrameQueue:
+    '''bounded queue of the frame batches from the decoder thread to the scorer, put blocks while it is full'''
+
+    def __init__(self, max_batches):
+        self.queue = queue.Queue(max_batches)
+        self.is_closed = False
+
+    def put(self, batch):
+        while True:
+            # scorer that stopped never takes the batch, so the decoder stops with it
+            if self.is_closed:
+                raise RuntimeError("Frame queue is closed")
+            try:
+                self.queue.put(batch, timeout=PUT_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self):
+        # end of the clip, put even when the queue is closed so that the scorer never waits for it
+        try:
+            self.put(None)
+        except RuntimeError:
+            pass
+
+    def close(self):
+        self.is_closed = True
+
+    def __iter__(self):
+        return iter(self.queue.get, None)
+
+
+def run_clip(mode, extract_state, sample_state, max_batches):
+    # the clip is decoded in a thread while its decoded batches are scored in this thread,
+    # decoding waits on the bounded queue whenever scoring falls behind
+    frame_queue = FrameQueue(max_batches)
+    mode.frame_queue = frame_queue
+    decode_result = {}
+
+    def decode():
+        # metrics of the thread are merged once it ends, as the request metrics are kept per thread
+        decode_result['metrics'] = metrics.start_request()
+        try:
+            decode_result['extract_state'] = mode.extract(extract_state)
+            mode.queue_frames(is_flushed=True)
+        except Exception as ex:
+            decode_result['error'] = ex
+        finally:
+            metrics.stop_request()
+            frame_queue.finish()
+
+    decoder = threading.Thread(target=decode, daemon=True)
+    decoder.start()
+    try:
+        sample_state = mode.sample_batches(frame_queue, sample_state)
+    finally:
+        frame_queue.close()
+        decoder.join()
+        mode.frame_queue = None
+        metrics.merge(decode_result['metrics'])
+    if 'error' in decode_result:
+        raise decode_result['error']
+    return decode_result['extract_state'], sample_state
@@ -0,0 +1,56 @@
+import time
+
+from generator import utils
+from generator.base_mode import BaseMode, get_frame_id
+from generator.decoders import PYAV, create_decoder
+from generator.human_eye_mode import HumanEyeMode
+
+
+class PreviewMode(HumanEyeMode):
+    '''decodes only the keyframes of every clip and samples them as human_eye does, for a quick first pass'''
+
+    def plan_extract_state(self, prev_state=None):
+        # keyframes do not depend on the previous clips
+        return prev_state
+
+    def max_kept_frames(self, prev_state=None):
+        # keyframes are not known ahead, so any frame of the clip may be kept
+        return BaseMode.max_kept_frames(self, prev_state)
+
+    def extract(self, prev_state=None):
+        start_time = time.perf_counter()
+        clip_start_time, _, frames_in_clip = self.get_clip_details()
+        # only pyav skips the frames other than the keyframes, opencv decodes from a keyframe to the frame sought
+        decoder = create_decoder(self.video_file_path, PYAV, self.decode_threads)
+        start_frame = get_frame_id(clip_start_time * 1000, self.frames_per_second)
+        # keyframes are read one after the other as the decoder drops the other frames
+        decoder.skip_nonkey_frames()
+        decoder.seek_frame(start_frame)
+
+        # frames of the clip covered by the progress bar
+        cur_frame_id = 0
+        with utils.progress_bar(
+                total=frames_in_clip, desc="{} Extracting keyframes".format(self.tag), is_shown=self.progress_bars
+        ) as frame_bar:
+            while True:
+                if not decoder.grab():
+                    self.is_cut_short = True
+                    break
+                frame_id = decoder.get_frame_id() - 1 - start_frame
+                if frame_id >= frames_in_clip:
+                    break
+                self.decoded_count += 1
+                success, image = decoder.retrieve(self.frame_size)
+                if not success:
+                    self.logger.error("{} Unable to read the keyframe at {}ms".format(
+                        self.tag, decoder.get_timestamp()))
+                    self.is_cut_short = True
+                    break
+                self.keep_frame(image, decoder.get_timestamp())
+                frame_bar.update(max(frame_id + 1 - cur_frame_id, 0))
+                self.report_progress(utils.PROGRESS_STAGES[0], frame_id + 1, frames_in_clip)
+                cur_frame_id = max(frame_id + 1, cur_frame_id)
+            frame_bar.update(frames_in_clip - cur_frame_id)
+        decoder.release()
+        self.record_extract(start_time)
+        return prev_state
@@ -0,0 +1,76 @@
+import math
+
+import cv2
+import numpy as np
+
+# gray levels below which a pixel is crushed and above which it is blown out
+DARK_LEVEL = 16
+BRIGHT_LEVEL = 239
+# frames whose quality is calculated at once, bounds the memory of the stacked images
+QUALITY_BATCH_SIZE = 256
+
+
+def to_gray(images):
+    # a stack of images converts in a single call when seen as one tall image
+    images_count, height, width = images.shape[:3]
+    images = cv2.cvtColor(images.reshape(images_count * height, width, 3), cv2.COLOR_BGR2GRAY)
+    return images.reshape(images_count, height, width)
+
+
+def calc_sharpness(images):
+    # variance of laplacian of a stack of BGR images, blurred frames have lower values
+    images_count, height, width = images.shape[:3]
+    gray_images = to_gray(images).reshape(images_count * height, width)
+    laplacians = cv2.Laplacian(gray_images, cv2.CV_32F).reshape(images_count, height, width)
+    # border rows see the neighbouring images in the tall image, so leave them out
+    return laplacians[:, 1:-1, :].reshape(images_count, -1).var(axis=1)
+
+
+def calc_exposure(images):
+    # fraction of the pixels of a stack of BGR images that are neither crushed to black nor blown out to white
+    gray_images = to_gray(images).reshape(len(images), -1)
+    return ((gray_images >= DARK_LEVEL) & (gray_images <= BRIGHT_LEVEL)).mean(axis=1)
+
+
+def calc_quality(images):
+    # blurred, dark and blown-out frames get the lowest values
+    return calc_sharpness(images) * calc_exposure(images)
+
+
+def calc_frame_qualities(frames, load_image):
+    # images are loaded one batch at a time
+    return np.concatenate(list(map(
+        lambda start: calc_quality(np.stack(list(map(load_image, frames[start:start + QUALITY_BATCH_SIZE])))),
+        range(0, len(frames), QUALITY_BATCH_SIZE)
+    )))
+
+
+def select_best(frames, load_image, count):
+    # frames of the highest quality in the order they are given
+    qualities = calc_frame_qualities(frames, load_image)
+    indexes = np.sort(np.argsort(-qualities, kind='stable')[:count])
+    return list(map(lambda index: frames[index], indexes))
+
+
+class QualityThreshold:
+    '''qualities of the frames of a clip seen so far, so that the batches of a clip keep the ratio of the clip'''
+
+    def __init__(self, ratio, min_count):
+        self.ratio = ratio
+        self.min_count = min_count
+        self.qualities = np.empty(0)
+        self.kept_count = 0
+
+    def select(self, frames, load_image):
+        # frames below the quality of the last frame kept from the clip so far are dropped,
+        # and the frames kept never exceed the ratio of the frames seen, at least min_count of them
+        qualities = calc_frame_qualities(frames, load_image)
+        self.qualities = np.concatenate([self.qualities, qualities])
+        target_count = min(max(self.min_count, math.ceil(len(self.qualities) * self.ratio)), len(self.qualities))
+        if target_count == 0:
+            return []
+        threshold = -np.partition(-self.qualities, target_count - 1)[target_count - 1]
+        indexes = np.flatnonzero(qualities >= threshold)
+        indexes = indexes[np.argsort(-qualities[indexes], kind='stable')[:max(target_count - self.kept_count, 0)]]
+        self.kept_count += len(indexes)
+        return list(map(lambda index: frames[index], np.sort(indexes)))
@@ -1,9 +1,16 @@
+import time
+
 import cv2
+import numpy as np
 from flask import current_app
-from tqdm import tqdm
 
+import metrics
 import nima
-from generator.base_mode import BaseMode, append_timestamp, save_frame, BASE_MODEL
+from generator import utils
+from generator.decoders import create_decoder
+from generator.quality import calc_sharpness
+from generator.base_mode import BaseMode, append_timestamp, record_batch, record_queue, score_frames, AESTHETIC, \
+    BASE_MODEL
 
 # consts related to histogram calculations
 # Use the 0-th and 1-st channels
@@ -18,6 +25,10 @@ S_RANGES = [0, 256]
 RANGES = H_RANGES + S_RANGES  # concat lists
 # threshold ratio for scene change detection
 THRESHOLD = 0.90
+# frames converted at once while calculating histograms, bounds the memory of the stacked frames
+HIST_BATCH_SIZE = 256
+# ways of picking the candidates of a scene that are scored when scenes are detected before scoring
+CANDIDATE_STRATEGIES = ['even', 'sharpness']
 
 
 def is_scene_detected(hist, base_hist):
@@ -27,79 +38,254 @@ def is_scene_detected(hist, base_hist):
     return comp_value < THRESHOLD
 
 
+def calc_hists(images):
+    # flattened H-S histograms of a stack of same sized BGR images, same as calcHist followed by min-max normalize
+    images_count, height, width = images.shape[:3]
+    # a stack of images converts in a single call when seen as one tall image
+    images = cv2.cvtColor(images.reshape(images_count * height, width, 3), cv2.COLOR_BGR2HSV)
+    images = images.reshape(images_count, height * width, 3).astype(np.int32)
+    h_bins = (images[..., CHANNELS[0]] - H_RANGES[0]) * H_BINS // (H_RANGES[1] - H_RANGES[0])
+    s_bins = (images[..., CHANNELS[1]] - S_RANGES[0]) * S_BINS // (S_RANGES[1] - S_RANGES[0])
+    # offset the bins of every image, so that one bincount counts all the histograms
+    bins = h_bins * S_BINS + s_bins + np.arange(images_count)[:, np.newaxis] * H_BINS * S_BINS
+    hists = np.bincount(bins.ravel(), minlength=images_count * H_BINS * S_BINS)
+    hists = hists.reshape(images_count, H_BINS * S_BINS).astype(np.float32)
+
+    # min-max normalize to [0, 1], a flat histogram normalizes to 0 as in opencv
+    hist_mins = hists.min(axis=1, keepdims=True)
+    hist_ranges = hists.max(axis=1, keepdims=True) - hist_mins
+    return np.divide(hists - hist_mins, hist_ranges, out=np.zeros_like(hists), where=hist_ranges > 0)
+
+
+def calc_correlations(hists, base_hist):
+    # pearson correlation of every histogram with the base, same as compareHist with HISTCMP_CORREL
+    hists = hists - hists.mean(axis=1, keepdims=True)
+    base_hist = base_hist - base_hist.mean()
+    denominators = np.sqrt((hists ** 2).sum(axis=1) * (base_hist ** 2).sum())
+    correlations = hists.dot(base_hist)
+    return np.divide(correlations, denominators, out=np.ones_like(correlations), where=denominators > 0)
+
+
+def detect_scenes(hists, base_hist, threshold=THRESHOLD):
+    # scene changes of consecutive histograms, base is replaced by the histogram where a scene is detected
+    # returns the scene change flags, correlations with the base in use (nan for the first base) and the last base
+    scene_changes = np.zeros(len(hists), dtype=bool)
+    correlations = np.full(len(hists), np.nan)
+    start = 0
+    if base_hist is None and len(hists) > 0:
+        base_hist, start = hists[0], 1
+    while start < len(hists):
+        correlations[start:] = calc_correlations(hists[start:], base_hist)
+        changes = np.flatnonzero(correlations[start:] < threshold)
+        if len(changes) == 0:
+            break
+        start += changes[0]
+        scene_changes[start] = True
+        base_hist, start = hists[start], start + 1
+    return scene_changes, correlations, base_hist
+
+
 class SceneDetectMode(BaseMode):
     def __init__(self, state):
         super().__init__(state)
+        # correlations with the scene base are kept for tuning the threshold offline
+        self.scene_correlations = state.setdefault('scene_correlations', [])
+        # frames scored per scene, every frame is scored when it is 0
+        # sparser sampling of a time budget also scores fewer candidates of every scene
+        self.scene_candidates = state['scene_candidates']
+        if self.scene_candidates > 0:
+            self.scene_candidates = max(self.scene_candidates // self.sampling_stride, 1)
+        self.scene_candidate_strategy = state['scene_candidate_strategy']
+        self.threshold = state.get('scene_threshold') or THRESHOLD
+        # scenes are detected before scoring only with in-memory frames
+        self.is_prefiltered = self.in_memory_frames and self.scene_candidates > 0
 
     def extract(self, prev_state=None):
+        start_time = time.perf_counter()
         clip_start_time, _, frames_in_clip = self.get_clip_details()
-        video_cap = cv2.VideoCapture(self.video_file_path)
-        video_cap.set(cv2.CAP_PROP_POS_MSEC, clip_start_time * 1000)
+        decoder = create_decoder(self.video_file_path, self.video_decoder, self.decode_threads)
+        decoder.seek_msec(clip_start_time * 1000)
 
-        with tqdm(total=frames_in_clip, desc="{} Extracting".format(self.tag)) as frame_bar:
+        with utils.progress_bar(
+                total=frames_in_clip, desc="{} Extracting".format(self.tag), is_shown=self.progress_bars
+        ) as frame_bar:
             for frame_id in range(frames_in_clip):
-                success, image = video_cap.read()
+                # frames between the sampled frames are only grabbed, they are neither retrieved nor converted
+                if frame_id % self.sampling_stride == 0:
+                    success, image = decoder.read(self.frame_size)
+                else:
+                    success, image = decoder.grab(), None
 
                 if success:
+                    self.decoded_count += 1
                     frame_bar.update(1)
-                    timestamp = int(video_cap.get(cv2.CAP_PROP_POS_MSEC))
-                    save_frame(image, self.extracts_path, timestamp, self.image_extension, True)
+                    self.report_progress(utils.PROGRESS_STAGES[0], frame_id + 1, frames_in_clip)
+                    if image is not None:
+                        timestamp = decoder.get_timestamp()
+                        self.keep_frame(image, timestamp)
                 else:
                     pending_frames = frames_in_clip - frame_id
-                    current_app.logger.error("{} Unable to read {} frames".format(self.tag, pending_frames - 1))
+                    self.logger.error("{} Unable to read {} frames".format(self.tag, pending_frames - 1))
+                    self.is_cut_short = True
                     frame_bar.update(pending_frames)
                     break
         # release video handles and delete it with the containing folder
-        video_cap.release()
+        decoder.release()
+        self.record_extract(start_time)
         return prev_state
 
-    def sample(self, prev_state=None):
-        # get aesthetic predictions
-        predictions = nima.score(
-            base_model_name=BASE_MODEL,
-            image_source=self.extracts_path,
-            swap_pred=self.swap_preds,
-            swap_buffer=self.swap_buffer,
-            weights_file=current_app.config['AESTHETIC_WEIGHTS_FILE_PATH'],
-            is_verbose=self.is_verbose
+    def retained_frames(self, prev_state=None):
+        # frames of the unfinished scene are carried over to the next clip
+        return self.sampled_frames + (prev_state[1] if prev_state else [])
+
+    def load_frame(self, prediction):
+        if self.in_memory_frames:
+            return prediction['image']
+        return cv2.imread('{}/{}.{}'.format(self.extracts_path, prediction['image_id'], self.image_extension))
+
+    def calc_hists(self, predictions):
+        # frames loaded from the feature index come with their histograms
+        if len(predictions) > 0 and all('hist' in prediction for prediction in predictions):
+            return np.stack(list(map(lambda prediction: prediction['hist'], predictions)))
+        hists = []
+        for start in utils.progress_bar(range(0, len(predictions), HIST_BATCH_SIZE),
+                                        desc="{} Histograms".format(self.tag), is_shown=self.progress_bars):
+            images = np.stack(list(map(self.load_frame, predictions[start:start + HIST_BATCH_SIZE])))
+            hists.append(calc_hists(images))
+        return np.concatenate(hists) if len(hists) > 0 else np.empty((0, H_BINS * S_BINS), dtype=np.float32)
+
+    def calc_sharpness(self, predictions):
+        sharpness = []
+        for start in range(0, len(predictions), HIST_BATCH_SIZE):
+            images = np.stack(list(map(self.load_frame, predictions[start:start + HIST_BATCH_SIZE])))
+            sharpness.append(calc_sharpness(images))
+        return np.concatenate(sharpness)
+
+    def select_candidates(self, scene):
+        if len(scene) <= self.scene_candidates:
+            return scene
+        if self.scene_candidate_strategy == CANDIDATE_STRATEGIES[1]:
+            # sharpest frames in the order of their timestamps
+            indexes = np.sort(np.argsort(-self.calc_sharpness(scene), kind='stable')[:self.scene_candidates])
+        else:
+            # evenly spaced frames including the first and the last
+            indexes = np.unique(np.linspace(0, len(scene) - 1, self.scene_candidates).round().astype(int))
+        return list(map(lambda index: scene[index], indexes))
+
+    def score_candidates(self, scenes):
+        # only the candidates of every scene are scored, so the other frames are dropped from the scenes
+        candidates = list(map(self.select_candidates, scenes))
+        scored_candidates = score_frames(
+            [candidate for scene in candidates for candidate in scene],
+            AESTHETIC, self.batch_size, self.is_dual_head, self.is_verbose
         )
+        self.index_frames(scored_candidates)
+        scored_candidates = iter(scored_candidates)
+        return list(map(lambda scene: [next(scored_candidates) for _ in scene], candidates))
+
+    def score_batch(self, predictions):
+        # candidates of the scenes are scored after detecting the scenes, so that every frame need not be scored
+        if not self.is_prefiltered:
+            predictions = score_frames(predictions, AESTHETIC, self.batch_size, self.is_dual_head, self.is_verbose)
         # sort them in increasing timestamp for detecting scene change
-        predictions = list(map(lambda timed_pred: append_timestamp(timed_pred), predictions))
-        predictions = sorted(predictions, key=lambda k: k['timestamp'])
+        return sorted(predictions, key=lambda k: k['timestamp'])
 
+    def select_scenes(self, predictions, prev_state=None, is_last=True):
+        # best frames of the scenes completed by the predictions, the unfinished scene is carried over in the state
         # load from previous state if available
         base_hist, cur_preds = prev_state if prev_state else (None, [])
-        # get best predictions in each scene
-        best_preds = []
-        for index, aest_pred in enumerate(tqdm(predictions, desc="{} Extracting".format(self.tag))):
-            cur_image = cv2.imread('{}/{}.{}'.format(self.extracts_path, aest_pred['image_id'], self.image_extension))
-            cur_image = cv2.cvtColor(cur_image, cv2.COLOR_BGR2HSV)
-            cur_hist = cv2.calcHist([cur_image], CHANNELS, None, HIST_SIZE, RANGES, accumulate=False)
-            cv2.normalize(cur_hist, cur_hist, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
-
-            # obtain and compare histograms
+        # obtain and compare histograms of all the frames at once
+        hists = self.calc_hists(predictions)
+        self.index_frames(predictions, hists)
+        scene_changes, correlations, base_hist = detect_scenes(hists, base_hist, self.threshold)
+        # first frame has no base, it is saved as null since json has no nan
+        self.scene_correlations.extend(map(
+            lambda pred, correlation: {
+                'timestamp': pred['timestamp'],
+                'correlation': None if np.isnan(correlation) else float(correlation)
+            },
+            predictions, correlations
+        ))
+        # split the frames into scenes
+        scenes = []
+        for index, aest_pred in enumerate(utils.progress_bar(
+                predictions, desc="{} Extracting".format(self.tag), is_shown=self.progress_bars)):
             # when there is a scene change detection or it is the last image in the video
-            scene_detected = is_scene_detected(cur_hist, base_hist)
-            is_terminal = self.clip_id == self.total_clips and (index + 1) == len(predictions)
+            scene_detected = scene_changes[index]
+            is_terminal = is_last and self.clip_id == self.total_clips and (index + 1) == len(predictions)
             if not scene_detected:
                 cur_preds.append(aest_pred)
             if scene_detected or is_terminal:
-                # get only the best frame in the scene
-                best_pred = max(cur_preds, key=lambda cur_pred: cur_pred['mean_score_prediction'])
-                best_preds.append(best_pred)
+                scenes.append(cur_preds)
                 cur_preds = [aest_pred]
-                base_hist = None
-
-            if base_hist is None:
-                base_hist = cur_hist
-
-        # save unprocesed frames to swap path
-        desc = "{} Saving unprocessed frames to **{}".format(self.tag, self.swap_path[self.swap_path.rindex("/"):])
-        self.save_samples(cur_preds, self.extracts_path, self.swap_path, desc)
-        # move processed frames to temps path
-        desc = "{} Moving processed frames to **{}".format(self.tag, self.temps_path[self.temps_path.rindex("/"):])
-        self.save_samples(best_preds, self.extracts_path, self.temps_path, desc)
-        # apply technical predictions on temps path and move the samples to samples path
-        self.save_tech_samples(self.temps_path, self.samples_path)
+                # frame ending the scene is the new base, detect_scenes already did it except for the terminal frame
+                base_hist = hists[index]
+        scene_preds = [pred for scene in scenes for pred in scene]
+        if self.is_prefiltered:
+            scenes = self.score_candidates(scenes)
+        # get only the best frame in each scene
+        best_preds = list(map(
+            lambda scene: max(scene, key=lambda cur_pred: cur_pred['mean_score_prediction']),
+            scenes
+        ))
+        # frames of the unfinished scene are in cur_preds, so only the completed scenes release their frames
+        self.discard_frames(scene_preds, best_preds)
+        # scored frames of the unfinished scene release their frames as well except for its running winner
+        if not self.is_prefiltered and len(cur_preds) > 0:
+            self.discard_frames(cur_preds, [max(cur_preds, key=lambda cur_pred: cur_pred['mean_score_prediction'])])
+        return best_preds, (base_hist, cur_preds)
+
+    def sample_batches(self, batches, prev_state=None):
+        # batches are scored as they arrive, their scenes are split a batch later to know the last frames of the video
+        self.report_progress(utils.PROGRESS_STAGES[1])
+        best_preds = []
+        pending_preds = None
+        for batch in batches:
+            predictions = self.score_batch(batch)
+            if pending_preds is not None:
+                scene_preds, prev_state = self.select_scenes(pending_preds, prev_state, False)
+                best_preds.extend(scene_preds)
+            pending_preds = predictions
+        if pending_preds is not None:
+            scene_preds, prev_state = self.select_scenes(pending_preds, prev_state)
+            best_preds.extend(scene_preds)
+        self.save_tech_frames(best_preds)
+        return prev_state
+
+    def sample(self, prev_state=None):
+        self.report_progress(utils.PROGRESS_STAGES[1])
+        # get aesthetic predictions
+        if self.in_memory_frames:
+            predictions = self.score_batch(self.extracted_frames)
+        else:
+            predictions = nima.score(
+                base_model_name=BASE_MODEL,
+                image_source=self.extracts_path,
+                batch_size=self.batch_size,
+                weights_file=current_app.config['AESTHETIC_WEIGHTS_FILE_PATH'],
+                is_verbose=self.is_verbose,
+                backend=current_app.config['INFERENCE_BACKEND'],
+                on_batch=record_batch(AESTHETIC),
+                on_queue=record_queue(AESTHETIC)
+            )
+            metrics.inc('highlights_cnn_images_total', len(predictions), model=AESTHETIC)
+            predictions = list(map(lambda timed_pred: append_timestamp(timed_pred), predictions))
+            # sort them in increasing timestamp for detecting scene change
+            predictions = sorted(predictions, key=lambda k: k['timestamp'])
+        best_preds, (base_hist, cur_preds) = self.select_scenes(predictions, prev_state)
+
+        if self.in_memory_frames:
+            # unprocessed frames stay in cur_preds along with their images for the next clip
+            self.save_tech_frames(best_preds)
+        else:
+            # save unprocesed frames to swap path
+            desc = "{} Saving unprocessed frames to **{}".format(self.tag, self.swap_path[self.swap_path.rindex("/"):])
+            self.save_samples(cur_preds, self.extracts_path, self.swap_path, desc)
+            # move processed frames to temps path
+            desc = "{} Moving processed frames to **{}".format(
+                self.tag, self.temps_path[self.temps_path.rindex("/"):])
+            self.save_samples(best_preds, self.extracts_path, self.temps_path, desc)
+            # apply technical predictions on temps path and move the samples to samples path
+            self.save_tech_samples(self.temps_path, self.samples_path)
         # (base_hist, cur_preds) contains the termination state of this operation, so return it
         return base_hist, cur_preds
@@ -0,0 +1,196 @@
+import math
+import os
+import struct
+import time
+
+# atoms holding other atoms, searched for the duration of a fragmented video and for the sample tables
+CONTAINER_ATOMS = [b'moov', b'mvex', b'trak', b'mdia', b'minf', b'stbl']
+# fraction of the media bytes waited for over the estimate, as the bitrate varies within a video
+BYTES_MARGIN = 0.05
+# seconds of samples waited for beyond the end of a clip, as the decoder reads ahead of the frames it returns
+LOOKAHEAD_SECONDS = 1
+# seconds between two checks of the uploaded bytes
+POLL_INTERVAL = 0.5
+
+
+def read_atoms(video_file, start, end, file_size=None):
+    # top level atoms between start and end as (type, offset, size), stops at the first header beyond end
+    atoms = []
+    offset = start
+    while offset + 8 <= end:
+        video_file.seek(offset)
+        size, atom_type = struct.unpack('>I4s', video_file.read(8))
+        if size == 1:
+            if offset + 16 > end:
+                break
+            size = struct.unpack('>Q', video_file.read(8))[0]
+        elif size == 0:
+            # atom extends till the end of the file
+            size = (file_size or end) - offset
+        if size < 8:
+            break
+        atoms.append((atom_type, offset, size))
+        offset += size
+    return atoms
+
+
+def find_atom(video_file, atoms, path):
+    # nested atom of the path like [b'moov', b'mvex', b'mehd'], None when it is not present
+    for atom_type, offset, size in atoms:
+        if atom_type != path[0]:
+            continue
+        if len(path) == 1:
+            return atom_type, offset, size
+        if atom_type in CONTAINER_ATOMS:
+            return find_atom(video_file, read_atoms(video_file, offset + 8, offset + size), path[1:])
+    return None
+
+
+def read_payload(video_file, atom):
+    _, offset, size = atom
+    video_file.seek(offset)
+    header_size = 16 if struct.unpack('>I', video_file.read(4))[0] == 1 else 8
+    video_file.seek(offset + header_size)
+    return video_file.read(size - header_size)
+
+
+def read_table(payload, entry_format, entry_size, start=8):
+    # entries of a sample table, whose count follows the version and the flags
+    count = struct.unpack('>I', payload[start - 4:start])[0]
+    return list(struct.iter_unpack(entry_format, payload[start:start + count * entry_size]))
+
+
+def get_track_samples(video_file, trak_atom):
+    # (decode time in seconds, end offset) of every sample of the track
+    mdhd_atom = find_atom(video_file, [trak_atom], [b'trak', b'mdia', b'mdhd'])
+    stbl_atom = find_atom(video_file, [trak_atom], [b'trak', b'mdia', b'minf', b'stbl'])
+    if mdhd_atom is None or stbl_atom is None:
+        return []
+    mdhd = read_payload(video_file, mdhd_atom)
+    timescale = struct.unpack('>I', mdhd[20:24] if mdhd[0] == 1 else mdhd[12:16])[0]
+    tables = dict(map(lambda atom: (atom[0], read_payload(video_file, atom)),
+                      read_atoms(video_file, stbl_atom[1] + 8, stbl_atom[1] + stbl_atom[2])))
+    if timescale == 0 or not all(map(lambda table: table in tables, [b'stts', b'stsz', b'stsc'])):
+        return []
+
+    sample_size, sample_count = struct.unpack('>II', tables[b'stsz'][4:12])
+    sizes = [sample_size] * sample_count if sample_size > 0 else \
+        list(map(lambda entry: entry[0], read_table(tables[b'stsz'], '>I', 4, 12)))
+    if b'co64' in tables:
+        chunk_offsets = list(map(lambda entry: entry[0], read_table(tables[b'co64'], '>Q', 8)))
+    elif b'stco' in tables:
+        chunk_offsets = list(map(lambda entry: entry[0], read_table(tables[b'stco'], '>I', 4)))
+    else:
+        return []
+    # every run of chunks holds the same number of samples till the first chunk of the next run
+    chunk_runs = read_table(tables[b'stsc'], '>III', 12)
+    samples_per_chunk = []
+    for index, (first_chunk, chunk_samples, _) in enumerate(chunk_runs):
+        last_chunk = chunk_runs[index + 1][0] if index + 1 < len(chunk_runs) else len(chunk_offsets) + 1
+        samples_per_chunk.extend([chunk_samples] * (last_chunk - first_chunk))
+    end_offsets = []
+    for chunk_offset, chunk_samples in zip(chunk_offsets, samples_per_chunk):
+        for size in sizes[len(end_offsets):len(end_offsets) + chunk_samples]:
+            chunk_offset += size
+            end_offsets.append(chunk_offset)
+    decode_times = []
+    decode_time = 0
+    for count, delta in read_table(tables[b'stts'], '>II', 8):
+        for _ in range(count):
+            decode_times.append(decode_time / timescale)
+            decode_time += delta
+    return list(zip(decode_times, end_offsets))
+
+
+def get_second_offsets(video_file, moov_atom):
+    # bytes holding every sample decoded before each second of the video, from the sample tables of the moov
+    _, moov_offset, moov_size = moov_atom
+    moov_atoms = read_atoms(video_file, moov_offset + 8, moov_offset + moov_size)
+    trak_atoms = filter(lambda atom: atom[0] == b'trak', moov_atoms)
+    samples = sorted([sample for trak_atom in trak_atoms for sample in get_track_samples(video_file, trak_atom)])
+    if len(samples) == 0:
+        return None
+    second_offsets = []
+    end_offset = 0
+    index = 0
+    for second in range(math.ceil(samples[-1][0]) + 2):
+        while index < len(samples) and samples[index][0] < second:
+            end_offset = max(end_offset, samples[index][1])
+            index += 1
+        second_offsets.append(end_offset)
+    return second_offsets
+
+
+def get_media_range(file_path, upload_size):
+    # byte range of the media when the video can be decoded while it is uploaded, None otherwise
+    # moov-first videos also have the bytes required by every second of the video, from their sample tables
+    received_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as video_file:
+        atoms = read_atoms(video_file, 0, received_size, upload_size)
+        atom_types = list(map(lambda atom: atom[0], atoms))
+        if b'moov' not in atom_types:
+            return None
+        moov_offset, moov_size = atoms[atom_types.index(b'moov')][1:]
+        # moov has the index of every sample, so it must have arrived completely
+        if moov_offset + moov_size > received_size:
+            return None
+        if b'mdat' in atom_types and atom_types.index(b'moov') < atom_types.index(b'mdat'):
+            # moov-first video, every sample is in the mdat after it
+            mdat_offset, mdat_size = atoms[atom_types.index(b'mdat')][1:]
+            second_offsets = get_second_offsets(video_file, atoms[atom_types.index(b'moov')])
+            return mdat_offset, mdat_offset + mdat_size, second_offsets
+        if find_atom(video_file, atoms, [b'moov', b'mvex', b'mehd']) is not None:
+            # fragmented video with its duration in the moov, so the frame count is known before the fragments
+            return moov_offset + moov_size, upload_size, None
+    return None
+
+
+def get_clip_end_offset(media_range, clip_end_time, total_time):
+    media_start, media_end, second_offsets = media_range
+    if second_offsets is not None:
+        return second_offsets[min(math.ceil(clip_end_time) + LOOKAHEAD_SECONDS, len(second_offsets) - 1)]
+    # bytes of a fragmented video are assumed to be spread evenly over the time of the video
+    fraction = min(1.0, clip_end_time / total_time + BYTES_MARGIN)
+    return int(media_start + (media_end - media_start) * fraction)
+
+
+def wait_for_bytes(file_path, end_offset, stall_timeout, tag="", logger=None):
+    # blocks till the upload reaches the offset, fails when no byte arrives for stall_timeout seconds
+    received_size = os.path.getsize(file_path)
+    last_progress_time = time.time()
+    if received_size < end_offset and logger is not None:
+        logger.info("{} Waiting for {} of the uploaded bytes, received {}".format(tag, end_offset, received_size))
+    while received_size < end_offset:
+        time.sleep(POLL_INTERVAL)
+        cur_size = os.path.getsize(file_path)
+        if cur_size > received_size:
+            received_size, last_progress_time = cur_size, time.time()
+        elif time.time() - last_progress_time > stall_timeout:
+            raise TimeoutError("{} Upload stalled at {} bytes".format(tag, received_size))
+
+
+def get_wait_offset(state, clip_id=None):
+    # whole video is required when it cannot be decoded partially or when clip_id is None
+    if state.get('media_range') is None or clip_id is None:
+        return state['upload_size']
+    clip_end_time = min(clip_id * state['clip_time'] * 60, state['total_time'])
+    return get_clip_end_offset(state['media_range'], clip_end_time, state['total_time'])
+
+
+def is_estimated(state):
+    # bytes of the clips of a fragmented video are estimated, so a clip may be cut short by the received bytes
+    return state.get('media_range') is not None and state['media_range'][2] is None
+
+
+def is_clip_received(state, clip_id=None):
+    # only the videos uploaded in chunks have an upload size
+    if 'upload_size' not in state:
+        return True
+    return os.path.getsize(state['video_file_path']) >= get_wait_offset(state, clip_id)
+
+
+def wait_for_clip(state, clip_id=None, logger=None):
+    if 'upload_size' not in state:
+        return
+    wait_for_bytes(state['video_file_path'], get_wait_offset(state, clip_id), state['upload_timeout'], state['tag'],
+                   logger)
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 import random
@@ -7,9 +8,17 @@ import string
 from flask import current_app
 from werkzeug.utils import secure_filename
 
+try:
+    from tqdm import tqdm
+except ImportError:
+    # progress bars are optional, the requests run the same without them
+    tqdm = None
+
 SUPPORTED_VIDEO_EXTENSIONS = ['mov', 'mp4']
 SUPPORTED_IMAGE_EXTENSIONS = ['jpg']
-SUPPORTED_MODES = ['human_eye', 'scene_detect']
+SUPPORTED_MODES = ['human_eye', 'scene_detect', 'preview']
+# stages of a request as reported to the progress callback
+PROGRESS_STAGES = ['extracting', 'sampling', 'saving']
 
 
 def rand_gen(size=8, chars=string.ascii_lowercase + string.digits):
@@ -46,12 +55,70 @@ def get_param_value(request_form, request_param):
     return request_param['allowed'][0]
 
 
-def save_uploaded_file(file, base_path):
+def get_float_value(request_form, name):
+    # None when the param is either missing or invalid, so that the default is used
+    try:
+        return float(request_form[name]) if name in request_form else None
+    except ValueError as vErr:
+        current_app.logger.error(vErr)
+        return None
+
+
+def save_uploaded_file(file, base_path, chunk_size=1024 * 1024):
     file_name = secure_filename(file.filename)
     file_path = os.path.join(base_path, file_name)
-    file.save(file_path)
+    # hash the video while it is written, so that the repeated uploads are found without reading it again
+    sha256 = hashlib.sha256()
+    with open(file_path, 'wb') as saved_file:
+        for chunk in iter(lambda: file.stream.read(chunk_size), b''):
+            sha256.update(chunk)
+            saved_file.write(chunk)
     current_app.logger.debug('Saved uploaded file at {}'.format(file_path))
-    return file_path
+    return file_path, sha256.hexdigest()
+
+
+class NullBar:
+    '''stands in for a hidden tqdm bar, so that the loops need not check whether the bars are shown'''
+
+    def __init__(self, iterable=None):
+        self.iterable = iterable
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def update(self, n=1):
+        pass
+
+
+def progress_bar(iterable=None, desc=None, total=None, is_shown=True):
+    # updating a bar for every frame costs time in the decode loops, so the bars can be hidden
+    if tqdm is None or not is_shown:
+        return NullBar(iterable)
+    return tqdm(iterable, desc=desc, total=total)
+
+
+def report_progress(progress_callback, stage, clip_id, total_clips, completed=0, total=0):
+    # progress callback is available only for the asynchronous jobs
+    if progress_callback is None:
+        return
+    progress_callback({
+        'stage': stage,
+        'clipId': clip_id,
+        'totalClips': total_clips,
+        'completed': completed,
+        'total': total
+    })
+
+
+def save_json(json_object, file_path):
+    with open(file_path, 'w') as json_file:
+        json.dump(json_object, json_file)
 
 
 def get_print_string(json_object):
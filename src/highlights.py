@@ -1,14 +1,27 @@
+import fcntl
+import json
 import os
 import shutil
+import sys
 import time
 
 from flask import Blueprint, current_app, request, send_from_directory
+from werkzeug.http import parse_content_range_header
+from werkzeug.utils import secure_filename
 
-from generator import utils, get_predictions
+import jobs
+import metrics
+import result_cache
+from generator import decoders, feature_index, streaming, utils, get_predictions
 from generator.utils import SUPPORTED_MODES, SUPPORTED_IMAGE_EXTENSIONS, SUPPORTED_VIDEO_EXTENSIONS
 
 highlights = Blueprint("highlights", __name__, url_prefix="/highlights")
 
+# state of a chunked upload, kept in its videos directory till the job deletes it
+UPLOAD_STATE_FILE = 'upload.json'
+# status of a chunked upload whose job is yet to start
+UPLOADING = 'uploading'
+
 
 @highlights.route("/")
 def hello_highlights():
@@ -27,37 +40,55 @@ def generate_result(prediction, request_uuid, image_extension):
     }
 
 
-@highlights.route('/generate', methods=['POST'])
-def generate_highlights():
-    start_time = time.time()
-    request_uid = utils.rand_gen()
-    tag = "[{}]".format(request_uid)
-    # return immediately if video is not sent in the request
-    if 'video' not in request.files or not is_supported_video_type(request.files['video'].filename):
-        current_app.logger.info("{} No file uploaded".format(tag))
-        return utils.get_print_string({
-            'predictions': [],
-            'timeTaken': time.time() - start_time
-        })
-    video_file = request.files['video']
+def is_metrics_requested(request_values):
+    # metrics are not a param of the highlights, so they neither change the cached result nor its key
+    return request_values.get('metrics', '').lower() in ['1', 'true']
+
 
+def get_response(state, predictions, start_time):
+    response = {
+        'predictions': predictions,
+        'timeTaken': time.time() - start_time
+    }
+    # sampling within a time budget is reported, so that the client knows how sparse it was
+    if 'sampling' in state:
+        response['sampling'] = state['sampling']
+    # cached results are not generated again, so they have no metrics
+    if state.get('report_metrics'):
+        response['metrics'] = state.get('request_metrics', [])
+    return response
+
+
+def is_mode_unavailable(request_form):
+    # preview decodes the keyframes with pyav, so without it the request is rejected
+    # instead of silently running a much slower full extraction
+    mode = request_form.get('mode', '').lower()
+    return mode == SUPPORTED_MODES[2] and not decoders.is_available(decoders.PYAV)
+
+
+def reject_unavailable_mode(tag):
+    current_app.logger.info("{} Preview mode requires PyAV".format(tag))
+    return utils.get_print_string({'error': "Preview mode requires PyAV"}), 400
+
+
+def get_request_params(request_form, tag):
     # gracefully get params from form
-    mode = utils.get_param_value(request.form, {
+    mode = utils.get_param_value(request_form, {
         'name': "mode",
         'data_type': str,
         'allowed': SUPPORTED_MODES
     })
-    images_per_clip = utils.get_param_value(request.form, {
+    images_per_clip = utils.get_param_value(request_form, {
         'name': "images_per_clip",
         'data_type': int,
         'allowed': list(range(1, 6, 1))
     })
-    image_extension = utils.get_param_value(request.form, {
+    image_extension = utils.get_param_value(request_form, {
         'name': "image_extension",
         'data_type': str,
         'allowed': SUPPORTED_IMAGE_EXTENSIONS
     })
-    total_clips = utils.get_param_value(request.form, {
+    total_clips = utils.get_param_value(request_form, {
         'name': "total_clips",
         'data_type': int,
         'allowed': list(range(1, 26, 1))
@@ -66,8 +97,31 @@ def generate_highlights():
     current_app.logger.debug("{} mode: {}".format(tag, mode))
     current_app.logger.debug("{} images_per_clip: {}".format(tag, images_per_clip))
     current_app.logger.debug("{} image_extension: {}".format(tag, image_extension))
+    # seed of the random frame sampling, so that the same seed generates the same highlights
+    seed = request_form.get('seed')
     current_app.logger.debug("{} total_clips: {}".format(tag, total_clips))
+    current_app.logger.debug("{} seed: {}".format(tag, seed))
+    # scene change threshold of scene_detect mode, so that it can be tuned per video
+    scene_threshold = utils.get_float_value(request_form, 'scene_threshold')
+    current_app.logger.debug("{} scene_threshold: {}".format(tag, scene_threshold))
+    # seconds within which the frames are sampled and scored, the sampling gets sparser to meet it
+    time_budget = utils.get_float_value(request_form, 'time_budget')
+    if time_budget is not None and time_budget <= 0:
+        time_budget = None
+    current_app.logger.debug("{} time_budget: {}".format(tag, time_budget))
+    return {
+        'mode': mode,
+        'images_per_clip': images_per_clip,
+        'image_extension': image_extension,
+        'total_clips': total_clips,
+        'seed': seed,
+        'scene_threshold': scene_threshold,
+        'time_budget': time_budget
+    }
 
+
+def create_request_dirs(request_uid):
+    tag = "[{}]".format(request_uid)
     # create request directories
     request_dirs = [
         current_app.config['TEMP_VIDEOS_PATH'],
@@ -75,34 +129,277 @@ def generate_highlights():
         current_app.config['OUTPUT_IMAGES_PATH']
     ]
     request_dirs = list(map(lambda base_path: '{}/{}'.format(base_path, request_uid), request_dirs))
-    temp_videos_path, temp_images_path, output_images_path = request_dirs
     utils.create_dirs(request_dirs, current_app.logger, tag)
+    return request_dirs
 
-    # download the video
-    video_file_path = utils.save_uploaded_file(video_file, temp_videos_path)
 
-    state = {
+def get_request_state(request_uid, video_file_path, params, request_dirs, result_key=None, index_path=None):
+    temp_videos_path, temp_images_path, output_images_path = request_dirs
+    return {
         'request_uid': request_uid,
-        'mode': mode,
+        'mode': params['mode'],
         'video_file_path': video_file_path,
-        'total_clips': total_clips,
-        'images_per_clip': images_per_clip,
+        'total_clips': params['total_clips'],
+        'images_per_clip': params['images_per_clip'],
+        'seed': params['seed'],
+        'scene_threshold': params['scene_threshold'],
+        'time_budget': params['time_budget'],
+        'temp_videos_path': temp_videos_path,
         'temp_images_path': temp_images_path,
-        'image_extension': image_extension,
-        'predicts_path': output_images_path
+        'image_extension': params['image_extension'],
+        'predicts_path': output_images_path,
+        'result_key': result_key,
+        'index_path': index_path
     }
 
-    predictions = get_predictions(state)
-    predictions = list(map(lambda prediction: generate_result(prediction, request_uid, image_extension), predictions))
+
+def create_request_state(request_uid, video_file, params):
+    request_dirs = create_request_dirs(request_uid)
+
+    # download the video
+    video_file_path, content_hash = utils.save_uploaded_file(video_file, request_dirs[0])
+    # same video with the same params generates the same highlights
+    result_key = result_cache.get_result_key(content_hash, params) if result_cache.is_enabled() else None
+    # same video in the same mode and seed has the same frames, so later requests re-rank its feature index
+    index_path = None
+    if current_app.config['FEATURE_INDEX'] and current_app.config['IN_MEMORY_FRAMES']:
+        index_path = feature_index.get_index_path(current_app.config['FEATURES_PATH'], content_hash, params['mode'],
+                                                  params['seed'], current_app.config['WEIGHTS_VERSION'])
+    return get_request_state(request_uid, video_file_path, params, request_dirs, result_key, index_path)
+
+
+def get_upload_state_path(upload_id):
+    # upload ids are generated by rand_gen, so anything else is not an upload
+    if not upload_id.isalnum():
+        return None
+    return "{}/{}/{}".format(current_app.config['TEMP_VIDEOS_PATH'], upload_id, UPLOAD_STATE_FILE)
+
+
+def load_upload_state(upload_id):
+    upload_state_path = get_upload_state_path(upload_id)
+    if upload_state_path is None or not os.path.exists(upload_state_path):
+        return None
+    with open(upload_state_path) as upload_state_file:
+        return json.load(upload_state_file)
+
+
+def get_upload_status(state):
+    job = jobs.get_job_store().get(state['request_uid'])
+    return {
+        'uploadId': state['request_uid'],
+        'offset': os.path.getsize(state['video_file_path']),
+        'size': state['upload_size'],
+        'status': job['status'] if job is not None else UPLOADING
+    }
+
+
+def append_upload_chunk(state, content_range, chunk_size=1024 * 1024):
+    # chunk is streamed from the request body, so the server never holds more than chunk_size bytes of it
+    pending_bytes = content_range.stop - content_range.start
+    with open(state['video_file_path'], 'ab') as video_file:
+        while pending_bytes > 0:
+            chunk = request.stream.read(min(chunk_size, pending_bytes))
+            if not chunk:
+                break
+            video_file.write(chunk)
+            pending_bytes -= len(chunk)
+
+
+def start_upload_job(state):
+    # job starts as soon as the clips can be decoded from the arrived bytes, or else once the upload finishes
+    job_store = jobs.get_job_store()
+    if job_store.get(state['request_uid']) is not None:
+        return
+    received_size = os.path.getsize(state['video_file_path'])
+    if received_size < state['upload_size'] and \
+            streaming.get_media_range(state['video_file_path'], state['upload_size']) is None:
+        return
+    current_app.logger.info("[{}] Starting the job with {} of {} bytes".format(
+        state['request_uid'], received_size, state['upload_size']))
+    job_store.add(state['request_uid'], state)
+    jobs.start_workers(current_app._get_current_object())
+
+
+def delete_request_temps(state):
     # delete request temp images directory
-    shutil.rmtree(temp_images_path)
+    shutil.rmtree(state['temp_images_path'], ignore_errors=True)
     # delete request video directory
-    shutil.rmtree(temp_videos_path)
+    shutil.rmtree(state['temp_videos_path'], ignore_errors=True)
+
+
+def get_cached_predictions(state):
+    if state['result_key'] is None:
+        return None
+    predictions = result_cache.get_result_cache().get(state['result_key'])
+    if predictions is not None:
+        # images of the cached result are served, so the directories of this request are not required
+        current_app.logger.info("[{}] Reusing the highlights of the same video".format(state['request_uid']))
+        delete_request_temps(state)
+        shutil.rmtree(state['predicts_path'], ignore_errors=True)
+    return predictions
+
+
+def run_request(state):
+    request_uid, image_extension = state['request_uid'], state['image_extension']
+    # metrics are recorded by the thread running the request and added to the shared totals once it ends
+    request_metrics = metrics.start_request()
+    try:
+        with metrics.timer('highlights_request_seconds', mode=state['mode']):
+            predictions = get_predictions(state)
+    finally:
+        metrics.stop_request()
+        metrics.get_metric_store().add(request_metrics)
+    state['request_metrics'] = request_metrics.to_json()
+    predictions = list(map(lambda prediction: generate_result(prediction, request_uid, image_extension), predictions))
+    delete_request_temps(state)
+    if state.get('result_key') is not None:
+        result_cache.get_result_cache().add(state['result_key'], request_uid, predictions)
+    return predictions
+
+
+@highlights.route('/generate', methods=['POST'])
+def generate_highlights():
+    start_time = time.time()
+    request_uid = utils.rand_gen()
+    tag = "[{}]".format(request_uid)
+    # return immediately if video is not sent in the request
+    if 'video' not in request.files or not is_supported_video_type(request.files['video'].filename):
+        current_app.logger.info("{} No file uploaded".format(tag))
+        return utils.get_print_string({
+            'predictions': [],
+            'timeTaken': time.time() - start_time
+        })
+    if is_mode_unavailable(request.form):
+        return reject_unavailable_mode(tag)
+
+    params = get_request_params(request.form, tag)
+    state = create_request_state(request_uid, request.files['video'], params)
+    state['report_metrics'] = is_metrics_requested(request.values)
+    predictions = get_cached_predictions(state)
+    if predictions is None:
+        predictions = run_request(state)
+
+    return utils.get_print_string(get_response(state, predictions, start_time))
+
+
+@highlights.route('/jobs', methods=['POST'])
+def submit_job():
+    start_time = time.time()
+    request_uid = utils.rand_gen()
+    tag = "[{}]".format(request_uid)
+    # reject immediately if video is not sent in the request
+    if 'video' not in request.files or not is_supported_video_type(request.files['video'].filename):
+        current_app.logger.info("{} No file uploaded".format(tag))
+        return utils.get_print_string({'error': "No file uploaded"}), 400
+    if is_mode_unavailable(request.form):
+        return reject_unavailable_mode(tag)
+    # keep the queue bounded, so that the accepted jobs finish in a reasonable time
+    job_store = jobs.get_job_store()
+    if job_store.count_pending() >= current_app.config['JOB_QUEUE_LIMIT']:
+        current_app.logger.info("{} Job queue is full".format(tag))
+        return utils.get_print_string({'error': "Job queue is full"}), 503
+
+    params = get_request_params(request.form, tag)
+    state = create_request_state(request_uid, request.files['video'], params)
+    state['report_metrics'] = is_metrics_requested(request.values)
+    predictions = get_cached_predictions(state)
+    if predictions is not None:
+        # cached results are stored as finished jobs, so that they are polled like any other job
+        job_store.add(request_uid, state, get_response(state, predictions, start_time))
+        return utils.get_print_string({
+            'jobId': request_uid,
+            'status': jobs.DONE
+        })
+    job_store.add(request_uid, state)
+    jobs.start_workers(current_app._get_current_object())
 
     return utils.get_print_string({
-        'predictions': predictions,
-        'timeTaken': time.time() - start_time
+        'jobId': request_uid,
+        'status': jobs.QUEUED
+    }), 202
+
+
+@highlights.route('/jobs/<job_id>')
+def get_job_status(job_id):
+    job = jobs.get_job_store().get(job_id)
+    if job is None:
+        return utils.get_print_string({'error': "Unknown job"}), 404
+    return utils.get_print_string(jobs.get_status(job))
+
+
+@highlights.route('/jobs/<job_id>/result')
+def get_job_result(job_id):
+    job = jobs.get_job_store().get(job_id)
+    if job is None:
+        return utils.get_print_string({'error': "Unknown job"}), 404
+    if job['status'] == jobs.DONE:
+        return utils.get_print_string(json.loads(job['result']))
+    if job['status'] == jobs.FAILED:
+        return utils.get_print_string({'error': job['error']}), 500
+    # job is yet to finish
+    return utils.get_print_string(jobs.get_status(job)), 202
+
+
+@highlights.route('/uploads', methods=['POST'])
+def create_upload():
+    request_uid = utils.rand_gen()
+    tag = "[{}]".format(request_uid)
+    file_name = request.form.get('filename', '')
+    upload_size = utils.get_param_value(request.form, {
+        'name': "size",
+        'data_type': int,
+        'allowed': range(0, sys.maxsize)
     })
+    if not is_supported_video_type(file_name) or upload_size == 0:
+        current_app.logger.info("{} Invalid upload".format(tag))
+        return utils.get_print_string({'error': "Invalid upload"}), 400
+    if is_mode_unavailable(request.form):
+        return reject_unavailable_mode(tag)
+    # uploads become jobs, so they are bounded by the same queue
+    if jobs.get_job_store().count_pending() >= current_app.config['JOB_QUEUE_LIMIT']:
+        current_app.logger.info("{} Job queue is full".format(tag))
+        return utils.get_print_string({'error': "Job queue is full"}), 503
+
+    params = get_request_params(request.form, tag)
+    request_dirs = create_request_dirs(request_uid)
+    video_file_path = os.path.join(request_dirs[0], secure_filename(file_name))
+    open(video_file_path, 'wb').close()
+    # content hash is not known till the end, so the uploads are neither cached nor indexed
+    state = get_request_state(request_uid, video_file_path, params, request_dirs)
+    state.update({
+        'upload_size': upload_size,
+        'upload_timeout': current_app.config['UPLOAD_TIMEOUT'],
+        'report_metrics': is_metrics_requested(request.values)
+    })
+    utils.save_json(state, get_upload_state_path(request_uid))
+
+    return utils.get_print_string(get_upload_status(state)), 201
+
+
+@highlights.route('/uploads/<upload_id>', methods=['PUT'])
+def append_upload(upload_id):
+    state = load_upload_state(upload_id)
+    if state is None:
+        return utils.get_print_string({'error': "Unknown upload"}), 404
+    content_range = parse_content_range_header(request.headers.get('Content-Range'))
+    # lock the upload, so that the chunks are appended one after the other
+    with open(get_upload_state_path(upload_id)) as upload_state_file:
+        fcntl.flock(upload_state_file, fcntl.LOCK_EX)
+        # chunks are accepted only at the end of the received bytes, so a failed chunk is resumed from the offset
+        if content_range is None or content_range.units != 'bytes' or content_range.length != state['upload_size'] \
+                or content_range.start != os.path.getsize(state['video_file_path']):
+            return utils.get_print_string(get_upload_status(state)), 416
+        append_upload_chunk(state, content_range)
+        start_upload_job(state)
+        return utils.get_print_string(get_upload_status(state))
+
+
+@highlights.route('/uploads/<upload_id>')
+def get_upload(upload_id):
+    state = load_upload_state(upload_id)
+    if state is None:
+        return utils.get_print_string({'error': "Unknown upload"}), 404
+    return utils.get_print_string(get_upload_status(state))
 
 
 @highlights.route('/images/<path:path>')
@@ -0,0 +1,237 @@
+import atexit
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from contextlib import closing
+
+from flask import current_app
+
+from sqlite_store import SqliteStore
+
+# job statuses
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# seconds an idle worker waits before checking the queue again
+POLL_INTERVAL = 0.5
+# seconds between two progress updates of the same stage
+PROGRESS_INTERVAL = 1
+
+CREATE_JOBS_TABLE = '''
+CREATE TABLE jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    state TEXT NOT NULL,
+    progress TEXT,
+    result TEXT,
+    error TEXT,
+    worker_pid INTEGER,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+)
+'''
+
+# workers started by this process
+_WORKERS = []
+_WORKERS_LOCK = threading.Lock()
+
+
+class JobStore(SqliteStore):
+    '''sqlite backed queue of the jobs, shared by the flask process and the workers'''
+
+    # videos of the jobs in previous runs are deleted on start, so the jobs are also dropped on reset
+    table_name = 'jobs'
+    create_table = CREATE_JOBS_TABLE
+
+    def add(self, job_id, state, result=None):
+        # jobs with a result are added as done, so that no worker claims them
+        with closing(self.connect()) as connection:
+            if result is None:
+                connection.execute(
+                    "INSERT INTO jobs (id, status, state, created_at) VALUES (?, ?, ?, ?)",
+                    (job_id, QUEUED, json.dumps(state), time.time())
+                )
+            else:
+                connection.execute(
+                    "INSERT INTO jobs (id, status, state, result, created_at, finished_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (job_id, DONE, json.dumps(state), json.dumps(result), time.time(), time.time())
+                )
+
+    def get(self, job_id):
+        with closing(self.connect()) as connection:
+            return connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def count_pending(self):
+        with closing(self.connect()) as connection:
+            return connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)
+            ).fetchone()[0]
+
+    def claim(self, worker_pid):
+        # lock the database so that only one worker gets the oldest queued job
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            job = connection.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if job is not None:
+                connection.execute(
+                    "UPDATE jobs SET status = ?, worker_pid = ?, started_at = ? WHERE id = ?",
+                    (RUNNING, worker_pid, time.time(), job['id'])
+                )
+            connection.execute("COMMIT")
+            return job
+
+    def update_progress(self, job_id, progress):
+        with closing(self.connect()) as connection:
+            connection.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+
+    def finish(self, job_id, result):
+        with closing(self.connect()) as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                (DONE, json.dumps(result), time.time(), job_id)
+            )
+
+    def fail(self, job_id, error):
+        with closing(self.connect()) as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (FAILED, error, time.time(), job_id)
+            )
+
+    def fail_orphans(self, alive_pids):
+        # running jobs of the workers that exited can never finish
+        with closing(self.connect()) as connection:
+            running_jobs = connection.execute(
+                "SELECT id, worker_pid FROM jobs WHERE status = ?", (RUNNING,)
+            ).fetchall()
+        for job in running_jobs:
+            if job['worker_pid'] not in alive_pids:
+                self.fail(job['id'], "Worker {} exited while running the job".format(job['worker_pid']))
+
+
+class ProgressWriter:
+    '''progress callback of a job, writes only on a stage change or after PROGRESS_INTERVAL seconds'''
+
+    def __init__(self, job_store, job_id):
+        self.job_store = job_store
+        self.job_id = job_id
+        self.last_stage = None
+        self.last_write_time = 0
+
+    def __call__(self, progress):
+        stage = (progress['stage'], progress['clipId'])
+        cur_time = time.time()
+        if stage == self.last_stage and cur_time - self.last_write_time < PROGRESS_INTERVAL:
+            return
+        self.last_stage, self.last_write_time = stage, cur_time
+        self.job_store.update_progress(self.job_id, progress)
+
+
+def get_job_store():
+    return JobStore(current_app.config['JOBS_DB_PATH'])
+
+
+def get_status(job):
+    return {
+        'jobId': job['id'],
+        'status': job['status'],
+        'progress': json.loads(job['progress']) if job['progress'] else None,
+        'createdAt': job['created_at'],
+        'startedAt': job['started_at'],
+        'finishedAt': job['finished_at']
+    }
+
+
+def run_job(job_store, job):
+    from highlights import delete_request_temps, get_response, run_request
+
+    start_time = time.time()
+    state = json.loads(job['state'])
+    state['progress_callback'] = ProgressWriter(job_store, job['id'])
+    try:
+        predictions = run_request(state)
+        job_store.finish(job['id'], get_response(state, predictions, start_time))
+    except Exception as ex:
+        current_app.logger.error("[{}] Job failed: {}".format(job['id'], ex))
+        traceback.print_exc()
+        delete_request_temps(state)
+        job_store.fail(job['id'], str(ex))
+
+
+def run_worker(config):
+    from logging.config import dictConfig
+
+    from flask import Flask
+
+    from nima.utils import set_memory_growth
+
+    # workers are spawned, so the logging, gpus and the app have to be configured again
+    dictConfig(config['LOG_CONFIG'])
+    set_memory_growth()
+    app = Flask(__name__)
+    app.config.from_mapping(config)
+    process_jobs(app)
+
+
+def process_jobs(app):
+    from generator import load_models
+
+    with app.app_context():
+        # every worker owns its models
+        warm_up_time = load_models(app.config)
+        app.logger.info("[worker:{}] Loaded nima models in {:.3f}s".format(os.getpid(), warm_up_time))
+
+    # jobs of the threads share the models of the worker, so their frames can be scored in the same batches
+    for _ in range(app.config['JOB_THREADS'] - 1):
+        threading.Thread(target=claim_jobs, args=(app,), daemon=True).start()
+    claim_jobs(app)
+
+
+def claim_jobs(app):
+    with app.app_context():
+        job_store = JobStore(app.config['JOBS_DB_PATH'])
+        while True:
+            job = job_store.claim(os.getpid())
+            if job is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            app.logger.info("[worker:{}] Running job {}".format(os.getpid(), job['id']))
+            run_job(job_store, job)
+
+
+def stop_workers():
+    with _WORKERS_LOCK:
+        for worker in _WORKERS:
+            worker.terminate()
+        _WORKERS.clear()
+
+
+def start_workers(app):
+    # job workers of the pre-fork server are forked by its master
+    if app.config['PREFORK_WORKERS'] > 0:
+        return
+    # workers are started on the first job, so the reloader process of flask does not own any workers
+    with _WORKERS_LOCK:
+        alive_workers = list(filter(lambda worker: worker.is_alive(), _WORKERS))
+        if len(alive_workers) < len(_WORKERS):
+            JobStore(app.config['JOBS_DB_PATH']).fail_orphans(list(map(lambda worker: worker.pid, alive_workers)))
+
+        # tensorflow does not support fork after it is initialized, so spawn the workers
+        context = multiprocessing.get_context('spawn')
+        while len(alive_workers) < app.config['JOB_WORKERS']:
+            worker = context.Process(target=run_worker, args=(dict(app.config),))
+            worker.start()
+            app.logger.info("Started job worker {}".format(worker.pid))
+            alive_workers.append(worker)
+        _WORKERS[:] = alive_workers
+
+
+atexit.register(stop_workers)
@@ -0,0 +1,216 @@
+import json
+import threading
+import time
+from contextlib import closing, contextmanager
+
+from flask import current_app
+
+from sqlite_store import SqliteStore
+
+# content type of the prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# upper bounds of the histogram buckets in seconds, from a single batch to a whole request
+TIME_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500]
+# upper bounds of the histogram buckets in frames, from a single frame to several batches
+FRAME_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+# exposed metrics with their types and help, in the order of the exposition
+METRICS = {
+    'highlights_request_seconds': (HISTOGRAM, "Time taken to generate the highlights of a request"),
+    'highlights_decode_seconds': (HISTOGRAM, "Time taken to extract the frames of a clip"),
+    'highlights_frames_decoded_total': (COUNTER, "Frames decoded while extracting the clips"),
+    'highlights_frames_kept_total': (COUNTER, "Decoded frames kept for scoring"),
+    'highlights_seeks_total': (COUNTER, "Seeks done instead of decoding the skipped frames"),
+    'highlights_cnn_batch_seconds': (HISTOGRAM, "Time taken to score a batch of frames"),
+    'highlights_cnn_images_total': (COUNTER, "Frames scored by the models"),
+    'highlights_prefiltered_frames_total': (COUNTER, "Frames dropped by the quality pre-filter before the models"),
+    'highlights_disk_written_bytes_total': (COUNTER, "Bytes of the frames written to the disk"),
+    'highlights_disk_moved_bytes_total': (COUNTER, "Bytes of the frames moved between the temp folders"),
+    'highlights_save_seconds': (HISTOGRAM, "Time taken to save the final frames of a request"),
+    'highlights_batching_wait_seconds': (HISTOGRAM, "Time frames waited in the batcher before their batch ran"),
+    'highlights_batching_queue_frames': (HISTOGRAM, "Frames queued in the batcher ahead of a submit"),
+    'highlights_batching_batch_frames': (HISTOGRAM, "Frames of the batches run by the batcher")
+}
+# histograms counted in frames, the others are in seconds
+HISTOGRAM_BUCKETS = {
+    'highlights_batching_queue_frames': FRAME_BUCKETS,
+    'highlights_batching_batch_frames': FRAME_BUCKETS
+}
+
+CREATE_METRICS_TABLE = '''
+CREATE TABLE metrics (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    count INTEGER,
+    buckets TEXT,
+    PRIMARY KEY (name, labels)
+)
+'''
+
+# metrics of the request run by the current thread
+_LOCAL = threading.local()
+
+
+class RequestMetrics:
+    '''counters and histograms recorded while running a request, keyed by the name and the sorted labels'''
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.setdefault(key, {'sum': 0, 'count': 0, 'buckets': [0] * len(get_buckets(name))})
+        histogram['sum'] += value
+        histogram['count'] += 1
+        # buckets are cumulative as in the exposition
+        for index, bound in enumerate(get_buckets(name)):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+
+    def merge(self, other):
+        for (name, labels), value in other.counters.items():
+            self.inc(name, value, dict(labels))
+        for key, other_histogram in other.histograms.items():
+            histogram = self.histograms.setdefault(
+                key, {'sum': 0, 'count': 0, 'buckets': [0] * len(get_buckets(key[0]))})
+            histogram['sum'] += other_histogram['sum']
+            histogram['count'] += other_histogram['count']
+            histogram['buckets'] = list(map(lambda a, b: a + b, histogram['buckets'], other_histogram['buckets']))
+
+    def to_json(self):
+        # buckets are left out, so that the response shows only the totals of the request
+        counters = list(map(
+            lambda item: {'name': item[0][0], 'labels': dict(item[0][1]), 'value': item[1]},
+            sorted(self.counters.items())
+        ))
+        histograms = list(map(
+            lambda item: {'name': item[0][0], 'labels': dict(item[0][1]), 'count': item[1]['count'],
+                          'sum': item[1]['sum']},
+            sorted(self.histograms.items(), key=lambda item: item[0])
+        ))
+        return counters + histograms
+
+
+class MetricStore(SqliteStore):
+    '''sqlite totals of the metrics of all the requests, shared by the flask process and the job workers'''
+
+    # counters of prometheus start from zero with the process, so the metrics are dropped on reset
+    table_name = 'metrics'
+    create_table = CREATE_METRICS_TABLE
+
+    def add(self, request_metrics):
+        # metrics of a request are added at once, so that a scrape never sees a part of the request
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for (name, labels), value in request_metrics.counters.items():
+                labels = json.dumps(labels)
+                row = connection.execute(
+                    "SELECT value FROM metrics WHERE name = ? AND labels = ?", (name, labels)).fetchone()
+                if row is None:
+                    connection.execute(
+                        "INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?)", (name, labels, value))
+                else:
+                    connection.execute(
+                        "UPDATE metrics SET value = ? WHERE name = ? AND labels = ?",
+                        (row['value'] + value, name, labels)
+                    )
+            for (name, labels), histogram in request_metrics.histograms.items():
+                labels = json.dumps(labels)
+                row = connection.execute(
+                    "SELECT * FROM metrics WHERE name = ? AND labels = ?", (name, labels)).fetchone()
+                if row is None:
+                    connection.execute(
+                        "INSERT INTO metrics (name, labels, value, count, buckets) VALUES (?, ?, ?, ?, ?)",
+                        (name, labels, histogram['sum'], histogram['count'], json.dumps(histogram['buckets']))
+                    )
+                else:
+                    buckets = list(map(lambda a, b: a + b, json.loads(row['buckets']), histogram['buckets']))
+                    connection.execute(
+                        "UPDATE metrics SET value = ?, count = ?, buckets = ? WHERE name = ? AND labels = ?",
+                        (row['value'] + histogram['sum'], row['count'] + histogram['count'], json.dumps(buckets),
+                         name, labels)
+                    )
+            connection.execute("COMMIT")
+
+    def export(self):
+        with closing(self.connect()) as connection:
+            rows = connection.execute("SELECT * FROM metrics ORDER BY name, labels").fetchall()
+        lines = []
+        for name, (metric_type, metric_help) in METRICS.items():
+            lines.append("# HELP {} {}".format(name, metric_help))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for row in filter(lambda row: row['name'] == name, rows):
+                labels = list(map(lambda label: '{}="{}"'.format(*label), json.loads(row['labels'])))
+                if metric_type == COUNTER:
+                    lines.append("{}{} {}".format(name, format_labels(labels), row['value']))
+                    continue
+                bucket_counts = json.loads(row['buckets']) + [row['count']]
+                for bound, bucket_count in zip(get_buckets(name) + ['+Inf'], bucket_counts):
+                    lines.append("{}_bucket{} {}".format(
+                        name, format_labels(labels + ['le="{}"'.format(bound)]), bucket_count))
+                lines.append("{}_sum{} {}".format(name, format_labels(labels), row['value']))
+                lines.append("{}_count{} {}".format(name, format_labels(labels), row['count']))
+        return "\n".join(lines) + "\n"
+
+
+def get_buckets(name):
+    return HISTOGRAM_BUCKETS.get(name, TIME_BUCKETS)
+
+
+def format_labels(labels):
+    return "{{{}}}".format(",".join(labels)) if len(labels) > 0 else ""
+
+
+def get_metric_store():
+    return MetricStore(current_app.config['METRICS_DB_PATH'])
+
+
+def start_request():
+    _LOCAL.metrics = RequestMetrics()
+    return _LOCAL.metrics
+
+
+def stop_request():
+    request_metrics = getattr(_LOCAL, 'metrics', None)
+    _LOCAL.metrics = None
+    return request_metrics
+
+
+def get_request_metrics():
+    return getattr(_LOCAL, 'metrics', None)
+
+
+def inc(name, value=1, **labels):
+    # recorded only while a request is running in this thread, so the modes work without the metrics
+    request_metrics = get_request_metrics()
+    if request_metrics is not None:
+        request_metrics.inc(name, value, labels)
+
+
+def observe(name, value, **labels):
+    request_metrics = get_request_metrics()
+    if request_metrics is not None:
+        request_metrics.observe(name, value, labels)
+
+
+def merge(other):
+    # metrics recorded by the decode workers are sent back with their frames
+    request_metrics = get_request_metrics()
+    if request_metrics is not None and other is not None:
+        request_metrics.merge(other)
+
+
+@contextmanager
+def timer(name, **labels):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start_time, **labels)
@@ -1,2 +1,6 @@
 # do not want members other than below to be exposed
-from nima.nima import score
+from nima.batching import configure as configure_batching
+from nima.nima import score, score_dual, score_images
+from nima.registry import BACKENDS, KERAS, check_drift, get_dual_model, get_model, load_dual_model, load_models, \
+    preload_weights
+from nima.utils import resolve_batch_size
@@ -0,0 +1,163 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+# batches of a request submitted ahead of the one it waits for, so that preprocessing overlaps the inference
+BATCHES_AHEAD = 1
+
+# batchers of the process keyed by the model, they are started on the first use so that they run after a fork
+_BATCHERS = {}
+_BATCHERS_LOCK = threading.Lock()
+# largest batch and seconds the oldest frames wait for the frames of other requests, no batching when it is 0
+_CONFIG = {'max_batch_size': 64, 'max_wait': 0}
+
+
+class PendingFrames:
+    '''frames submitted by a request, scored in one or more batches of the batcher'''
+
+    def __init__(self, images, queued_count):
+        self.images = images
+        self.queued_count = queued_count
+        self.submit_time = time.perf_counter()
+        # frames taken into a batch so far and the (wait seconds, batch frames, predict seconds) of those batches
+        self.offset = 0
+        self.batches = []
+        self.predictions = []
+        self.scored_count = 0
+        self.future = Future()
+
+
+class DynamicBatcher:
+    '''scores the frames of concurrent requests together, taking the requests in turns for every batch'''
+
+    def __init__(self, model, max_batch_size, max_wait):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # request id -> its pending frames in the order of submission
+        self.pending = OrderedDict()
+        self.queued_count = 0
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, request_id, images):
+        with self.condition:
+            pending_frames = PendingFrames(images, self.queued_count)
+            self.pending.setdefault(request_id, deque()).append(pending_frames)
+            self.queued_count += len(images)
+            self.condition.notify()
+        return pending_frames
+
+    def take_batch(self):
+        # every request gets an equal share of the batch, so a large request never holds back the others
+        parts = []
+        batch_size = 0
+        while batch_size < self.max_batch_size and len(self.pending) > 0:
+            share = max((self.max_batch_size - batch_size) // len(self.pending), 1)
+            for request_id in list(self.pending):
+                if batch_size >= self.max_batch_size:
+                    break
+                request_frames = self.pending[request_id]
+                pending_frames = request_frames[0]
+                count = min(share, len(pending_frames.images) - pending_frames.offset, self.max_batch_size - batch_size)
+                parts.append((pending_frames, pending_frames.offset, count))
+                pending_frames.offset += count
+                batch_size += count
+                if pending_frames.offset == len(pending_frames.images):
+                    request_frames.popleft()
+                # the request goes last, so the next batch starts with another request
+                if len(request_frames) == 0:
+                    del self.pending[request_id]
+                else:
+                    self.pending.move_to_end(request_id)
+        self.queued_count -= batch_size
+        return parts, batch_size
+
+    def wait_for_batch(self):
+        with self.condition:
+            while self.queued_count == 0:
+                self.condition.wait()
+            # frames of other requests are waited for till the batch is full or the oldest frames waited max_wait
+            deadline = min(map(lambda request_frames: request_frames[0].submit_time, self.pending.values()))
+            deadline += self.max_wait
+            while self.queued_count < self.max_batch_size and time.perf_counter() < deadline:
+                self.condition.wait(deadline - time.perf_counter())
+            return self.take_batch()
+
+    def run(self):
+        while True:
+            parts, batch_size = self.wait_for_batch()
+            start_time = time.perf_counter()
+            try:
+                images = np.concatenate(list(map(
+                    lambda part: part[0].images[part[1]:part[1] + part[2]], parts)))
+                outputs = self.model.predict_on_batch(images)
+            except Exception as ex:
+                for pending_frames, _, _ in parts:
+                    if not pending_frames.future.done():
+                        pending_frames.future.set_exception(ex)
+                continue
+            # models with several outputs, as the dual model, are split output by output
+            is_listed = isinstance(outputs, (list, tuple))
+            outputs = list(map(np.asarray, outputs)) if is_listed else [np.asarray(outputs)]
+            predict_seconds = time.perf_counter() - start_time
+            position = 0
+            for pending_frames, offset, count in parts:
+                pending_frames.batches.append((start_time - pending_frames.submit_time, batch_size, predict_seconds))
+                pending_frames.predictions.append(list(map(lambda output: output[position:position + count], outputs)))
+                pending_frames.scored_count += count
+                position += count
+                if pending_frames.scored_count == len(pending_frames.images) and not pending_frames.future.done():
+                    pending_frames.future.set_result(join_outputs(pending_frames.predictions, is_listed))
+
+
+def join_outputs(predictions, is_listed):
+    outputs = list(map(lambda index: np.concatenate(list(map(lambda parts: parts[index], predictions))),
+                       range(len(predictions[0]))))
+    return outputs if is_listed else outputs[0]
+
+
+def configure(max_batch_size, max_wait):
+    _CONFIG.update({'max_batch_size': max_batch_size, 'max_wait': max_wait})
+
+
+def is_enabled():
+    return _CONFIG['max_wait'] > 0
+
+
+def get_batcher(model):
+    # models are shared by all the requests of the process, so is their batcher
+    with _BATCHERS_LOCK:
+        if id(model) not in _BATCHERS:
+            _BATCHERS[id(model)] = DynamicBatcher(model, _CONFIG['max_batch_size'], _CONFIG['max_wait'])
+        return _BATCHERS[id(model)]
+
+
+def predict(model, data_generator, on_batch=None, on_queue=None):
+    # frames of the requests scoring at the same time are batched together, each request waits only for its own
+    batcher = get_batcher(model)
+    request_id = threading.get_ident()
+    submitted = deque()
+    predictions = []
+    for index in range(len(data_generator)):
+        batch = data_generator[index]
+        # batches of the test data generator come with their labels
+        submitted.append(batcher.submit(request_id, batch[0] if isinstance(batch, tuple) else batch))
+        if len(submitted) > BATCHES_AHEAD:
+            predictions.append(collect(submitted.popleft(), on_batch, on_queue))
+    while len(submitted) > 0:
+        predictions.append(collect(submitted.popleft(), on_batch, on_queue))
+    is_listed = isinstance(predictions[0], list)
+    return join_outputs(list(map(lambda outputs: outputs if is_listed else [outputs], predictions)), is_listed)
+
+
+def collect(pending_frames, on_batch=None, on_queue=None):
+    outputs = pending_frames.future.result()
+    if on_batch is not None:
+        list(map(lambda batch: on_batch(batch[2]), pending_frames.batches))
+    if on_queue is not None:
+        on_queue(pending_frames.queued_count, list(map(lambda batch: batch[:2], pending_frames.batches)))
+    return outputs
@@ -106,3 +106,29 @@ class TestDataGenerator(tf.keras.utils.Sequence):
         X = self.basenet_preprocess(X)
 
         return X, y
+
+
+class ArrayDataGenerator(tf.keras.utils.Sequence):
+    '''inherits from Keras Sequence base object, serves already decoded frames instead of image files'''
+
+    def __init__(self, samples, batch_size, basenet_preprocess, is_bgr=True):
+        self.samples = samples  # dicts holding the resized image as numpy array under 'image'
+        self.batch_size = batch_size
+        self.basenet_preprocess = basenet_preprocess  # Keras basenet specific preprocessing function
+        self.is_bgr = is_bgr  # frames decoded by opencv are in BGR order
+
+    def __len__(self):
+        return int(np.ceil(len(self.samples) / self.batch_size))  # number of batches per epoch
+
+    def __getitem__(self, index):
+        batch_samples = self.samples[index * self.batch_size:(index + 1) * self.batch_size]  # get batch samples
+        return self.__data_generator(batch_samples)
+
+    def __data_generator(self, batch_samples):
+        X = np.stack([sample['image'] for sample in batch_samples]).astype(np.float32)
+        if self.is_bgr:
+            X = X[..., ::-1]
+
+        # apply basenet specific preprocessing
+        # input is 4D numpy array of RGB values within [0, 255]
+        return self.basenet_preprocess(X)
@@ -1,7 +1,9 @@
 import importlib
+
+import numpy as np
 from tensorflow.keras import backend as K
 from tensorflow.keras.models import Model
-from tensorflow.keras.layers import Dropout, Dense
+from tensorflow.keras.layers import Dropout, Dense, Input
 from tensorflow.keras.optimizers import Adam
 
 
@@ -41,13 +43,56 @@ class Nima:
         self.base_model = BaseCnn(input_shape=(224, 224, 3), weights=self.weights, include_top=False, pooling='avg')
 
         # add dropout and dense layer
-        x = Dropout(self.dropout_rate)(self.base_model.output)
-        x = Dense(units=self.n_classes, activation='softmax')(x)
+        self.head_layers = [Dropout(self.dropout_rate), Dense(units=self.n_classes, activation='softmax')]
+        x = self.apply_head(self.base_model.output)
 
         self.nima_model = Model(self.base_model.inputs, x)
 
+    def apply_head(self, features):
+        for layer in self.head_layers:
+            features = layer(features)
+        return features
+
     def compile(self):
         self.nima_model.compile(optimizer=Adam(lr=self.learning_rate, decay=self.decay), loss=self.loss)
 
     def preprocessing_function(self):
         return self.base_module.preprocess_input
+
+
+def has_same_weights(model, other_model):
+    weights, other_weights = model.get_weights(), other_model.get_weights()
+    return len(weights) == len(other_weights) and all(map(np.array_equal, weights, other_weights))
+
+
+class DualNima:
+    def __init__(self, technical_nima, aesthetic_nima):
+        # built Nima models with the weights loaded
+        self.technical_nima = technical_nima
+        self.aesthetic_nima = aesthetic_nima
+        self.is_shared_backbone = has_same_weights(technical_nima.base_model, aesthetic_nima.base_model)
+
+    def build(self):
+        inputs = Input(shape=(224, 224, 3))
+        technical_features = self.technical_nima.base_model(inputs)
+        if self.is_shared_backbone:
+            # run the backbone once and both the heads on its pooled features
+            aesthetic_features = technical_features
+        else:
+            # fine-tuned backbones differ, so fuse both of them into a single forward pass
+            # nested models should have unique names in the fused model, so the aesthetic backbone is wrapped
+            # in a model of its own name sharing its layers, the base model of the registry stays as it is
+            aesthetic_base_model = self.aesthetic_nima.base_model
+            aesthetic_backbone = Model(aesthetic_base_model.inputs, aesthetic_base_model.outputs,
+                                       name="aesthetic_{}".format(aesthetic_base_model.name))
+            aesthetic_features = aesthetic_backbone(inputs)
+
+        # outputs are technical and aesthetic score distributions and pooled aesthetic features
+        self.dual_model = Model(inputs, [
+            self.technical_nima.apply_head(technical_features),
+            self.aesthetic_nima.apply_head(aesthetic_features),
+            aesthetic_features
+        ])
+
+    def preprocessing_function(self):
+        return self.technical_nima.preprocessing_function()
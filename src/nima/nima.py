@@ -1,9 +1,12 @@
 import os
 import glob
 
-from nima import utils
-from nima.data_generator import TestDataGenerator
-from nima.model_builder import Nima
+from nima import batching, utils
+from nima.data_generator import ArrayDataGenerator, TestDataGenerator
+from nima.registry import KERAS, get_dual_model, get_model
+
+# batch size that keeps the cpu cores busy without holding too many frames in memory
+DEFAULT_BATCH_SIZE = 32
 
 
 def image_file_to_json(img_path):
@@ -24,7 +27,9 @@ def image_dir_to_json(img_dir, img_type='jpg'):
     return samples
 
 
-def predict(model, data_generator, is_verbose=0):
+def predict(model, data_generator, is_verbose=0, on_batch=None, on_queue=None):
+    if batching.is_enabled():
+        return batching.predict(model, data_generator, on_batch, on_queue)
     # enabling multi processing is throwing GeneratorDataset iterator error in 2.1
     # fixing it by setting workers=1 and use_multiprocessing=False
     # ref: https://github.com/tensorflow/tensorflow/issues/37515
@@ -32,51 +37,30 @@ def predict(model, data_generator, is_verbose=0):
         data_generator,
         workers=1,
         use_multiprocessing=False,
-        verbose=is_verbose
+        verbose=is_verbose,
+        callbacks=[utils.BatchTimer(on_batch)] if on_batch is not None else None
     )
 
 
-def score(base_model_name, weights_file,
-          image_source, swap_pred="./pred", swap_buffer="./buffer",
-          predictions_file=None, img_type='jpg', is_verbose=0):
-    # build model and load weights
-    nima = Nima(base_model_name, weights=None)
-    nima.build()
-    nima.nima_model.load_weights(weights_file)
-    # print(nima.nima_model.summary())
+def score(base_model_name, weights_file, image_source, batch_size=DEFAULT_BATCH_SIZE,
+          predictions_file=None, img_type='jpg', is_verbose=0, backend=KERAS, on_batch=None, on_queue=None):
+    # get the model built and loaded only once per process
+    nima = get_model(base_model_name, weights_file, backend)
 
-    # observed that limiting the number of files to 2048 is reducing the probability of getting cuda out of memory error
-    FILES_LIMIT = 2048
-    samples = []
-    predictions = []
-    files = os.listdir(image_source)
-    while len(files) > 0:
-        # move folders to swap
-        files = files[:FILES_LIMIT]
-        utils.move_files(files, image_source, swap_pred)
-
-        # generate samples list
-        image_dir = swap_pred
-        cur_samps = image_dir_to_json(image_dir, img_type=img_type)
-        samples.extend(cur_samps)
-
-        # initialize data generator
-        # use only 1 as batch_size to support lower gpus
-        data_generator = TestDataGenerator(
-            cur_samps, image_dir, 1, 10,
-            nima.preprocessing_function(),
-            img_format=img_type
-        )
-        # get predictions
-        cur_preds = predict(nima.nima_model, data_generator, is_verbose)
-        predictions.extend(cur_preds)
-
-        # move files to buffer space
-        utils.move_files(files, swap_pred, swap_buffer)
-        # get new file list
-        files = os.listdir(image_source)
-    # move files back to the original directory
-    utils.move_files(os.listdir(swap_buffer), swap_buffer, image_source)
+    # generate samples list
+    samples = image_dir_to_json(image_source, img_type=img_type)
+    if len(samples) == 0:
+        return samples
+
+    # initialize data generator
+    # images are loaded only one batch at a time, so the batch size bounds the memory used
+    data_generator = TestDataGenerator(
+        samples, image_source, utils.resolve_batch_size(batch_size), 10,
+        nima.preprocessing_function(),
+        img_format=img_type
+    )
+    # get predictions
+    predictions = predict(nima.nima_model, data_generator, is_verbose, on_batch, on_queue)
 
     # calc mean scores and add to samples
     for i, sample in enumerate(samples):
@@ -86,3 +70,41 @@ def score(base_model_name, weights_file,
         utils.save_json(samples, predictions_file)
 
     return samples
+
+
+def score_images(base_model_name, weights_file, samples, batch_size=DEFAULT_BATCH_SIZE, is_verbose=0, backend=KERAS,
+                 on_batch=None, on_queue=None):
+    # samples are dicts with the resized frame under 'image', scores are added to a copy of them
+    if len(samples) == 0:
+        return []
+    nima = get_model(base_model_name, weights_file, backend)
+
+    data_generator = ArrayDataGenerator(samples, utils.resolve_batch_size(batch_size), nima.preprocessing_function())
+    predictions = predict(nima.nima_model, data_generator, is_verbose, on_batch, on_queue)
+
+    return list(map(
+        lambda sample, prediction: dict(sample, mean_score_prediction=utils.calc_mean_score(prediction)),
+        samples, predictions
+    ))
+
+
+def score_dual(base_model_name, technical_weights_file, aesthetic_weights_file, samples,
+               batch_size=DEFAULT_BATCH_SIZE, is_verbose=0, on_batch=None, on_queue=None):
+    # both the scores and the pooled features are added to a copy of the samples in a single pass
+    if len(samples) == 0:
+        return []
+    dual_nima = get_dual_model(base_model_name, technical_weights_file, aesthetic_weights_file)
+
+    data_generator = ArrayDataGenerator(samples, utils.resolve_batch_size(batch_size), dual_nima.preprocessing_function())
+    technical_preds, aesthetic_preds, embeddings = predict(
+        dual_nima.dual_model, data_generator, is_verbose, on_batch, on_queue)
+
+    return list(map(
+        lambda sample, technical_pred, aesthetic_pred, embedding: dict(
+            sample,
+            technical_score=utils.calc_mean_score(technical_pred),
+            aesthetic_score=utils.calc_mean_score(aesthetic_pred),
+            embedding=embedding
+        ),
+        samples, technical_preds, aesthetic_preds, embeddings
+    ))
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import numpy as np
+
+from nima import tflite, utils
+from nima.model_builder import DualNima, Nima
+
+# backends running the models, tflite ones run the models converted with the quantization in their name
+KERAS = 'keras'
+BACKENDS = [KERAS] + list(map(lambda quantization: "tflite-{}".format(quantization), tflite.QUANTIZATIONS))
+
+# process-wide models keyed by (base model name, weights file, backend)
+# building the graph and loading the weights is costlier than the inference itself,
+# so every model is built only once and shared across all the requests
+_MODELS = {}
+# re-entrant as dual models are built from the models in the same registry
+_MODELS_LOCK = threading.RLock()
+# weights read by the master of the pre-fork server keyed by (weights file, backend), keras weights as numpy arrays
+# and converted models as their flatbuffer bytes, the forked workers build their models on these copy-on-write
+# buffers instead of reading the files again
+_PRELOADED_WEIGHTS = {}
+
+
+def preload_weights(weights_files, backend=KERAS, calibration_path=None):
+    # no tensorflow op is run, so the process is still safe to fork
+    for weights_file in weights_files:
+        model_content = None
+        if backend != KERAS:
+            model_content = tflite.read_model_content(weights_file, backend.split('-', 1)[1], calibration_path)
+        if model_content is not None:
+            _PRELOADED_WEIGHTS[(weights_file, backend)] = model_content
+        else:
+            # keras models and the tflite models yet to be converted are built from the keras weights
+            _PRELOADED_WEIGHTS[(weights_file, KERAS)] = utils.read_weights(weights_file)
+
+
+def get_model(base_model_name, weights_file, backend=KERAS, calibration_path=None):
+    key = (base_model_name, weights_file, backend)
+    with _MODELS_LOCK:
+        if key not in _MODELS and backend == KERAS:
+            nima = Nima(base_model_name, weights=None)
+            nima.build()
+            # variables of the model take a copy of the preloaded arrays, so only the file read is saved
+            if (weights_file, KERAS) in _PRELOADED_WEIGHTS:
+                utils.set_weights(nima.nima_model, _PRELOADED_WEIGHTS[(weights_file, KERAS)])
+            else:
+                nima.nima_model.load_weights(weights_file)
+            _MODELS[key] = nima
+        elif key not in _MODELS and (weights_file, backend) in _PRELOADED_WEIGHTS:
+            # interpreter runs on the preloaded buffer in place, so the keras model is not even built
+            _MODELS[key] = tflite.TfliteNima(
+                Nima(base_model_name, weights=None), _PRELOADED_WEIGHTS[(weights_file, backend)])
+        elif key not in _MODELS:
+            # tflite models are converted from the keras model with the same weights
+            _MODELS[key] = tflite.get_tflite_nima(
+                get_model(base_model_name, weights_file), weights_file, backend.split('-', 1)[1], calibration_path)
+        return _MODELS[key]
+
+
+def get_dual_model(base_model_name, technical_weights_file, aesthetic_weights_file):
+    key = (base_model_name, technical_weights_file, aesthetic_weights_file)
+    with _MODELS_LOCK:
+        if key not in _MODELS:
+            dual_nima = DualNima(
+                get_model(base_model_name, technical_weights_file),
+                get_model(base_model_name, aesthetic_weights_file)
+            )
+            dual_nima.build()
+            _MODELS[key] = dual_nima
+        return _MODELS[key]
+
+
+def warm_up(model, preprocessing_function):
+    # first inference traces the prediction function, so run it on a dummy image
+    dummy_images = np.zeros((1, 224, 224, 3))
+    model.predict(preprocessing_function(dummy_images))
+
+
+def load_models(base_model_name, weights_files, backend=KERAS, calibration_path=None):
+    start_time = time.time()
+    for weights_file in weights_files:
+        nima = get_model(base_model_name, weights_file, backend, calibration_path)
+        warm_up(nima.nima_model, nima.preprocessing_function())
+    # time taken to build, load and warm-up the models
+    return time.time() - start_time
+
+
+def check_drift(base_model_name, weights_files, backend, sample_path):
+    # drift of the mean scores of a tflite backend from the keras models, keyed by the weights file
+    drifts = {}
+    for weights_file in weights_files:
+        nima = get_model(base_model_name, weights_file)
+        images = tflite.load_sample_images(nima, sample_path)
+        drifts[weights_file] = tflite.calc_drift(nima, get_model(base_model_name, weights_file, backend), images)
+    return drifts
+
+
+def load_dual_model(base_model_name, technical_weights_file, aesthetic_weights_file):
+    start_time = time.time()
+    dual_nima = get_dual_model(base_model_name, technical_weights_file, aesthetic_weights_file)
+    warm_up(dual_nima.dual_model, dual_nima.preprocessing_function())
+    return time.time() - start_time
+
+
+def clear_models():
+    with _MODELS_LOCK:
+        _MODELS.clear()
@@ -0,0 +1,146 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from nima import utils
+from nima.data_generator import TestDataGenerator
+
+# post-training quantizations of the converted models, dynamic quantizes only the weights
+QUANTIZATIONS = ['float16', 'int8', 'dynamic']
+# images read from the sample folder for calibrating int8 and for measuring the drift
+SAMPLE_LIMIT = 200
+
+
+class TfliteModel:
+    '''tflite interpreter behind the predict of a keras model, so that nima.predict works with either of them'''
+
+    def __init__(self, model_content):
+        self.interpreter = tf.lite.Interpreter(model_content=model_content)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+        # interpreter holds the tensors of a single invocation, so the requests take turns
+        self.lock = threading.Lock()
+
+    def predict_batch(self, images):
+        with self.lock:
+            if len(images) != self.batch_size:
+                self.interpreter.resize_tensor_input(self.input_index, [len(images), 224, 224, 3])
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(images)
+            self.interpreter.set_tensor(self.input_index, np.asarray(images, dtype=np.float32))
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index)
+
+    def predict_on_batch(self, images):
+        return self.predict_batch(images)
+
+    def predict(self, data, workers=1, use_multiprocessing=False, verbose=0, callbacks=None):
+        if isinstance(data, np.ndarray):
+            return self.predict_batch(data)
+        # batch hooks of the keras callbacks are called the same way as keras predict does
+        callbacks = callbacks or []
+        predictions = []
+        for index in range(len(data)):
+            list(map(lambda callback: callback.on_predict_batch_begin(index), callbacks))
+            batch = data[index]
+            # batches of the test data generator come with their labels
+            predictions.append(self.predict_batch(batch[0] if isinstance(batch, tuple) else batch))
+            list(map(lambda callback: callback.on_predict_batch_end(index), callbacks))
+        return np.concatenate(predictions)
+
+
+class TfliteNima:
+    '''converted counterpart of a built Nima with the same nima_model and preprocessing_function'''
+
+    def __init__(self, nima, model_content):
+        self.base_model_name = nima.base_model_name
+        self.nima_model = TfliteModel(model_content)
+        self.base_preprocess = nima.preprocessing_function()
+
+    def preprocessing_function(self):
+        return self.base_preprocess
+
+
+def load_sample_images(nima, images_path, limit=SAMPLE_LIMIT, img_type='jpg'):
+    from nima.nima import image_dir_to_json
+
+    samples = sorted(image_dir_to_json(images_path, img_type), key=lambda k: k['image_id'])[:limit]
+    if len(samples) == 0:
+        return np.empty((0, 224, 224, 3), dtype=np.float32)
+    data_generator = TestDataGenerator(samples, images_path, len(samples), 10, nima.preprocessing_function(), img_type)
+    return data_generator[0][0].astype(np.float32)
+
+
+def convert(nima, quantization, calibration_images=None):
+    converter = tf.lite.TFLiteConverter.from_keras_model(nima.nima_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == QUANTIZATIONS[0]:
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == QUANTIZATIONS[1]:
+        # ranges of the activations are taken from the calibration images
+        if calibration_images is None or len(calibration_images) == 0:
+            raise ValueError("int8 quantization requires calibration images")
+        converter.representative_dataset = lambda: map(lambda image: [image[np.newaxis]], calibration_images)
+    return converter.convert()
+
+
+def get_calibration_key(calibration_path, img_type='jpg'):
+    # names, sizes and modified times of the calibration images, so that a changed calibration set converts again
+    image_paths = sorted(glob.glob(os.path.join(calibration_path, '*.' + img_type)),
+                         key=lambda image_path: os.path.basename(image_path).split('.')[0])[:SAMPLE_LIMIT]
+    images = list(map(lambda image_path: [os.path.basename(image_path), os.path.getsize(image_path),
+                                          os.path.getmtime(image_path)], image_paths))
+    return hashlib.sha256(json.dumps(images).encode()).hexdigest()[:12]
+
+
+def get_model_file(weights_file, quantization, calibration_path=None):
+    # int8 models depend on their calibration images as well
+    if quantization == QUANTIZATIONS[1] and calibration_path:
+        quantization = "{}-{}".format(quantization, get_calibration_key(calibration_path))
+    return "{}.{}.tflite".format(os.path.splitext(weights_file)[0], quantization)
+
+
+def read_model_content(weights_file, quantization, calibration_path=None):
+    # converted models are saved next to their weights and converted again only when the weights change
+    model_file = get_model_file(weights_file, quantization, calibration_path)
+    if os.path.exists(model_file) and os.path.getmtime(model_file) >= os.path.getmtime(weights_file):
+        with open(model_file, 'rb') as tflite_file:
+            return tflite_file.read()
+    return None
+
+
+def get_tflite_nima(nima, weights_file, quantization, calibration_path=None):
+    model_content = read_model_content(weights_file, quantization, calibration_path)
+    if model_content is not None:
+        return TfliteNima(nima, model_content)
+    model_file = get_model_file(weights_file, quantization, calibration_path)
+    calibration_images = load_sample_images(nima, calibration_path) if calibration_path else None
+    model_content = convert(nima, quantization, calibration_images)
+    # written to a temp file first, so that the workers warming up at the same time never load a partial model
+    temp_file = "{}.{}.tmp".format(model_file, os.getpid())
+    with open(temp_file, 'wb') as tflite_file:
+        tflite_file.write(model_content)
+    os.replace(temp_file, model_file)
+    return TfliteNima(nima, model_content)
+
+
+def calc_drift(nima, tflite_nima, images):
+    # mean scores of the converted model against the keras model on the same images
+    if len(images) == 0:
+        return None
+    scores, tflite_scores = tuple(map(
+        lambda model: np.array(list(map(utils.calc_mean_score, model.predict(images)))),
+        [nima.nima_model, tflite_nima.nima_model]
+    ))
+    drifts = np.abs(scores - tflite_scores)
+    return {
+        'samples': len(images),
+        'meanDrift': float(drifts.mean()),
+        'maxDrift': float(drifts.max())
+    }
@@ -1,9 +1,61 @@
 import json
-import shutil
+import math
+import os
+import time
+import traceback
 
 import tensorflow as tf
 import numpy as np
-from tqdm import tqdm
+
+# approximate memory required by a 224x224 image in a MobileNet forward pass (input, activations and outputs)
+BATCH_BYTES_PER_IMAGE = 24 * 1024 * 1024
+# share of the available memory that auto batch size is allowed to use
+AUTO_MEMORY_FRACTION = 0.5
+AUTO_MAX_BATCH_SIZE = 256
+
+
+class BatchTimer(tf.keras.callbacks.Callback):
+    '''passes the seconds taken by every predicted batch to on_batch'''
+
+    def __init__(self, on_batch):
+        super().__init__()
+        self.on_batch = on_batch
+        self.start_time = None
+
+    def on_predict_batch_begin(self, batch, logs=None):
+        self.start_time = time.perf_counter()
+
+    def on_predict_batch_end(self, batch, logs=None):
+        self.on_batch(time.perf_counter() - self.start_time)
+
+
+def read_weights(weights_file):
+    # arrays of the layers with weights in the order keras saved them, read without running a tensorflow op
+    import h5py
+
+    def decode(name):
+        # names are saved as bytes by the older versions of h5py
+        return name.decode('utf8') if isinstance(name, bytes) else name
+
+    with h5py.File(weights_file, 'r') as weights_h5:
+        group = weights_h5['model_weights'] if 'model_weights' in weights_h5 else weights_h5
+        layer_weights = []
+        for layer_name in map(decode, group.attrs['layer_names']):
+            layer_group = group[layer_name]
+            weights = list(map(lambda weight_name: np.asarray(layer_group[decode(weight_name)]),
+                               layer_group.attrs['weight_names']))
+            if len(weights) > 0:
+                layer_weights.append(weights)
+    return layer_weights
+
+
+def set_weights(model, layer_weights):
+    # same matching as keras load_weights, the layers with weights take the saved arrays in order
+    layers = list(filter(lambda layer: len(layer.weights) > 0, model.layers))
+    if len(layers) != len(layer_weights):
+        raise ValueError("Model has {} layers with weights, the weights have {}".format(
+            len(layers), len(layer_weights)))
+    list(map(lambda layer, weights: layer.set_weights(weights), layers, layer_weights))
 
 
 def load_json(file_path):
@@ -50,16 +102,40 @@ def calc_mean_score(score_dist):
     return (score_dist * np.arange(1, 11)).sum()
 
 
-def move_files(files, cur_dir, new_dir):
-    for file_name in tqdm(
-            files,
-            desc="[nima] Moving **{} -> **{}".format(
-                cur_dir[cur_dir.rindex("/"):],
-                new_dir[new_dir.rindex("/"):]
-            )
-    ):
-        cur_location, new_location = tuple(map(
-            lambda dir_path: '{}/{}'.format(dir_path, file_name),
-            [cur_dir, new_dir])
-        )
-        shutil.move(cur_location, new_location)
+def get_available_memory():
+    # MemAvailable accounts for the reclaimable caches, so prefer it when the kernel reports it
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_auto_batch_size(memory_fraction=AUTO_MEMORY_FRACTION, max_batch_size=AUTO_MAX_BATCH_SIZE):
+    batch_size = int(get_available_memory() * memory_fraction / BATCH_BYTES_PER_IMAGE)
+    batch_size = min(max(batch_size, 1), max_batch_size)
+    # largest power of two that fits
+    return 2 ** int(math.log2(batch_size))
+
+
+def resolve_batch_size(batch_size):
+    if batch_size == 'auto':
+        return get_auto_batch_size()
+    return max(int(batch_size), 1)
+
+
+def set_memory_growth():
+    # get available gpus
+    gpus = tf.config.experimental.list_physical_devices('GPU')
+    if gpus:
+        try:
+            # Currently, memory growth needs to be the same across GPUs
+            for gpu in gpus:
+                tf.config.experimental.set_memory_growth(gpu, True)
+        except RuntimeError as ex:
+            # Memory growth must be set before GPUs have been initialized
+            print("Exception occurred when enabling memory growth: {}".format(ex))
+            traceback.print_exc()
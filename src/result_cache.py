@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import closing
+
+from flask import current_app
+
+from sqlite_store import SqliteStore
+
+# bytes read at once while hashing the files
+CHUNK_SIZE = 1024 * 1024
+# configs changing the generated highlights apart from the request params
+RESULT_CONFIGS = ['SCENE_CANDIDATES', 'SCENE_CANDIDATE_STRATEGY', 'PREFILTER_RATIO',
+                  'VIDEO_DECODER', 'NIMA_DUAL_HEAD']
+
+CREATE_RESULTS_TABLE = '''
+CREATE TABLE results (
+    key TEXT PRIMARY KEY,
+    request_uid TEXT NOT NULL,
+    predictions TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    used_at REAL NOT NULL
+)
+'''
+
+
+class ResultCache(SqliteStore):
+    '''sqlite index of the generated highlights keyed by the video content and the params, owns the output images'''
+
+    # output images are deleted on start, so the results are also dropped on reset
+    table_name = 'results'
+    create_table = CREATE_RESULTS_TABLE
+
+    def __init__(self, db_path, output_path, max_size, max_age):
+        super().__init__(db_path)
+        self.output_path = output_path
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def get(self, key):
+        with closing(self.connect()) as connection:
+            result = connection.execute("SELECT * FROM results WHERE key = ?", (key,)).fetchone()
+            if result is None or time.time() - result['created_at'] > self.max_age:
+                return None
+            connection.execute("UPDATE results SET used_at = ? WHERE key = ?", (time.time(), key))
+            return json.loads(result['predictions'])
+
+    def add(self, key, request_uid, predictions):
+        size = get_dir_size("{}/{}".format(self.output_path, request_uid))
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            # replaced result of the same key, as on concurrent requests for the same video, owns its own images
+            replaced_result = connection.execute("SELECT request_uid FROM results WHERE key = ?", (key,)).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO results (key, request_uid, predictions, size, created_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, request_uid, json.dumps(predictions), size, time.time(), time.time())
+            )
+            connection.execute("COMMIT")
+        if replaced_result is not None and replaced_result['request_uid'] != request_uid:
+            shutil.rmtree("{}/{}".format(self.output_path, replaced_result['request_uid']), ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        # expired results first and then the least recently used ones till the images fit the cache size
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            results = connection.execute("SELECT key, request_uid, size, created_at FROM results "
+                                         "ORDER BY used_at DESC").fetchall()
+            total_size = 0
+            evicted_results = []
+            for index, result in enumerate(results):
+                total_size += result['size']
+                # the latest result is just served, so it stays even when it is larger than the cache
+                is_oversized = index > 0 and total_size > self.max_size
+                if is_oversized or time.time() - result['created_at'] > self.max_age:
+                    evicted_results.append(result)
+            connection.executemany(
+                "DELETE FROM results WHERE key = ?", list(map(lambda result: (result['key'],), evicted_results)))
+            connection.execute("COMMIT")
+        for result in evicted_results:
+            shutil.rmtree("{}/{}".format(self.output_path, result['request_uid']), ignore_errors=True)
+        return len(evicted_results)
+
+
+def get_result_cache():
+    return ResultCache(
+        current_app.config['RESULTS_DB_PATH'],
+        current_app.config['OUTPUT_IMAGES_PATH'],
+        current_app.config['RESULT_CACHE_SIZE'] * 1024 * 1024,
+        current_app.config['RESULT_CACHE_AGE'] * 60 * 60
+    )
+
+
+def is_enabled():
+    return current_app.config['RESULT_CACHE_SIZE'] > 0
+
+
+def get_dir_size(dir_path):
+    if not os.path.isdir(dir_path):
+        return 0
+    return sum(map(lambda entry: entry.stat().st_size, filter(lambda entry: entry.is_file(), os.scandir(dir_path))))
+
+
+def hash_file(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_weights_version(config):
+    # contents of the weights and the backend running them decide the scores,
+    # so a retrained or a quantized model never serves the old results
+    return hashlib.sha256(''.join(list(map(
+        lambda config_name: hash_file(config[config_name]),
+        ['TECHNICAL_WEIGHTS_FILE_PATH', 'AESTHETIC_WEIGHTS_FILE_PATH']
+    )) + [config['INFERENCE_BACKEND']]).encode()).hexdigest()
+
+
+def get_result_key(content_hash, params):
+    key_params = dict(params, **{config_name: current_app.config[config_name] for config_name in RESULT_CONFIGS})
+    return hashlib.sha256(json.dumps({
+        'content_hash': content_hash,
+        'params': key_params,
+        'weights_version': current_app.config['WEIGHTS_VERSION']
+    }, sort_keys=True).encode()).hexdigest()
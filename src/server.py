@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+
+from werkzeug.serving import make_server
+
+import jobs
+import nima
+from app import create_app, create_parser, warm_up_app
+from generator import human_eye_mode, preload_weights, scene_detect_mode
+
+# tensorflow and opencv are imported by these modules once in the master, so that the forked workers share them
+PRELOADED_MODULES = [nima, human_eye_mode, scene_detect_mode]
+# roles of the forked workers
+HTTP = 'http'
+JOBS = 'jobs'
+# seconds a worker is given to exit on shutdown before it is killed
+SHUTDOWN_TIMEOUT = 10
+
+
+def run_http_worker(app, server, ready_flags, index):
+    from nima.utils import set_memory_growth
+
+    # models are built only after the fork, as tensorflow starts its thread pools and cuda on the first op
+    # and neither of them survive a fork, they are built on the weights preloaded by the master
+    set_memory_growth()
+    # drift of the converted models is the same in every worker, so only the first one measures it
+    warm_up_app(app, index == 0)
+    ready_flags[index] = 1
+    # connections wait in the backlog of the shared socket for a warm worker, so no request builds the models
+    server.serve_forever()
+
+
+def run_job_worker(app):
+    from nima.utils import set_memory_growth
+
+    set_memory_growth()
+    jobs.process_jobs(app)
+
+
+def fork_worker(target, *args):
+    pid = os.fork()
+    if pid > 0:
+        return pid
+    # worker exits with its target, so that it never returns to the loop of the master
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    exit_code = 0
+    try:
+        target(*args)
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+
+def stop_workers(workers):
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+    while len(workers) > 0 and time.time() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.1)
+            continue
+        workers.pop(pid, None)
+    for pid in workers:
+        os.kill(pid, signal.SIGKILL)
+
+
+def main():
+    parser = create_parser()
+    parser.add_argument('--host',
+                        default='127.0.0.1',
+                        help='address the server listens on, defaults to "127.0.0.1"')
+    parser.add_argument('--port',
+                        default=5000,
+                        type=int,
+                        help='port the server listens on, defaults to 5000')
+    parser.add_argument('--workers',
+                        default=2,
+                        type=int,
+                        help='number of forked processes serving the requests, defaults to 2')
+    args = parser.parse_args()
+
+    # models are not built by the master, see run_http_worker
+    app = create_app(args, load_nima_models=False)
+    # weights are read once by the master, so that the workers share the buffers copy-on-write
+    preload_weights(app.config)
+    app.config['PREFORK_WORKERS'] = args.workers
+    # shared with the workers on fork, every worker sets its flag once its models are warmed up
+    ready_flags = multiprocessing.Array('b', args.workers)
+    app.extensions['readiness'] = lambda: (sum(ready_flags), args.workers)
+    # socket is bound by the master, so that every worker accepts the connections on the same port
+    # concurrent requests of a worker are served in threads when their frames are batched together
+    server = make_server(args.host, args.port, app, threaded=app.config['BATCHING_WAIT'] > 0)
+    app.logger.info("Serving on http://{}:{} with {} workers".format(args.host, args.port, args.workers))
+
+    # workers are keyed by their pid along with the role and the index to fork them again
+    workers = {}
+    for index in range(args.workers):
+        workers[fork_worker(run_http_worker, app, server, ready_flags, index)] = (HTTP, index)
+    for index in range(app.config['JOB_WORKERS']):
+        workers[fork_worker(run_job_worker, app)] = (JOBS, index)
+
+    def shutdown(signum, frame):
+        app.logger.info("Stopping {} workers".format(len(workers)))
+        stop_workers(workers)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while True:
+        pid, status = os.wait()
+        if pid not in workers:
+            continue
+        role, index = workers.pop(pid)
+        app.logger.error("Worker {} ({} {}) exited with status {}, forking it again".format(pid, role, index, status))
+        if role == HTTP:
+            ready_flags[index] = 0
+            workers[fork_worker(run_http_worker, app, server, ready_flags, index)] = (HTTP, index)
+        else:
+            # running jobs of the exited worker can never finish
+            alive_pids = list(map(lambda item: item[0], filter(lambda item: item[1][0] == JOBS, workers.items())))
+            jobs.JobStore(app.config['JOBS_DB_PATH']).fail_orphans(alive_pids)
+            workers[fork_worker(run_job_worker, app)] = (JOBS, index)
+
+
+if __name__ == '__main__':
+    main()
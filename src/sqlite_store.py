@@ -0,0 +1,24 @@
+import sqlite3
+from contextlib import closing
+
+
+class SqliteStore:
+    '''sqlite database with a single table, opened by every process that shares it'''
+
+    # name and create statement of the table, set by the stores
+    table_name = None
+    create_table = None
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def connect(self):
+        # autocommit mode, transactions are started explicitly when required
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def reset(self):
+        with closing(self.connect()) as connection:
+            connection.execute("DROP TABLE IF EXISTS {}".format(self.table_name))
+            connection.execute(self.create_table)
@@ -75,7 +75,7 @@ usage()
   echo "  --use-conda-env CONDA_ENV_NAME"
   echo "                            starts the app by activating conda environment CONDA_ENV_NAME,"
   echo "                            this option is ignored if either of --update-conda-env or --create-conda-env are also available"
-  echo "  *                         arguments to app.py as shown below"
+  echo "  *                         arguments to app.py (or server.py in production) as shown below"
   echo ""
 }
 
@@ -147,10 +147,15 @@ then
 else
   generate_args
 fi
-# run the server
+# run the pre-fork server in production and the flask server otherwise
+SERVER=src/app.py
+if [ "${MODE}" = "production" ]
+then
+  SERVER=src/server.py
+fi
 if [ "${ARGS}" != "" ]
 then
-  python src/app.py "${ARGS}"
+  python ${SERVER} "${ARGS}"
 else
-  python src/app.py
+  python ${SERVER}
 fi
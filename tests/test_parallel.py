@@ -0,0 +1,131 @@
+import os
+import signal
+import sys
+import time
+
+import cv2
+import numpy as np
+import pytest
+from flask import Flask
+
+# modules of the app are imported the same way as app.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from generator import create_mode, init_state  # noqa: E402
+from generator import parallel  # noqa: E402
+from generator.parallel import extract_clips  # noqa: E402
+
+# two clips of a minute, small frames keep the video quick to decode
+DURATION = 130
+FPS = 10
+FRAME_SHAPE = (96, 128)
+
+
+@pytest.fixture(scope='module')
+def video_file_path(tmp_path_factory):
+    file_path = str(tmp_path_factory.mktemp('videos') / 'clips.mp4')
+    rng = np.random.RandomState(0)
+    writer = cv2.VideoWriter(file_path, cv2.VideoWriter_fourcc(*'mp4v'), FPS, FRAME_SHAPE[::-1])
+    for _ in range(DURATION * FPS):
+        writer.write(rng.randint(0, 256, FRAME_SHAPE + (3,)).astype(np.uint8))
+    writer.release()
+    return file_path
+
+
+def create_app(decode_workers, shared_memory_frames):
+    app = Flask(__name__)
+    app.config.from_mapping(
+        IN_MEMORY_FRAMES=True,
+        NIMA_BATCH_SIZE='32',
+        NIMA_DUAL_HEAD=False,
+        PREFILTER_RATIO=1,
+        KEYFRAME_INTERVAL=250,
+        VIDEO_DECODER='opencv',
+        DECODE_THREADS=0,
+        DECODE_WORKERS=decode_workers,
+        SHARED_MEMORY_FRAMES=shared_memory_frames,
+        PIPELINE_BATCHES=0,
+        SCENE_CANDIDATES=0,
+        SCENE_CANDIDATE_STRATEGY='sharpness',
+        FRAME_CACHE_SIZE=0,
+        PROGRESS_BARS=False
+    )
+    return app
+
+
+def create_state(mode_name, video_file_path, tmp_path):
+    return init_state({
+        'request_uid': mode_name,
+        'mode': mode_name,
+        'video_file_path': video_file_path,
+        'total_clips': 2,
+        'images_per_clip': 5,
+        'seed': 'parallel',
+        'image_extension': 'jpg',
+        'temp_images_path': str(tmp_path)
+    })
+
+
+def extract_sequentially(state):
+    clips = []
+    extract_state = None
+    for clip_id in range(1, state['total_clips'] + 1):
+        state.update({'clip_id': clip_id, 'tag': "[{}:{}]".format(state['request_uid'], clip_id)})
+        mode = create_mode(state)
+        extract_state = mode.extract(extract_state)
+        clips.append((mode.extracted_frames, extract_state))
+    return clips
+
+
+def extract_in_parallel(state):
+    clips = []
+    for extracted_frames, extract_state in extract_clips(state):
+        # frames in the shared slots are recycled on the next clip, so they are copied as the caller would
+        clips.append((list(map(lambda frame: dict(frame, image=np.array(frame['image'])), extracted_frames)),
+                      extract_state))
+    return clips
+
+
+def kill_decode_worker(max_workers):
+    # workers are spawned on the first submit, so an empty clip list starts them before one of them is killed
+    executor = parallel.get_executor(max_workers)
+    executor.submit(len, []).result()
+    os.kill(next(iter(executor._processes)), signal.SIGKILL)
+    # pool is marked broken once its management thread notices the dead worker
+    deadline = time.time() + 10
+    while not executor._broken and time.time() < deadline:
+        time.sleep(0.1)
+    assert executor._broken
+    return executor
+
+
+def assert_same_clips(clips, expected_clips):
+    assert len(clips) == len(expected_clips)
+    for (frames, extract_state), (expected_frames, expected_state) in zip(clips, expected_clips):
+        assert extract_state == expected_state
+        assert list(map(lambda frame: frame['timestamp'], frames)) == \
+            list(map(lambda frame: frame['timestamp'], expected_frames))
+        for frame, expected_frame in zip(frames, expected_frames):
+            assert np.array_equal(frame['image'], expected_frame['image'])
+
+
+@pytest.mark.parametrize('mode_name', ['human_eye', 'scene_detect'])
+@pytest.mark.parametrize('shared_memory_frames', [False, True])
+def test_parallel_extraction_matches_sequential(mode_name, shared_memory_frames, video_file_path, tmp_path):
+    with create_app(0, False).app_context():
+        expected_clips = extract_sequentially(create_state(mode_name, video_file_path, tmp_path))
+    with create_app(2, shared_memory_frames).app_context():
+        clips = extract_in_parallel(create_state(mode_name, video_file_path, tmp_path))
+    assert_same_clips(clips, expected_clips)
+
+
+@pytest.mark.parametrize('shared_memory_frames', [False, True])
+def test_parallel_extraction_survives_dead_worker(shared_memory_frames, video_file_path, tmp_path):
+    with create_app(0, False).app_context():
+        expected_clips = extract_sequentially(create_state('human_eye', video_file_path, tmp_path))
+    with create_app(2, shared_memory_frames).app_context():
+        broken_executor = kill_decode_worker(2)
+        clips = extract_in_parallel(create_state('human_eye', video_file_path, tmp_path))
+    # request completes in a new pool with the same frames
+    assert parallel.get_executor(2) is not broken_executor
+    assert_same_clips(clips, expected_clips)
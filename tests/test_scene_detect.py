@@ -0,0 +1,77 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+
+# modules of the app are imported the same way as app.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from generator.scene_detect_mode import CHANNELS, HIST_SIZE, RANGES, calc_hists, detect_scenes, \
+    is_scene_detected  # noqa: E402
+
+FRAME_SHAPE = (72, 96, 3)
+
+
+def create_frames(seed=0):
+    # scenes of noisy frames around a random color range, with single color frames among them
+    rng = np.random.RandomState(seed)
+    frames = []
+    for _ in range(6):
+        low = rng.randint(0, 200, 3)
+        base = rng.randint(0, 56, FRAME_SHAPE) + low
+        for _ in range(rng.randint(3, 8)):
+            frames.append(np.clip(base + rng.randint(-8, 9, FRAME_SHAPE), 0, 255).astype(np.uint8))
+        frames.append(np.full(FRAME_SHAPE, rng.randint(0, 256, 3), dtype=np.uint8))
+    # black and white frames, whose hue and saturation are all 0
+    frames.append(np.zeros(FRAME_SHAPE, dtype=np.uint8))
+    frames.append(np.full(FRAME_SHAPE, 255, dtype=np.uint8))
+    return np.stack(frames)
+
+
+def calc_hist_per_frame(frame):
+    # per-frame histogram of the previous implementation
+    hist = cv2.calcHist([cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)], CHANNELS, None, HIST_SIZE, RANGES, accumulate=False)
+    cv2.normalize(hist, hist, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
+    return hist
+
+
+def detect_scenes_per_frame(frames):
+    # per-frame scene detection of the previous implementation, the base is replaced on every scene change
+    scene_changes = []
+    correlations = []
+    base_hist = None
+    for frame in frames:
+        hist = calc_hist_per_frame(frame)
+        scene_detected = is_scene_detected(hist, base_hist)
+        correlations.append(np.nan if base_hist is None else cv2.compareHist(base_hist, hist, cv2.HISTCMP_CORREL))
+        scene_changes.append(scene_detected)
+        if scene_detected or base_hist is None:
+            base_hist = hist
+    return np.array(scene_changes), np.array(correlations)
+
+
+def test_calc_hists_matches_calc_hist():
+    frames = create_frames()
+    expected_hists = np.stack(list(map(lambda frame: calc_hist_per_frame(frame).ravel(), frames)))
+    assert np.allclose(calc_hists(frames), expected_hists, atol=1e-6)
+
+
+def test_detect_scenes_matches_compare_hist():
+    frames = create_frames()
+    expected_changes, expected_correlations = detect_scenes_per_frame(frames)
+    scene_changes, correlations, _ = detect_scenes(calc_hists(frames), None)
+    assert scene_changes.any()
+    assert np.array_equal(scene_changes, expected_changes)
+    assert np.allclose(correlations, expected_correlations, atol=1e-5, equal_nan=True)
+
+
+def test_detect_scenes_continues_from_base():
+    # a clip split in two detects the same scenes as the whole clip when the base is carried over
+    hists = calc_hists(create_frames())
+    scene_changes, correlations, _ = detect_scenes(hists, None)
+    split = len(hists) // 2
+    first_changes, first_correlations, base_hist = detect_scenes(hists[:split], None)
+    last_changes, last_correlations, _ = detect_scenes(hists[split:], base_hist)
+    assert np.array_equal(np.concatenate([first_changes, last_changes]), scene_changes)
+    assert np.allclose(np.concatenate([first_correlations, last_correlations]), correlations, equal_nan=True)